@@ -0,0 +1,273 @@
+""" On-disk caches for the outlier detection pipeline
+
+The metric cache stores the metric time series computed for a run, keyed by
+the SHA1 hash of the run file, the metric name, the metric arguments and the
+package version.  Changing a detector setting then does not require loading
+and decoding the images again.  The hashes of the run files are also kept in
+the cache directory, keyed by the path, size, modification time and inode of
+each file, so a new process does not read an unchanged run to hash it again.
+
+The decode cache stores an uncompressed copy of each gzipped run, loaded
+memory-mapped, so that a run is only decompressed once.
+"""
+
+import hashlib
+import json
+import os
+import os.path as op
+
+import numpy as np
+import nibabel as nib
+
+from findoutlie import __version__
+
+# Size of the blocks read when hashing a file
+HASH_CHUNK_SIZE = 2 ** 20
+
+# Hashes already computed in this process, keyed by (path, size, mtime, inode)
+_HASH_MEMO = {}
+
+
+def file_hash(fname, chunk_size=HASH_CHUNK_SIZE):
+    """ Return SHA1 hash of the contents of file `fname`
+
+    The file is read by blocks, so the memory use does not depend on the file
+    size.
+
+    Parameters
+    ----------
+    fname : str
+        Name of file to read
+    chunk_size : int, optional
+        Size in bytes of the blocks read from the file.
+
+    Returns
+    -------
+    hash : str
+        SHA1 hexadecimal hash string for contents of `fname`.
+    """
+    sha1 = hashlib.sha1()
+    with open(fname, 'rb') as fobj:
+        for block in iter(lambda: fobj.read(chunk_size), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def cached_file_hash(fname, memo_dir=None):
+    """ Return SHA1 hash of file `fname`, reusing hashes computed before
+
+    The hash is computed again only if the size, modification time or inode
+    of the file changed since the last call in this process.
+
+    Parameters
+    ----------
+    fname : str
+        Name of file to hash.
+    memo_dir : str, optional
+        Directory keeping the hashes between processes, by default None (only
+        kept in this process).  A hash stored there is reused while the path,
+        size, modification time and inode of the file are unchanged.
+
+    Returns
+    -------
+    hash : str
+        SHA1 hexadecimal hash string for contents of `fname`.
+    """
+    stat = os.stat(fname)
+    memo_key = (op.abspath(fname), stat.st_size, stat.st_mtime_ns,
+                stat.st_ino)
+    if memo_key in _HASH_MEMO:
+        return _HASH_MEMO[memo_key]
+    if memo_dir is None:
+        _HASH_MEMO[memo_key] = file_hash(fname)
+        return _HASH_MEMO[memo_key]
+    memo_name = hashlib.sha1(json.dumps(memo_key).encode()).hexdigest()
+    memo_path = op.join(memo_dir, memo_name + '.sha1')
+    try:
+        with open(memo_path) as fobj:
+            sha1 = fobj.read().strip()
+    except FileNotFoundError:
+        sha1 = ''
+    if len(sha1) != 40:
+        sha1 = file_hash(fname)
+        # Write then rename, so other processes never read a partial file
+        tmp_path = f'{memo_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as fobj:
+            fobj.write(sha1)
+        os.replace(tmp_path, memo_path)
+    _HASH_MEMO[memo_key] = sha1
+    return sha1
+
+
+def evict(cache_dir, max_bytes, suffix):
+    """ Remove least recently used files in `cache_dir` above `max_bytes`
+
+    Parameters
+    ----------
+    cache_dir : str
+        Cache directory.
+    max_bytes : int
+        Maximum total size of the cached files.
+    suffix : str
+        Only the files ending with `suffix` are considered.
+    """
+    entries = []
+    for entry in os.scandir(cache_dir):
+        # Skip the files being written
+        if '.tmp' in entry.name:
+            continue
+        if entry.is_file() and entry.name.endswith(suffix):
+            stat = entry.stat()
+            entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    # Oldest access first
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            # Already evicted by another process
+            pass
+        total -= size
+
+
+class MetricCache:
+    """ Content-addressed on-disk cache of metric time series
+
+    Each entry is a ``.npy`` file named from the hash of the run file contents,
+    the metric name and arguments and the package version.  When the cache
+    grows above `max_bytes`, the least recently used entries are removed.
+    The hashes of the run files are kept in the ``hashes`` subdirectory (see
+    `cached_file_hash`), and the number of volumes and decoding type of each
+    run in ``.json`` entries (see `get_info`), so that a run whose metrics are
+    all cached is not loaded at all.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory holding the cache, created if needed.
+    max_bytes : int, optional
+        Maximum size of the cache, by default 1 GB.
+    """
+
+    def __init__(self, cache_dir, max_bytes=2 ** 30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hash_dir = op.join(cache_dir, 'hashes')
+        os.makedirs(self.hash_dir, exist_ok=True)
+
+    def key(self, fname, metric_name, **kwargs):
+        """ Return the cache key for metric `metric_name` of run `fname`
+        """
+        key_parts = [cached_file_hash(fname, self.hash_dir), metric_name,
+                     sorted((k, repr(v)) for k, v in kwargs.items()),
+                     __version__]
+        return hashlib.sha1(json.dumps(key_parts).encode()).hexdigest()
+
+    def _path(self, key):
+        return op.join(self.cache_dir, key + '.npy')
+
+    def get(self, fname, metric_name, **kwargs):
+        """ Return cached metric values, or None if not in the cache
+        """
+        path = self._path(self.key(fname, metric_name, **kwargs))
+        try:
+            values = np.load(path)
+        except (FileNotFoundError, ValueError, EOFError):
+            return None
+        # Mark the entry as recently used
+        os.utime(path)
+        return values
+
+    def put(self, fname, metric_name, values, **kwargs):
+        """ Store metric values in the cache
+        """
+        path = self._path(self.key(fname, metric_name, **kwargs))
+        # Write then rename, so other processes never read a partial file
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as fobj:
+            np.save(fobj, np.asarray(values))
+        os.replace(tmp_path, path)
+        evict(self.cache_dir, self.max_bytes, '.npy')
+
+    def _info_path(self, fname, **kwargs):
+        return op.join(self.cache_dir,
+                       self.key(fname, 'run_info', **kwargs) + '.json')
+
+    def get_info(self, fname, **kwargs):
+        """ Return the cached run information of `fname`, or None
+
+        The information is the dictionary stored by `put_info`, such as the
+        number of volumes and the decoding type of the run.
+        """
+        try:
+            with open(self._info_path(fname, **kwargs)) as fobj:
+                return json.load(fobj)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def put_info(self, fname, info, **kwargs):
+        """ Store dictionary `info` of run information for `fname`
+        """
+        path = self._info_path(fname, **kwargs)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as fobj:
+            json.dump(info, fobj)
+        os.replace(tmp_path, path)
+
+
+class DecodeCache:
+    """ Cache of uncompressed copies of gzipped runs, loaded memory-mapped
+
+    The first access to a run writes it once as an uncompressed ``.nii`` file
+    in the cache directory; the next accesses load that file with
+    ``mmap=True``, so reading the data does not decompress anything, and does
+    not copy it when the image has no scaling.  Entries are keyed by the path,
+    size and modification time of the original file.  When the cache grows
+    above `max_bytes`, the least recently used entries are removed.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory holding the cache, created if needed.
+    max_bytes : int, optional
+        Maximum size of the cache, by default 20 GB.
+    """
+
+    def __init__(self, cache_dir, max_bytes=20 * 2 ** 30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, fname):
+        """ Return the cache key of run `fname`
+        """
+        stat = os.stat(fname)
+        key_parts = [op.abspath(fname), stat.st_size, stat.st_mtime_ns]
+        return hashlib.sha1(json.dumps(key_parts).encode()).hexdigest()
+
+    def get_path(self, fname):
+        """ Return the path of the uncompressed copy of `fname`, writing it if
+        needed
+        """
+        if not fname.endswith('.gz'):
+            # Already uncompressed
+            return fname
+        path = op.join(self.cache_dir, self.key(fname) + '.nii')
+        if op.isfile(path):
+            # Mark the entry as recently used
+            os.utime(path)
+            return path
+        img = nib.load(fname)
+        # Write then rename, so other processes never read a partial file
+        tmp_path = f'{path[:-4]}.{os.getpid()}.tmp.nii'
+        nib.save(img, tmp_path)
+        os.replace(tmp_path, path)
+        evict(self.cache_dir, self.max_bytes, '.nii')
+        return path
+
+    def load(self, fname, **kwargs):
+        """ Load run `fname` from its memory-mapped uncompressed copy
+        """
+        return nib.load(self.get_path(fname), mmap=True, **kwargs)
@@ -0,0 +1,274 @@
+""" Outlier detection across the runs of a cohort
+
+The metric series of all the runs are stacked in one (n_runs x n_timepoints)
+array, padded with NaN, with the values aligned to the volumes.  The detectors
+are then applied once to the whole array:
+
+* frame level: each frame is compared to the frames of all the runs;
+* run level: a summary of each run (such as its median) is compared to the
+  summaries of the other runs;
+* group level: the run summaries are averaged by group (subject, site...) and
+  the groups compared to each other.
+
+The runs that cannot be processed have NaN rows, and are left out of the run
+and group levels; without any processed run, nothing is an outlier.  The metrics must give 1D series: a 2D metric (such as
+slice_dvars) has no single value per frame to compare between runs.
+"""
+
+import warnings
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import findoutlie.data_load as data_load
+import findoutlie.metrics as metrics
+import findoutlie.profiling as profiling
+from findoutlie.dataset_index import DatasetIndex, parse_bids_entities
+from findoutlie.outfind import CONFIG, compute_metrics
+from findoutlie.registry import get_detector
+
+CohortOutliers = namedtuple('CohortOutliers', ['frames', 'runs',
+                                               'group_labels', 'groups'])
+
+SUMMARIES = {'median': np.nanmedian,
+             'mean': np.nanmean,
+             'max': np.nanmax}
+
+
+def stack_series(series, offsets=0, n_timepoints=None):
+    """ Stack metric series of different lengths in a NaN-padded 2D array
+
+    Parameters
+    ----------
+    series : sequence of 1D arrays
+        Metric values of each run.
+    offsets : int or sequence of int, optional
+        Index of the volume matching the first value of each series, by
+        default 0.
+    n_timepoints : int, optional
+        Number of columns, by default the longest series plus its offset.
+
+    Returns
+    -------
+    stacked : 2D array (n_runs x n_timepoints)
+        Metric values aligned to the volumes, NaN where there is no value.
+    """
+    lengths = np.array([len(values) for values in series])
+    offsets = np.broadcast_to(offsets, lengths.shape)
+    if n_timepoints is None:
+        n_timepoints = int(np.max(lengths + offsets, initial=0))
+    columns = np.arange(n_timepoints)
+    filled = ((columns >= offsets[:, None])
+              & (columns < (offsets + lengths)[:, None]))
+    stacked = np.full((len(lengths), n_timepoints), np.nan)
+    # Row-major order of the mask matches the concatenated series
+    stacked[filled] = np.concatenate([np.asarray(values, dtype=float)
+                                      for values in series] or [[]])
+    return stacked
+
+
+def detect_cohort_outliers(stacked, groups=None, detector_name='iqr_detector',
+                           summary='median', **kwargs):
+    """ Detect outlier frames, runs and groups in stacked metric series
+
+    Parameters
+    ----------
+    stacked : 2D array (n_runs x n_timepoints)
+        Metric values of each run, NaN-padded (see `stack_series`).
+    groups : sequence, optional
+        Group label of each run (for instance the subject), by default None
+        (no group-level detection).
+    detector_name : str, optional
+        Name of the detector, by default 'iqr_detector'.
+    summary : str, optional
+        Run summary compared between runs: 'median', 'mean' or 'max', by
+        default 'median'.
+    **kwargs
+        Extra arguments passed to the detector.
+
+    Returns
+    -------
+    outliers : CohortOutliers
+        Named tuple with fields:
+
+        * frames : 2D boolean array, True for the frames that are outliers
+          relative to the frames of all the runs;
+        * runs : 1D boolean array, True for the outlier runs (False for the
+          runs without values);
+        * group_labels : sorted unique group labels (None without groups);
+        * groups : 1D boolean array, True for the outlier groups (None without
+          groups).
+    """
+    detector = get_detector(detector_name)
+    stacked = np.asarray(stacked, dtype=float)
+    valid = ~np.isnan(stacked)
+
+    frames = np.zeros(stacked.shape, dtype=bool)
+    frames[valid] = _detect_values(detector, stacked[valid], kwargs)
+
+    with warnings.catch_warnings():
+        # Rows of the failed runs are all NaN
+        warnings.simplefilter('ignore', RuntimeWarning)
+        run_values = SUMMARIES[summary](stacked, axis=1)
+    valid_runs = ~np.isnan(run_values)
+    runs = np.zeros(len(run_values), dtype=bool)
+    runs[valid_runs] = _detect_values(detector, run_values[valid_runs], kwargs)
+
+    group_labels = group_tf = None
+    if groups is not None:
+        group_labels, inverse = np.unique(np.asarray(groups),
+                                          return_inverse=True)
+        n_groups = len(group_labels)
+        counts = np.bincount(inverse[valid_runs], minlength=n_groups)
+        sums = np.bincount(inverse[valid_runs], weights=run_values[valid_runs],
+                           minlength=n_groups)
+        valid_groups = counts > 0
+        group_tf = np.zeros(n_groups, dtype=bool)
+        group_tf[valid_groups] = _detect_values(
+            detector, sums[valid_groups] / counts[valid_groups], kwargs)
+
+    return CohortOutliers(frames, runs, group_labels, group_tf)
+
+
+def _detect_values(detector, values, kwargs):
+    # No outliers among no values (no runs, or all the runs failed)
+    if values.size == 0:
+        return np.zeros(0, dtype=bool)
+    return detector(values, **kwargs)
+
+
+def _run_metrics(fname, metric_names, dtype, cache, use_mask, decode_cache):
+    # Metric values and number of volumes of run `fname`, or its error
+    with profiling.record_run(fname) as record:
+        try:
+            run = data_load.RunData(fname, dtype=dtype, use_mask=use_mask,
+                                    decode_cache=decode_cache)
+            return (compute_metrics(run, metric_names, cache),
+                    run.n_timepoints, None)
+        except Exception as err:
+            if record is not None:
+                record['error'] = repr(err)
+            return None, None, err
+
+
+def collect_cohort(fnames, metric_names, n_jobs=1, dtype=None,
+                   cache=None, use_mask=True, decode_cache=None,
+                   return_errors=False):
+    """ Compute metrics on all runs and stack them per metric
+
+    A run that fails does not stop the others: its rows are NaN, and its
+    error is reported.
+
+    Parameters
+    ----------
+    fnames : sequence of str
+        Paths to the functional runs.
+    metric_names : sequence of str
+        Names of the metrics to compute.
+    n_jobs : int, optional
+        Number of worker processes, by default 1.
+    dtype, cache, use_mask, decode_cache
+        See `outfind.detect_outliers`.
+    return_errors : bool, optional
+        If True, also return the errors raised by the failing runs, by default
+        False.  Otherwise the failing runs are reported as warnings.
+
+    Returns
+    -------
+    stacked : dict
+        Dictionary with keys being metric names and values being NaN-padded
+        (n_runs x n_timepoints) arrays aligned to the volumes.
+    subjects : list of str
+        Subject label of each run.
+    error_dict : dict
+        Dictionary with keys being filenames of the failing runs and values
+        being the raised exceptions.  Only returned if `return_errors` is True.
+
+    Raises
+    ------
+    ValueError
+        A metric gives more than one value per frame (a 2D array).
+    """
+    args = (metric_names, dtype, cache, use_mask, decode_cache)
+    if n_jobs == 1:
+        results = [_run_metrics(fname, *args) for fname in fnames]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            results = list(executor.map(_run_metrics, fnames,
+                                        *[[arg] * len(fnames) for arg in args]))
+    error_dict = {fname: err for fname, (_, _, err) in zip(fnames, results)
+                  if err is not None}
+    n_timepoints = max((n for _, n, err in results if err is None),
+                       default=0)
+    stacked = {}
+    for metric_name in metric_names:
+        series = []
+        for values, _, err in results:
+            metric = np.zeros(0) if err is not None else values[metric_name]
+            if np.ndim(metric) != 1:
+                raise ValueError(
+                    f'Metric "{metric_name}" gives a {np.ndim(metric)}D '
+                    'array; cohort outlier detection needs one value per '
+                    'frame')
+            series.append(metric)
+        stacked[metric_name] = stack_series(
+            series, metrics.metric_offset(metric_name), n_timepoints)
+    subjects = [parse_bids_entities(fname)['sub'] for fname in fnames]
+    if return_errors:
+        return stacked, subjects, error_dict
+    for fname, err in error_dict.items():
+        warnings.warn(f'Metrics failed for "{fname}": {err!r}')
+    return stacked, subjects
+
+
+def find_cohort_outliers(data_directory, config=None, n_jobs=1,
+                         summary='median', index_path=None,
+                         return_errors=False, **kwargs):
+    """ Detect outlier frames, runs and subjects in `data_directory`
+
+    Parameters
+    ----------
+    data_directory : str
+        Directory containing images.
+    config : list, optional
+        List of the metric names and list of the matching detector names, by
+        default `outfind.CONFIG`.
+    n_jobs : int, optional
+        Number of worker processes, by default 1.
+    summary : str, optional
+        Run summary compared between runs, by default 'median'.
+    index_path : str, optional
+        Path of the dataset index file, by default in the user cache
+        directory (see `dataset_index.DatasetIndex`).
+    return_errors : bool, optional
+        If True, also return the errors raised by the failing runs, by default
+        False.  Otherwise the failing runs are reported as warnings.
+    **kwargs
+        Extra arguments passed to `collect_cohort`.
+
+    Returns
+    -------
+    fnames : list of str
+        Paths of the runs, in the order of the rows of the outlier arrays.
+    outliers : dict
+        Dictionary with keys being metric names and values being
+        `CohortOutliers`, grouped by subject.
+    error_dict : dict
+        Dictionary with keys being filenames of the failing runs and values
+        being the raised exceptions.  Only returned if `return_errors` is True.
+    """
+    if config is None:
+        config = CONFIG
+    fnames = DatasetIndex(data_directory, index_path=index_path).fnames()
+    stacked, subjects, error_dict = collect_cohort(
+        fnames, config[0], n_jobs, return_errors=True, **kwargs)
+    outliers = {metric_name: detect_cohort_outliers(stacked[metric_name],
+                                                    subjects, detector_name,
+                                                    summary)
+                for metric_name, detector_name in zip(*config)}
+    if return_errors:
+        return fnames, outliers, error_dict
+    for fname, err in error_dict.items():
+        warnings.warn(f'Metrics failed for "{fname}": {err!r}')
+    return fnames, outliers
@@ -1,6 +1,13 @@
 """
 This module defines functions to load data from files.
 
+Data type policy: the data is decoded in the smallest floating point type
+holding the stored values exactly, float32 for the usual int16 or float32
+BOLD files (see `native_float_dtype`), instead of the float64 of nibabel
+``get_fdata``.  The metrics accumulate their sums and means in float64
+(``ACCUM_DTYPE``), so their values match the float64 computation within
+float32 rounding.
+
 Test this module with:
 
     python3 findoutlie/tests/test_data_load.py
@@ -11,11 +18,32 @@ or better, in IPython::
 """
 
 import os.path as op
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
 import nibabel as nib
 
-def get_fname(sub_id, run_num, data_dir = "data/"):
+from findoutlie import profiling
+from findoutlie.dataset_index import DatasetIndex
+from findoutlie.registry import get_intermediate
+
+# Floating point type of the sums and means accumulated by the metrics
+ACCUM_DTYPE = np.float64
+
+# Indexes opened by `open_dataset_index`, by data directory and index path
+_INDEXES = {}
+
+def get_fname(sub_id, run_num, data_dir = "data/", index=None,
+              index_path=None, **filters):
     """Get the filename for a specified subject-run functional data.
 
+    By default, this is the path of the run in the course dataset
+    (``group-00``, task ``taskzero``).  With `index` or `index_path`, the run
+    is looked up in the index of the dataset (see
+    `dataset_index.DatasetIndex`), so any BIDS layout is found, whatever its
+    group directories and task names.
+
     Parameters
     ----------
     sub_id : int
@@ -24,32 +52,88 @@ def get_fname(sub_id, run_num, data_dir = "data/"):
         Run number to load.
     data_dir : str, optional
         Path to the "data" directory, by default "data/"
+    index : DatasetIndex, optional
+        Index of `data_dir` in which to look the run up, by default None.
+    index_path : str, optional
+        Path of the index file of `data_dir`, opened once per process (see
+        `dataset_index.default_index_path` for the default location), by
+        default None (no index, unless `index` is given).
+    **filters
+        Other BIDS entities selecting the run in the index, for instance
+        ``task='rest'``.
 
     Returns
     -------
     path_to_run
-        Path to the subject-run file containing the functional data.
+        Path to the subject-run file containing the functional data.  If no
+        run of the index matches, even after refreshing the index, the path
+        in the course dataset, which loading then reports as missing.
 
     Raises
     ------
     TypeError
         Type of "sub_id" or "run_num" was not recognized, expected "int".
+    ValueError
+        More than one run of the index match.
     """
 
     try:
-        filename = f"sub-{sub_id:02d}_task-taskzero_run-{run_num:02d}_bold.nii.gz"
-    except ValueError:
-        print('Fixing type for "sub_id" or/and "run_num"')
-        filename = f"sub-{int(sub_id):02d}_task-taskzero_run-{int(run_num):02d}_bold.nii.gz"
-    except:
-        raise TypeError('Unrecognized type for "sub_id" or/and "run_num", expected "int",',
-                        f'got {type(sub_id)}, {type(run_num)}')
+        sub_id, run_num = int(sub_id), int(run_num)
+    except (TypeError, ValueError):
+        raise TypeError('Unrecognized type for "sub_id" or/and "run_num", '
+                        f'expected "int", got {type(sub_id)}, '
+                        f'{type(run_num)}') from None
+
+    if index is None and index_path is not None and op.isdir(data_dir):
+        index = open_dataset_index(data_dir, index_path)
+    if index is not None:
+        fnames = index.fnames(sub=sub_id, run=run_num, **filters)
+        if not fnames:
+            # The run may be new since the index was opened
+            index.refresh()
+            fnames = index.fnames(sub=sub_id, run=run_num, **filters)
+        if len(fnames) > 1:
+            raise ValueError(
+                f'Expected one run for sub {sub_id} run {run_num} {filters}, '
+                f'found {len(fnames)}')
+        if fnames:
+            return fnames[0]
+
+    filename = f"sub-{sub_id:02d}_task-taskzero_run-{run_num:02d}_bold.nii.gz"
+    return op.join(data_dir, "group-00", f"sub-{sub_id:02d}", "func",
+                   filename)
+
+def open_dataset_index(data_dir="data/", index_path=None):
+    """Return the index of `data_dir`, opened once per process.
+
+    Later calls return the same `dataset_index.DatasetIndex`, without walking
+    the dataset again; `get_fname` refreshes it when a run is not found.
+
+    Parameters
+    ----------
+    data_dir : str, optional
+        Path to the "data" directory, by default "data/"
+    index_path : str, optional
+        Path of the index file, by default in the user cache directory.
 
-    path_to_run = op.join(data_dir, "group-00", f"sub-{sub_id:02d}", "func", filename)
+    Returns
+    -------
+    index : DatasetIndex
+    """
+    key = (op.abspath(data_dir), index_path)
+    if key not in _INDEXES:
+        _INDEXES[key] = DatasetIndex(data_dir, index_path=index_path)
+    return _INDEXES[key]
 
-    return path_to_run
+def _open_index(kwargs):
+    # Index of the dataset for the `get_fname` calls of the loading functions
+    data_dir = kwargs.get('data_dir', 'data/')
+    if kwargs.get('index') is None and op.isdir(data_dir):
+        kwargs['index'] = open_dataset_index(data_dir,
+                                             kwargs.get('index_path'))
+    return kwargs
 
-def load_sub_run(sub_id, run_num, **kwargs):
+def load_sub_run(sub_id, run_num, decode_cache=None, **kwargs):
     """Load functional images of a specified subject-run.
 
     Parameters
@@ -58,6 +142,12 @@ def load_sub_run(sub_id, run_num, **kwargs):
         Subject ID(s) to load data from.
     run_num : int or list
         Run number(s) to load.
+    decode_cache : DecodeCache, optional
+        Cache of the uncompressed runs, by default None (no cache).
+    **kwargs
+        Extra arguments passed to `get_fname`, such as ``data_dir`` or
+        ``task``.  The runs are looked up in the dataset index, opened once
+        per process (see `open_dataset_index`).
 
     Returns
     -------
@@ -77,15 +167,13 @@ def load_sub_run(sub_id, run_num, **kwargs):
         run_num = [run_num]
 
     images = []
+    kwargs = _open_index(kwargs)
 
     for sub in sub_id:
         for run in run_num:
             path_to_run = get_fname(sub, run, **kwargs)
 
-            if not op.isfile(path_to_run):
-                raise FileNotFoundError(f'File "{path_to_run}" does not exist')
-
-            images.append(nib.load(path_to_run))
+            images.append(load_image(path_to_run, decode_cache=decode_cache))
 
     # Returns only one image if a single subject-run was specified
     if len(sub_id) == len(run_num) == 1:
@@ -93,13 +181,91 @@ def load_sub_run(sub_id, run_num, **kwargs):
 
     return images
 
-def load_image(fname):
+def iter_sub_runs(sub_ids, run_nums, n_prefetch=2, dtype=None,
+                  decode_cache=None, **kwargs):
+    """Iterate over the data of several subject-runs, prefetching the next ones.
+
+    A pool of `n_prefetch` threads loads and decompresses the next runs while
+    the current one is processed, so the file reading overlaps with the
+    computation.  At most `n_prefetch` runs are loaded ahead.
+
+    Parameters
+    ----------
+    sub_ids : int or iterable of int
+        Subject ID(s) to load data from, for instance a list or a range.
+    run_nums : int or iterable of int
+        Run number(s) to load for each subject.
+    n_prefetch : int, optional
+        Number of runs loaded ahead, by default 2.
+    dtype : numpy dtype, optional
+        Floating point type of the decoded data, by default the native float
+        type of each run (see `native_float_dtype`).
+    decode_cache : DecodeCache, optional
+        Cache of the uncompressed runs, by default None (no cache).
+    **kwargs
+        Extra arguments passed to `get_fname`, such as ``data_dir`` or
+        ``task``.  The runs are looked up in the dataset index, opened once
+        per process (see `open_dataset_index`).
+
+    Yields
+    ------
+    sub_id : int
+        Subject ID
+    run_num : int
+        Run number
+    data : numpy array
+        4D data of the subject-run.
+
+    Raises
+    ------
+    FileNotFoundError
+        Functional file was not found in the specified directory.
+    """
+
+    if isinstance(sub_ids, int):
+        sub_ids = [sub_ids]
+    if isinstance(run_nums, int):
+        run_nums = [run_nums]
+    pairs = iter([(sub, run) for sub in sub_ids for run in run_nums])
+    kwargs = _open_index(kwargs)
+
+    def _load(sub, run):
+        img = load_image(get_fname(sub, run, **kwargs),
+                         decode_cache=decode_cache)
+        return img.get_fdata(dtype=float_dtype(img) if dtype is None
+                             else dtype)
+
+    with ThreadPoolExecutor(max_workers=n_prefetch) as executor:
+        pending = deque()
+
+        def _submit_next():
+            pair = next(pairs, None)
+            if pair is not None:
+                pending.append((*pair, executor.submit(_load, *pair)))
+
+        for _ in range(n_prefetch):
+            _submit_next()
+        while pending:
+            sub, run, future = pending.popleft()
+            data = future.result()
+            # Start loading the next run before handing this one over
+            _submit_next()
+            yield sub, run, data
+            # Drop our reference before waiting for the next run
+            del data
+
+def load_image(fname, decode_cache=None, **kwargs):
     """ Load the functional 4D image from a filepath
 
     Parameters
     ----------
     fname : str
         Path to the nifit file
+    decode_cache : DecodeCache, optional
+        Cache of the uncompressed runs, by default None (no cache).  With a
+        cache, the image is loaded memory-mapped from its uncompressed copy.
+    **kwargs
+        Extra arguments passed to ``nibabel.load``.
 
     Returns
     -------
@@ -115,6 +281,188 @@ def load_image(fname):
     if not op.isfile(fname):
         raise FileNotFoundError(f'File "{fname}" does not exist')
 
-    image = nib.load(fname)
+    if decode_cache is not None:
+        return decode_cache.load(fname, **kwargs)
+
+    image = nib.load(fname, **kwargs)
 
     return image
+
+
+def native_float_dtype(stored_dtype):
+    """ Return the floating point type to compute on data of `stored_dtype`
+
+    Parameters
+    ----------
+    stored_dtype : numpy dtype
+        Data type of the values, such as the on-disk type of an image.
+
+    Returns
+    -------
+    numpy dtype
+        float32 if it holds all the values of `stored_dtype` exactly (for
+        instance int16 or float32), float64 otherwise.
+    """
+    if np.can_cast(stored_dtype, np.float32, casting='safe'):
+        return np.dtype(np.float32)
+    return np.dtype(np.float64)
+
+
+def float_dtype(img):
+    """ Return the floating point type used to compute on `img`
+
+    Parameters
+    ----------
+    img : nibabel image, RunData or numpy array
+        Functional 4D image.
+
+    Returns
+    -------
+    numpy dtype
+        The decoding type of a RunData, the type of a floating point array,
+        and otherwise the native float type of the stored values (see
+        `native_float_dtype`).
+    """
+    if isinstance(img, RunData):
+        return img.dtype
+    if isinstance(img, np.ndarray):
+        if np.issubdtype(img.dtype, np.floating):
+            return img.dtype
+        return native_float_dtype(img.dtype)
+    return native_float_dtype(img.get_data_dtype())
+
+
+def get_data(img, dtype=None):
+    """ Return the data array of `img`, decoding it only if needed.
+
+    Parameters
+    ----------
+    img : nibabel image, RunData or numpy array
+        Functional 4D image, already loaded run or data array.
+    dtype : numpy dtype, optional
+        Floating point type used when decoding a nibabel image, by default
+        its native float type (see `float_dtype`).
+
+    Returns
+    -------
+    numpy array
+        4D data array.
+    """
+
+    if isinstance(img, RunData):
+        return img.data
+    if isinstance(img, np.ndarray):
+        return img
+
+    return img.get_fdata(dtype=float_dtype(img) if dtype is None else dtype)
+
+
+def volume_source(img):
+    """ Return an array-like giving the volumes of `img` with ``[..., i]``
+
+    For an image whose data is not loaded, this is the array proxy.  A
+    gzipped file is then kept open, so that reading consecutive volumes does
+    not restart the decompression from the start of the file for each volume.
+
+    Parameters
+    ----------
+    img : nibabel image, RunData or numpy array
+        Functional 4D image.
+
+    Returns
+    -------
+    array-like
+        Object with a ``shape`` and supporting ``[..., i]`` indexing.
+    """
+
+    if isinstance(img, np.ndarray):
+        return img
+    dataobj = img.dataobj
+    if isinstance(img, RunData):
+        return dataobj
+    fname = img.get_filename()
+    if nib.is_proxy(dataobj) and fname is not None and fname.endswith('.gz'):
+        return nib.load(fname, keep_file_open=True).dataobj
+    return dataobj
+
+
+class RunData:
+    """ Functional run loaded once and shared between all the metrics.
+
+    The data array is decoded the first time it is requested, in the dtype
+    given at creation, and then kept for all the following metrics.  Until
+    then, streaming metrics can read volumes one at a time from `dataobj`;
+    the file is kept open so that reading consecutive volumes of a gzipped
+    image does not restart the decompression for each volume.
+
+    Parameters
+    ----------
+    fname : str
+        Path to the nifti file
+    dtype : numpy dtype, optional
+        Floating point type of the decoded data, by default the native float
+        type of the file (see `native_float_dtype`).
+    use_mask : bool, optional
+        If True, the metrics supporting it only use the voxels of the brain
+        mask (see `masking.compute_brain_mask`), by default False.
+    decode_cache : DecodeCache, optional
+        Cache of the uncompressed runs, by default None (no cache).
+    """
+
+    def __init__(self, fname, dtype=None, use_mask=False,
+                 decode_cache=None):
+        self.fname = fname
+        self.use_mask = use_mask
+        with profiling.stage('load_image'):
+            self.img = load_image(fname, decode_cache=decode_cache,
+                                  keep_file_open=True)
+        self.dtype = (native_float_dtype(self.img.get_data_dtype())
+                      if dtype is None else np.dtype(dtype))
+        self._data = None
+        self._intermediates = {}
+
+    @property
+    def shape(self):
+        return self.img.shape
+
+    @property
+    def n_timepoints(self):
+        return self.img.shape[-1]
+
+    @property
+    def dataobj(self):
+        """ Decoded data if available, otherwise the image array proxy
+        """
+        if self._data is None:
+            return self.img.dataobj
+        return self._data
+
+    @property
+    def data(self):
+        if self._data is None:
+            with profiling.stage('decode'):
+                self._data = self.img.get_fdata(dtype=self.dtype)
+        return self._data
+
+    def get_fdata(self, dtype=None):
+        """ Return the decoded data, mimicking the nibabel image method
+        """
+        if dtype is None or np.dtype(dtype) == self.dtype:
+            return self.data
+        return self.data.astype(dtype)
+
+    def intermediate(self, name):
+        """ Return intermediate `name` (for instance the mean map), computing
+        it on first use
+        """
+        if name not in self._intermediates:
+            with profiling.stage('intermediate', name):
+                self._intermediates[name] = get_intermediate(name)(self)
+        return self._intermediates[name]
+
+    def release(self, keep=()):
+        """ Free the intermediates, except the ones named in `keep`
+        """
+        for name in list(self._intermediates):
+            if name not in keep:
+                del self._intermediates[name]
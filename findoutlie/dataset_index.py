@@ -0,0 +1,228 @@
+""" Index of the functional runs of a BIDS dataset
+
+The index scans the dataset tree once, and records for each run its BIDS
+entities (sub, ses, task, run, suffix) and header metadata (shape, dtype, TR).
+The table is saved as a JSON file in the user cache directory (see
+`default_index_path`), so that datasets on read-only or shared file systems
+are indexed too, and the dataset tree is not written to.  Refreshing the
+index only lists the directories whose modification time changed, and only
+reads the headers of new or modified files.
+"""
+
+import hashlib
+import json
+import os
+import os.path as op
+import re
+
+import nibabel as nib
+
+# Directory of the index files, in the user cache directory
+INDEX_DIR = op.join('findoutlie', 'index')
+
+BIDS_ENTITIES = ('sub', 'ses', 'task', 'run')
+
+_ENTITY_RE = re.compile(r'(?P<key>[a-zA-Z]+)-(?P<value>[a-zA-Z0-9]+)')
+
+
+def parse_bids_entities(fname):
+    """ Return the BIDS entities of filename `fname`
+
+    Parameters
+    ----------
+    fname : str
+        Filename or path, such as
+        ``sub-01_task-taskzero_run-01_bold.nii.gz``.
+
+    Returns
+    -------
+    entities : dict
+        Dictionary with keys "sub", "ses", "task", "run" (None if absent) and
+        "suffix" (such as "bold").
+    """
+    name = op.basename(fname).split('.')[0]
+    parts = name.split('_')
+    entities = dict.fromkeys(BIDS_ENTITIES)
+    entities['suffix'] = None
+    for part in parts:
+        match = _ENTITY_RE.fullmatch(part)
+        if match is None:
+            entities['suffix'] = part
+        elif match['key'] in entities:
+            entities[match['key']] = match['value']
+    return entities
+
+
+def default_index_path(data_directory):
+    """ Return the default path of the index file of `data_directory`
+
+    The index files are in ``findoutlie/index`` of the user cache directory
+    (``$XDG_CACHE_HOME``, by default ``~/.cache``), named from the hash of the
+    absolute path of the dataset.
+    """
+    cache_root = (os.environ.get('XDG_CACHE_HOME')
+                  or op.join(op.expanduser('~'), '.cache'))
+    name = hashlib.sha1(op.abspath(data_directory).encode()).hexdigest()
+    return op.join(cache_root, INDEX_DIR, name + '.json')
+
+
+def _header_entry(path, stat):
+    entry = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+             'shape': None, 'dtype': None, 'tr': None}
+    try:
+        header = nib.load(path).header
+    except Exception:
+        # Unreadable image; keep it in the index so that its processing
+        # reports the error
+        return entry
+    zooms = header.get_zooms()
+    entry.update(shape=[int(n) for n in header.get_data_shape()],
+                 dtype=header.get_data_dtype().name,
+                 tr=float(zooms[3]) if len(zooms) > 3 else None)
+    return entry
+
+
+def _matches(value, wanted):
+    if value is None:
+        return wanted is None
+    if isinstance(wanted, int) and value.isdigit():
+        return int(value) == wanted
+    return value == str(wanted)
+
+
+class DatasetIndex:
+    """ Persisted index of the runs in a dataset directory
+
+    Parameters
+    ----------
+    data_directory : str
+        Root directory of the dataset.
+    index_path : str, optional
+        Path of the JSON index file, by default in the user cache directory
+        (see `default_index_path`).  The index is not saved if this file
+        cannot be written.
+    extensions : tuple of str, optional
+        Extensions of the indexed images, by default ('.nii.gz',).
+    refresh : bool, optional
+        If True (default), bring the index up to date with the directory
+        tree on creation.
+    """
+
+    def __init__(self, data_directory, index_path=None,
+                 extensions=('.nii.gz',), refresh=True):
+        self.data_directory = data_directory
+        if index_path is None:
+            index_path = default_index_path(data_directory)
+        self.index_path = index_path
+        self.extensions = tuple(extensions)
+        try:
+            with open(index_path) as fobj:
+                table = json.load(fobj)
+        except (FileNotFoundError, ValueError):
+            table = {}
+        self._dirs = table.get('dirs', {})
+        self._runs = table.get('runs', {})
+        if refresh:
+            self.refresh()
+
+    def _is_run(self, name):
+        return name.startswith('sub-') and name.endswith(self.extensions)
+
+    def refresh(self):
+        """ Update the index with the changes in the directory tree
+        """
+        dirs = {}
+        runs = {}
+        to_visit = ['']
+        while to_visit:
+            rel_dir = to_visit.pop()
+            abs_dir = op.join(self.data_directory, rel_dir)
+            mtime_ns = os.stat(abs_dir).st_mtime_ns
+            listing = self._dirs.get(rel_dir)
+            if listing is None or listing['mtime_ns'] != mtime_ns:
+                # Directory contents changed, list it again
+                listing = {'mtime_ns': mtime_ns, 'subdirs': [], 'files': []}
+                for entry in os.scandir(abs_dir):
+                    if entry.is_dir():
+                        listing['subdirs'].append(entry.name)
+                    elif self._is_run(entry.name):
+                        listing['files'].append(entry.name)
+            dirs[rel_dir] = listing
+            to_visit.extend(op.join(rel_dir, name)
+                            for name in listing['subdirs'])
+            for name in listing['files']:
+                rel_path = op.join(rel_dir, name)
+                try:
+                    stat = os.stat(op.join(self.data_directory, rel_path))
+                except FileNotFoundError:
+                    continue
+                entry = self._runs.get(rel_path)
+                if (entry is None or entry['size'] != stat.st_size
+                        or entry['mtime_ns'] != stat.st_mtime_ns):
+                    entry = _header_entry(
+                        op.join(self.data_directory, rel_path), stat)
+                    entry.update(parse_bids_entities(name))
+                runs[rel_path] = entry
+        self._dirs = dirs
+        self._runs = runs
+        self.save()
+
+    def save(self):
+        """ Save the index, if its file can be written
+        """
+        tmp_path = f'{self.index_path}.{os.getpid()}.tmp'
+        try:
+            os.makedirs(op.dirname(op.abspath(self.index_path)),
+                        exist_ok=True)
+            with open(tmp_path, 'w') as fobj:
+                json.dump({'dirs': self._dirs, 'runs': self._runs}, fobj)
+            os.replace(tmp_path, self.index_path)
+        except OSError:
+            # Index file not writable; the index only lives in memory
+            pass
+
+    def runs(self, **filters):
+        """ Return the runs matching the BIDS entity `filters`
+
+        Parameters
+        ----------
+        **filters
+            Values of the entities, for instance ``sub=1, task='taskzero'``.
+
+        Returns
+        -------
+        runs : list of dict
+            Index entries, sorted by path, with the extra key "path" giving the
+            path of the run file.
+        """
+        selected = []
+        for rel_path in sorted(self._runs):
+            entry = self._runs[rel_path]
+            if all(_matches(entry.get(key), value)
+                   for key, value in filters.items()):
+                selected.append(dict(entry, path=op.join(self.data_directory,
+                                                         rel_path)))
+        return selected
+
+    def fnames(self, **filters):
+        """ Return the sorted paths of the runs matching `filters`
+        """
+        return [entry['path'] for entry in self.runs(**filters)]
+
+    def get_fname(self, sub_id, run_num, **filters):
+        """ Return the path of the run of subject `sub_id` number `run_num`
+
+        Raises
+        ------
+        FileNotFoundError
+            No run match.
+        ValueError
+            More than one run match.
+        """
+        fnames = self.fnames(sub=sub_id, run=run_num, **filters)
+        if len(fnames) != 1:
+            error = FileNotFoundError if not fnames else ValueError
+            raise error(
+                f'Expected one run for sub {sub_id} run {run_num} '
+                f'{filters}, found {len(fnames)}')
+        return fnames[0]
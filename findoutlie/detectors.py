@@ -10,19 +10,29 @@ other on normally distributed values etc.  The routines should check that their
 requirements are met and raise an error otherwise.
 """
 
+import warnings
+
 import numpy as np
 
-def compute_outliers(metric_values, n_timepoints, detector_name = 'iqr_detector', **kwargs):
+from findoutlie.registry import get_detector, register_detector
+
+def compute_outliers(metric_values, n_timepoints, detector_name = 'iqr_detector', offset = None, **kwargs):
     """ Compute the outlier mask timeframe of a metric array for a specified detector.
 
     Parameters
     ----------
     metric_values : numpy array
-        Metric value at each timepoint
+        Metric value at each timepoint.  For a 2D metric (such as the dvars of
+        each slice), the detector is applied to each row, and a frame is an
+        outlier if it is an outlier in any row.
     n_timepoints : int
         Number of timepoints in the functional data
     detector_name : str
         Name of the detector to use in the outlier detection
+    offset : int, optional
+        Index of the volume corresponding to the first metric value (for
+        instance 1 for dvars).  By default, the metric values are aligned with
+        the last volumes.
 
     Returns
     -------
@@ -30,14 +40,54 @@ def compute_outliers(metric_values, n_timepoints, detector_name = 'iqr_detector'
         Outlier mask timeframe with 1 if the frame is considered as an outlier and 0 otherwise.
     """
 
-    detector_func = globals()[detector_name]
-    outlier_tf = detector_func(metric_values, **kwargs)
+    detector_func = get_detector(detector_name)
+    metric_tf = detector_func(metric_values, **kwargs)
+    if np.ndim(metric_tf) == 2:
+        metric_tf = np.any(metric_tf, axis=0)
 
-    while len(outlier_tf) < n_timepoints:
-        outlier_tf = np.insert(outlier_tf, 0, 0)
+    if offset is None:
+        offset = n_timepoints - len(metric_tf)
+    outlier_tf = np.zeros(n_timepoints, dtype=bool)
+    outlier_tf[offset:offset + len(metric_tf)] = metric_tf
 
     return outlier_tf
 
+def compute_outliers_batch(metrics_values, n_timepoints, detector_name = 'iqr_detector', offsets = 0, **kwargs):
+    """ Compute the outlier mask timeframes of several metrics in one call.
+
+    The detector is applied to all the rows of `metrics_values` at once.
+
+    Parameters
+    ----------
+    metrics_values : numpy array (n_metrics x n_values)
+        Metric values, one metric per row
+    n_timepoints : int
+        Number of timepoints in the functional data
+    detector_name : str
+        Name of the detector to use in the outlier detection
+    offsets : int or sequence of int, optional
+        Index of the volume corresponding to the first value of each row, by
+        default 0.
+
+    Returns
+    -------
+    numpy array (n_metrics x n_timepoints)
+        Outlier mask timeframes with 1 if the frame is considered as an outlier and 0 otherwise.
+    """
+
+    metrics_values = np.atleast_2d(metrics_values)
+    n_metrics, n_values = metrics_values.shape
+
+    detector_func = get_detector(detector_name)
+    metric_tfs = detector_func(metrics_values, **kwargs)
+
+    offsets = np.broadcast_to(offsets, (n_metrics,))
+    outlier_tfs = np.zeros((n_metrics, n_timepoints), dtype=bool)
+    columns = offsets[:, None] + np.arange(n_values)
+    outlier_tfs[np.arange(n_metrics)[:, None], columns] = metric_tfs
+
+    return outlier_tfs
+
 def consensus_outliers(outlier_tfs, decision = 'all'):
     """ Decide if a frame is to be considered as outlier or not based on the outcome of all metrics.
 
@@ -64,6 +114,56 @@ def consensus_outliers(outlier_tfs, decision = 'all'):
 
     return outlier_decision_tf
 
+def _order_stats(values, quantiles):
+    """ Quantiles of `values` along the last axis from a single partition.
+
+    Uses the same linear interpolation as ``np.percentile``.
+    """
+    n = values.shape[-1]
+    positions = np.asarray(quantiles) * (n - 1)
+    lows = np.floor(positions).astype(int)
+    highs = np.minimum(lows + 1, n - 1)
+    partitioned = np.partition(values, np.unique(np.r_[lows, highs]), axis=-1)
+    fractions = positions - lows
+    return [partitioned[..., [low]] + fraction * (partitioned[..., [high]] - partitioned[..., [low]])
+            for low, high, fraction in zip(lows, highs, fractions)]
+
+def robust_stats(measures, with_mad=True):
+    """ Compute Q1, median, Q3 and MAD of `measures` together.
+
+    The three quartiles come from a single partition of the values, and the MAD
+    from a single partition of the absolute deviations.
+
+    Parameters
+    ----------
+    measures : 1D or 2D array
+        Values, one series per row for a 2D array.
+    with_mad : bool, optional
+        If False, the MAD is not computed (returned as None).  Default is True.
+
+    Returns
+    -------
+    q1, median, q3, mad : arrays
+        Statistics of each row, with the last axis kept (of length 1) so that
+        they broadcast against `measures`.  `mad` is the (unscaled) median of
+        the absolute deviations from the median.
+    """
+    measures = np.asarray(measures, dtype=float)
+    q1, median, q3 = _order_stats(measures, [0.25, 0.5, 0.75])
+    mad = None
+    if with_mad:
+        mad, = _order_stats(np.abs(measures - median), [0.5])
+    return q1, median, q3, mad
+
+def _threshold_mask(measures, lower, upper, pos_only, neg_only):
+    outlier_tf = np.zeros(np.shape(measures), dtype=bool)
+    if not neg_only:
+        outlier_tf |= measures > upper
+    if not pos_only:
+        outlier_tf |= measures < lower
+    return outlier_tf
+
+@register_detector()
 def iqr_detector(measures, iqr_proportion=1.5, pos_only = True, neg_only = False):
     """Detect outliers in `measures` using interquartile range.
 
@@ -83,8 +183,9 @@ def iqr_detector(measures, iqr_proportion=1.5, pos_only = True, neg_only = False
 
     Parameters
     ----------
-    measures : 1D array
-        Values for which we will detect outliers
+    measures : 1D or 2D array
+        Values for which we will detect outliers.  For a 2D array, each row is
+        processed independently.
     iqr_proportion : float, optional
         Scalar to multiply the IQR to form upper and lower threshold (see
         above).  Default is 2.
@@ -99,14 +200,14 @@ def iqr_detector(measures, iqr_proportion=1.5, pos_only = True, neg_only = False
         A boolean vector of same length as `measures`, where True means the
         corresponding value in `measures` is an outlier.
     """
-    Q1 = np.percentile(measures, 25)
-    Q3 = np.percentile(measures, 75)
+    Q1, _, Q3, _ = robust_stats(measures, with_mad=False)
     IQR = Q3 - Q1
-    outlier_tf = np.logical_or((not neg_only)*( measures > Q3 + iqr_proportion * IQR),
-                                (not pos_only)*(measures < Q1 - iqr_proportion * IQR))
+    outlier_tf = _threshold_mask(measures, Q1 - iqr_proportion * IQR,
+                                 Q3 + iqr_proportion * IQR, pos_only, neg_only)
 
     return outlier_tf
 
+@register_detector()
 def median_detector(measures, scale = 5, pos_only = True, neg_only = False):
     """Detect outliers in `measures` from the scaled Means Absolute Deviation.
     
@@ -124,8 +225,9 @@ def median_detector(measures, scale = 5, pos_only = True, neg_only = False):
 
     Parameters
     ----------
-    metric : numpy array
-        Metric to detect outlier on
+    measures : numpy array
+        Metric to detect outlier on.  For a 2D array, each row is processed
+        independently.
     scale : int, float, optional
         Scalar to multiply the scaled MAD to form upper and lower threshold (see
         above).  Default is 4.
@@ -143,10 +245,220 @@ def median_detector(measures, scale = 5, pos_only = True, neg_only = False):
     ERFCINV_CST = -0.4769362762044699
 
     c = -1/(np.sqrt(2)*ERFCINV_CST)
-    # MAD is the Mean Absolute Deviation
-    scaled_mad = c * np.median(np.abs(measures - np.median(measures)))
+    # MAD is the Median Absolute Deviation
+    _, median, _, mad = robust_stats(measures)
+    scaled_mad = c * mad
+
+    outlier_tf = _threshold_mask(measures, median - scale * scaled_mad,
+                                 median + scale * scaled_mad, pos_only, neg_only)
+
+    return outlier_tf
+
+@register_detector()
+def pvalue_detector(p_values, alpha=0.05, correction='bonferroni'):
+    """Detect outliers from the p-values of a test per frame.
+
+    For metrics giving the p-value of each frame under a null hypothesis of no
+    artifact, such as "dvars_pvalue".  An outlier is any frame with a p-value
+    below `alpha`, corrected for the number of frames tested.
+
+    Parameters
+    ----------
+    p_values : 1D or 2D array
+        P-values of each frame.  For a 2D array, each row is processed
+        independently.  NaN values are not tested.
+    alpha : float, optional
+        Family-wise error rate, by default 0.05.
+    correction : str or None, optional
+        'bonferroni' (default) divides `alpha` by the number of tested frames,
+        None does not correct.
 
-    outlier_tf = np.logical_or((not neg_only)*(measures > np.median(measures) + scale * scaled_mad),
-                                (not pos_only)*(measures < np.median(measures) - scale * scaled_mad))
+    Returns
+    -------
+    numpy array (bool)
+        Outlier mask timeframe with a 1 if a frame is labeled as an outlier and 0 otherwise.
+    """
+    p_values = np.asarray(p_values, dtype=float)
+    if correction == 'bonferroni':
+        n_tests = np.sum(~np.isnan(p_values), axis=-1, keepdims=True)
+        alpha = alpha / np.maximum(n_tests, 1)
+    elif correction is not None:
+        raise ValueError(f'Unknown correction "{correction}"')
+    return p_values < alpha
+
+def rolling_robust_stats(measures, window=31):
+    """ Compute Q1, median, Q3 and MAD of `measures` in sliding windows.
+
+    The window of each value is the `window` values centred on it, shifted to
+    stay inside the series at its ends.  The values of the window are kept
+    sorted from one position to the next: the value leaving the window is
+    removed and the entering value inserted at their sorted positions, instead
+    of sorting each window again.  The updates are vectorized across the
+    series of a 2D array.
+
+    Each update shifts the whole sorted window, and the MAD needs the median
+    of the deviations of the window, which change with its median, so the
+    cost is O(n * w) for n values and a window of w values, not the
+    O(n log w) of sorted containers or of two heaps.  That costs less than
+    sorting each window (O(n * w log w)), and keeps the updates as numpy
+    operations on whole windows, which beats per-value Python updates for
+    the default window (31) and for the lengths of fMRI runs.
+
+    NaN values are ignored: the statistics of a window are those of its other
+    values (NaN if all its values are NaN).  The series containing NaN are
+    processed window by window, with ``np.nanpercentile``.
+
+    Parameters
+    ----------
+    measures : 1D or 2D array
+        Values, one series per row for a 2D array.
+    window : int, optional
+        Number of values in each window, by default 31.  A window longer than
+        the series covers the whole series.
+
+    Returns
+    -------
+    q1, median, q3, mad : arrays
+        Statistics of the window of each value, of the same shape as
+        `measures`.  `mad` is the (unscaled) median of the absolute
+        deviations from the median of the window.
+    """
+    measures = np.asarray(measures, dtype=float)
+    series = np.atleast_2d(measures)
+    n_values = series.shape[1]
+    window = max(min(window, n_values), 1)
+    # A NaN cannot be found again in a sorted window to be removed, so the
+    # series with NaN take the per-window route
+    nan_rows = np.any(np.isnan(series), axis=1)
+    stats = np.zeros((4,) + series.shape)
+    stats[:, ~nan_rows] = _sorted_window_stats(series[~nan_rows], window)
+    if np.any(nan_rows):
+        stats[:, nan_rows] = _nan_window_stats(series[nan_rows], window)
+    return tuple(stat.reshape(measures.shape) for stat in stats)
+
+
+def _nan_window_stats(series, window):
+    # Statistics of each window, ignoring the NaN, as rolling_robust_stats
+    n_values = series.shape[1]
+    starts = np.clip(np.arange(n_values) - window // 2, 0, n_values - window)
+    windows = np.lib.stride_tricks.sliding_window_view(
+        series, window, axis=1)[:, starts]
+    with warnings.catch_warnings():
+        # Windows with NaN only give NaN
+        warnings.simplefilter('ignore', RuntimeWarning)
+        q1, median, q3 = np.nanpercentile(windows, [25, 50, 75], axis=-1)
+        mad = np.nanmedian(np.abs(windows - median[..., None]), axis=-1)
+    return np.array([q1, median, q3, mad])
+
+
+def _sorted_window_stats(series, window):
+    # Statistics of each window, from the sorted window updated at each step
+    n_series, n_values = series.shape
+    half = window // 2
+    # Interpolation of the quartiles in a sorted window, as np.percentile
+    positions = np.array([0.25, 0.5, 0.75]) * (window - 1)
+    lows = np.floor(positions).astype(int)
+    highs = np.minimum(lows + 1, window - 1)
+    fractions = positions - lows
+    stats = np.zeros((4, n_series, n_values))
+    columns = np.arange(window)
+    sorted_win = np.sort(series[:, :window], axis=1)
+    last_start = n_values - window
+    for start in range(last_start + 1):
+        if start > 0:
+            old = series[:, start - 1, None]
+            new = series[:, start + window - 1, None]
+            # Remove one copy of the leaving value, shifting the larger ones
+            i_old = np.sum(sorted_win < old, axis=1, keepdims=True)
+            removed = np.where(columns < i_old, sorted_win,
+                               np.roll(sorted_win, -1, axis=1))
+            # Insert the entering value among the window - 1 remaining ones
+            i_new = np.sum(removed[:, :-1] < new, axis=1, keepdims=True)
+            sorted_win = np.where(columns < i_new, removed,
+                                  np.where(columns == i_new, new,
+                                           np.roll(removed, 1, axis=1)))
+        q1, median, q3 = (sorted_win[:, low] + fraction
+                          * (sorted_win[:, high] - sorted_win[:, low])
+                          for low, high, fraction
+                          in zip(lows, highs, fractions))
+        mad = np.median(np.abs(sorted_win - median[:, None]), axis=1)
+        # Values whose window starts here
+        first = 0 if start == 0 else start + half
+        stop = n_values if start == last_start else start + half + 1
+        stats[:, :, first:stop] = np.array([q1, median, q3, mad])[..., None]
+    return stats
+
+
+@register_detector()
+def rolling_iqr_detector(measures, window=31, iqr_proportion=1.5,
+                         pos_only=True, neg_only=False):
+    """Detect outliers in `measures` using the interquartile range of a
+    sliding window.
+
+    As `iqr_detector`, but the quartiles are those of the `window` values
+    around each value (see `rolling_robust_stats`), so that a slow drift of
+    the metric does not hide spikes or flag whole segments.
+
+    Parameters
+    ----------
+    measures : 1D or 2D array
+        Values for which we will detect outliers.  For a 2D array, each row is
+        processed independently.
+    window : int, optional
+        Number of values in each window, by default 31.
+    iqr_proportion : float, optional
+        Scalar to multiply the IQR to form upper and lower threshold.  Default
+        is 1.5.
+    pos_only : bool, optional
+        Condition to filter only values above the upper threshold.  Default is True.
+    neg_only : bool, optional
+        Condition to filter only values below the lower threshold.  Default is False.
+
+    Returns
+    -------
+    numpy array (bool)
+        Outlier mask of the same shape as `measures`.
+    """
+    measures = np.asarray(measures, dtype=float)
+    q1, _, q3, _ = rolling_robust_stats(measures, window)
+    iqr = q3 - q1
+    return _threshold_mask(measures, q1 - iqr_proportion * iqr,
+                           q3 + iqr_proportion * iqr, pos_only, neg_only)
+
+@register_detector()
+def rolling_median_detector(measures, window=31, scale=5, pos_only=True,
+                            neg_only=False):
+    """Detect outliers in `measures` from the scaled MAD of a sliding window.
+
+    As `median_detector`, but the median and MAD are those of the `window`
+    values around each value (see `rolling_robust_stats`).
+
+    Parameters
+    ----------
+    measures : 1D or 2D array
+        Metric to detect outlier on.  For a 2D array, each row is processed
+        independently.
+    window : int, optional
+        Number of values in each window, by default 31.
+    scale : int, float, optional
+        Scalar to multiply the scaled MAD to form upper and lower threshold.
+        Default is 5.
+    pos_only : bool, optional
+        Condition to filter only values above the upper threshold.  Default is True.
+    neg_only : bool, optional
+        Condition to filter only values below the lower threshold.  Default is False.
+
+    Returns
+    -------
+    numpy array (bool)
+        Outlier mask of the same shape as `measures`.
+    """
+    # Corresponding to erfcinv(3/2), see `median_detector`
+    ERFCINV_CST = -0.4769362762044699
 
-    return outlier_tf
\ No newline at end of file
+    c = -1/(np.sqrt(2)*ERFCINV_CST)
+    measures = np.asarray(measures, dtype=float)
+    _, median, _, mad = rolling_robust_stats(measures, window)
+    scaled_mad = c * mad
+    return _threshold_mask(measures, median - scale * scaled_mad,
+                           median + scale * scaled_mad, pos_only, neg_only)
@@ -0,0 +1,148 @@
+""" DVARS and its standardized and spatial variants from one difference pass
+
+The fused pass of `stats.run_stats`, which also gives the global DVARS and the
+coefficient of variation, reads each volume once, takes its difference with
+the previous volume, and accumulates:
+
+* the squared differences summed over each slice, giving raw DVARS and the
+  (n_slices x n - 1) per-slice DVARS matrix;
+* the per-voxel temporal moments (Welford algorithm), giving the average
+  voxel variance that the DVARS decomposition is expressed against.
+
+From these, `compute_dvars` derives without going back to the data:
+
+* standardized DVARS: DVARS divided by its expected value without artifact,
+  estimated robustly as the square root of the median of DVARS^2;
+* the DVARS inference of Afyouni & Nichols (2018): each DVARS^2 value is
+  compared to a scaled chi-square null distribution, matching the robust mean
+  (median) and standard deviation (lower half IQR) of DVARS^2, giving a
+  p-value per volume pair;
+* the D-var decomposition of the same paper: %D-var is the mean squared half
+  difference D as a percentage of the average voxel variance A, and Δ%D-var
+  its excess over the median, the practical significance of a spike.
+
+Only volume-sized accumulators and the per-pair summaries are kept in memory,
+and a run read for any of the DVARS variants is not read again for the
+others, nor for the metrics using `stats.run_stats`.
+
+See: Afyouni S. & Nichols T.E. (2018) Insight and inference for DVARS.
+NeuroImage 172, 291-312.
+"""
+
+from collections import namedtuple
+
+import numpy as np
+from scipy.special import chdtrc
+
+from findoutlie.stats import run_stats
+
+DVARSStats = namedtuple('DVARSStats', ['dvars', 'std_dvars', 'p_values',
+                                       'pct_dvar', 'delta_pct_dvar',
+                                       'slice_dvars', 'null_mean', 'null_sd',
+                                       'mean_var'])
+
+# Half IQR of the standard normal, scaling the lower half IQR to a SD
+HALF_IQR_NORMAL = 0.6744897501960817
+
+
+def dvars_null(dvars_sq):
+    """ Robust mean and standard deviation of DVARS^2 without artifact
+
+    Parameters
+    ----------
+    dvars_sq : 1D array
+        Squared DVARS values.
+
+    Returns
+    -------
+    null_mean : float
+        Median of `dvars_sq`.
+    null_sd : float
+        Standard deviation estimated from the lower half IQR, which spikes do
+        not inflate.
+    """
+    q1, median = np.percentile(dvars_sq, [25, 50])
+    return median, (median - q1) / HALF_IQR_NORMAL
+
+
+def dvars_p_values(dvars_sq, null_mean, null_sd):
+    """ P-values of DVARS^2 values under a scaled chi-square null
+
+    The null distribution is ``null_mean / nu * chi2(nu)`` with
+    ``nu = 2 * null_mean ** 2 / null_sd ** 2`` degrees of freedom, having
+    mean `null_mean` and standard deviation `null_sd`.
+
+    Parameters
+    ----------
+    dvars_sq : array
+        Squared DVARS values.
+    null_mean, null_sd : float
+        Mean and standard deviation of the null distribution (see
+        `dvars_null`).
+
+    Returns
+    -------
+    p_values : array
+        Probability of a value at least as large under the null.
+    """
+    dvars_sq = np.asarray(dvars_sq, dtype=float)
+    if not null_sd > 0 or not null_mean > 0:
+        return np.where(dvars_sq > null_mean, 0., 1.)
+    nu = 2 * null_mean ** 2 / null_sd ** 2
+    return chdtrc(nu, nu * dvars_sq / null_mean)
+
+
+def compute_dvars(img, mask=None, slice_axis=2, stats=None):
+    """ Compute DVARS and its variants from the fused pass of `stats.run_stats`
+
+    Parameters
+    ----------
+    img : nibabel image, RunData or numpy array
+        Functional 4D image.  Volumes are read one at a time through
+        ``img.dataobj`` when available.
+    mask : BrainMask, optional
+        If given, only the brain voxels are used.
+    slice_axis : int, optional
+        Axis of the slices in the volumes, by default 2.
+    stats : RunStats, optional
+        Output of ``stats.run_stats(img, mask, slice_axis)``.  If given, the
+        volumes are not read again.
+
+    Returns
+    -------
+    stats : DVARSStats
+        Named tuple with fields:
+
+        * dvars : 1D array (n - 1), raw DVARS between consecutive volumes;
+        * std_dvars : 1D array (n - 1), DVARS divided by its robust expected
+          value, close to 1 without artifact;
+        * p_values : 1D array (n - 1), p-values of DVARS^2 under the null
+          (see `dvars_p_values`);
+        * pct_dvar : 1D array (n - 1), D-var (mean of the squared half
+          differences) as a percentage of the average voxel variance;
+        * delta_pct_dvar : 1D array (n - 1), excess of `pct_dvar` over its
+          median;
+        * slice_dvars : 2D array (n_slices x n - 1), DVARS computed on each
+          slice, NaN for the slices without voxels;
+        * null_mean, null_sd : robust mean and standard deviation of DVARS^2
+          (see `dvars_null`);
+        * mean_var : average over the voxels of the temporal variance.
+    """
+    if stats is None:
+        stats = run_stats(img, mask, slice_axis)
+    dvars = stats.dvars
+    dvars_sq = dvars ** 2
+    mean_var = stats.mean_var
+    null_mean, null_sd = dvars_null(dvars_sq)
+    std_dvars = (dvars / np.sqrt(null_mean) if null_mean > 0
+                 else np.full_like(dvars, np.nan))
+    # D-var is the mean squared half difference, so DVARS^2 / 4
+    if mean_var > 0:
+        pct_dvar = 100 * dvars_sq / 4 / mean_var
+    else:
+        pct_dvar = np.full_like(dvars, np.nan)
+    delta_pct_dvar = pct_dvar - np.median(pct_dvar)
+    return DVARSStats(dvars, std_dvars,
+                      dvars_p_values(dvars_sq, null_mean, null_sd),
+                      pct_dvar, delta_pct_dvar, stats.slice_dvars, null_mean,
+                      null_sd, mean_var)
@@ -0,0 +1,106 @@
+""" Brain mask computed once per run and reused by the metrics
+
+The mask is stored as the flat indices of the brain voxels, so that the metrics
+can work on a compact (n_brain_voxels x n_timepoints) matrix instead of the
+full 4D array.  It can also be stored bit-packed, taking one bit per voxel.
+"""
+
+import numpy as np
+
+from findoutlie.data_load import float_dtype, volume_source
+
+
+class BrainMask:
+    """ Brain mask stored as flat voxel indices
+
+    Parameters
+    ----------
+    mask : 3D array
+        Boolean array, True for brain voxels.
+    """
+
+    def __init__(self, mask):
+        mask = np.asarray(mask, dtype=bool)
+        self.shape = mask.shape
+        index_dtype = np.int32 if mask.size < 2 ** 31 else np.int64
+        self.indices = np.flatnonzero(mask).astype(index_dtype)
+
+    @property
+    def n_voxels(self):
+        """ Number of brain voxels
+        """
+        return len(self.indices)
+
+    def to_bool(self):
+        """ Return the mask as a 3D boolean array
+        """
+        mask = np.zeros(self.shape, dtype=bool)
+        mask.flat[self.indices] = True
+        return mask
+
+    def packbits(self):
+        """ Return the mask bit-packed, one bit per voxel
+        """
+        return np.packbits(self.to_bool().ravel())
+
+    @classmethod
+    def from_packbits(cls, bits, shape):
+        """ Build a mask from the output of `packbits`
+        """
+        n_voxels = int(np.prod(shape))
+        return cls(np.unpackbits(bits, count=n_voxels).reshape(shape))
+
+    def compact_volume(self, vol):
+        """ Return the brain voxels of 3D volume `vol` as a 1D array
+        """
+        return np.asarray(vol).reshape(-1)[self.indices]
+
+    def compact(self, img):
+        """ Return the (n_brain_voxels x n_timepoints) matrix of `img`
+
+        The matrix is filled one volume at a time, so the full 4D array is
+        never loaded when `img` has an array proxy.
+
+        Parameters
+        ----------
+        img : nibabel image, RunData or numpy array
+            Functional 4D image.
+        """
+        dataobj = volume_source(img)
+        n_trs = dataobj.shape[-1]
+        compact = np.zeros((self.n_voxels, n_trs), dtype=float_dtype(img))
+        for i in range(n_trs):
+            compact[:, i] = self.compact_volume(dataobj[..., i])
+        return compact
+
+    def expand(self, values, fill=0):
+        """ Put the brain voxel `values` back into a full 3D array
+        """
+        full = np.full(self.shape, fill, dtype=np.asarray(values).dtype)
+        full.flat[self.indices] = values
+        return full
+
+
+def compute_brain_mask(img, fraction=1 / 8):
+    """ Compute the brain mask of a functional run
+
+    As for the SPM global signal, the brain voxels are the ones with an
+    intensity above `fraction` times the mean intensity.  The threshold is
+    applied to the first volume, so computing the mask does not need a pass
+    over the whole run.
+
+    Parameters
+    ----------
+    img : nibabel image, RunData or numpy array
+        Functional 4D image.
+    fraction : float, optional
+        Fraction of the mean intensity giving the threshold, by default 1/8.
+
+    Returns
+    -------
+    mask : BrainMask
+        Brain mask of the run.
+    """
+    dataobj = volume_source(img)
+    vol = np.asarray(dataobj[..., 0], dtype=np.float64)
+    return BrainMask(vol > np.mean(vol) * fraction)
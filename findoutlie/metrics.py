@@ -2,12 +2,23 @@
 
 Currently implemented metrics : 
     - dvars
+    - streaming_dvars
+    - coefficient_of_variation
+    - spm_global
+    - std_dvars, dvars_pvalue, delta_pct_dvar, slice_dvars (see
+      `findoutlie.dvars_engine`)
+    - tsnr, temporal_entropy (run-level summaries of voxelwise maps)
+    - framewise_displacement (see `findoutlie.motion`)
 
 To implement : 
     - ...
 
+Metrics are registered with `registry.register_metric`, declaring their cost
+profile (see `findoutlie.registry`).
+
 Template function : 
 
+@register_metric(offset=0, streamable=False, needs=())
 def metric_name(img):
     " Calculate metric on Nibabel image `img`
 
@@ -15,13 +26,14 @@ def metric_name(img):
 
     Parameters
     ----------
-    img : nibabel image
+    img : nibabel image, RunData or numpy array
 
     Returns
     -------
     metric : 1D array
         One-dimensional array containing the computed metric
     "
+    data = get_data(img)
     --- do stuff ---
     return metric
 
@@ -29,13 +41,27 @@ def metric_name(img):
 
 import numpy as np
 
+from findoutlie.data_load import (ACCUM_DTYPE, RunData, float_dtype, get_data,
+                                  volume_source)
+from findoutlie.dvars_engine import compute_dvars
+from findoutlie.masking import compute_brain_mask
+from findoutlie.motion import framewise_displacement as compute_fd
+from findoutlie.motion import motion_parameters
+from findoutlie.registry import (get_intermediate, get_metric,
+                                 register_intermediate, register_metric)
+from findoutlie.spm_funcs import spm_globals
+from findoutlie.stats import run_stats as compute_run_stats
+from findoutlie.stats import temporal_entropy as compute_temporal_entropy
+from findoutlie.stats import tsnr as compute_tsnr
+
 def compute_metric(img, metric_name = 'dvars', **kwargs):
     """ Compute the metric value of a 4D image for a specified metric name.
 
     Parameters
     ----------
-    img : nibabel image
-        Functional 4D image
+    img : nibabel image, RunData or numpy array
+        Functional 4D image. Pass a RunData to decode the data only once
+        when computing several metrics on the same run.
     metric_name : str, optional
         Name of the metric to compute, by default 'dvars'
 
@@ -45,12 +71,101 @@ def compute_metric(img, metric_name = 'dvars', **kwargs):
         Metric values at each timepoints (usually of size n_timepoints but could be less)
     """
 
-    metric_func = globals()[metric_name]
-    metric_tf = metric_func(img, **kwargs)
+    spec = get_metric(metric_name)
+    for need in spec.needs:
+        if need not in kwargs:
+            if isinstance(img, RunData):
+                kwargs[need] = img.intermediate(need)
+            else:
+                kwargs[need] = get_intermediate(need)(img)
+    metric_tf = spec.func(img, **kwargs)
 
     return metric_tf
 
-def dvars(img):
+def metric_offset(metric_name):
+    """ Return the index of the volume matching the first value of a metric.
+
+    Parameters
+    ----------
+    metric_name : str
+        Name of the metric
+
+    Returns
+    -------
+    int
+        Offset of the metric values relative to the volumes.
+    """
+
+    return get_metric(metric_name).offset
+
+def _run_stats(img):
+    if isinstance(img, RunData):
+        return img.intermediate('run_stats')
+    return compute_run_stats(img)
+
+@register_intermediate()
+def brain_mask(img):
+    """ Brain mask of the run (see `masking.compute_brain_mask`)
+    """
+    return compute_brain_mask(img)
+
+@register_intermediate()
+def compact_data(img):
+    """ Brain voxels x time matrix of the run
+    """
+    if isinstance(img, RunData):
+        return img.intermediate('brain_mask').compact(img)
+    return compute_brain_mask(img).compact(img)
+
+@register_intermediate()
+def run_stats(img):
+    """ Fused temporal maps and per-volume statistics (see `stats.run_stats`)
+
+    For a RunData created with ``use_mask=True``, the statistics only use the
+    brain voxels.
+    """
+    if isinstance(img, RunData) and img.use_mask:
+        return compute_run_stats(img, img.intermediate('brain_mask'))
+    return compute_run_stats(img)
+
+@register_intermediate()
+def mean_map(img):
+    """ Mean of `img` over time, shared between the metrics needing it
+    """
+    return _run_stats(img).mean_map
+
+@register_intermediate()
+def std_map(img):
+    """ Standard deviation of `img` over time, shared between the metrics needing it
+    """
+    return _run_stats(img).sd_map
+
+def _brain_mask(img):
+    if isinstance(img, RunData) and img.use_mask:
+        return img.intermediate('brain_mask')
+    return None
+
+@register_intermediate()
+def motion_params(img):
+    """ Rigid body parameters of each volume (see `motion.motion_parameters`)
+    """
+    return motion_parameters(img)
+
+@register_intermediate()
+def tsnr_stats(img):
+    """ tSNR map and its average (see `stats.tsnr`)
+    """
+    return compute_tsnr(img, _brain_mask(img), _run_stats(img))
+
+@register_intermediate()
+def entropy_stats(img):
+    """ Temporal Shannon entropy map and its average (see `stats.temporal_entropy`)
+    """
+    return compute_temporal_entropy(img, mask=_brain_mask(img),
+                                    stats=_run_stats(img))
+
+@register_metric(offset=1, streamable=True, needs=['run_stats'])
+def dvars(img, run_stats=None):
     """ Calculate TEMPORAL dvars metric on Nibabel image `img`
 
     The dvars calculation between two volumes is defined as the square root of
@@ -59,7 +174,10 @@ def dvars(img):
 
     Parameters
     ----------
-    img : nibabel image
+    img : nibabel image, RunData or numpy array
+    run_stats : RunStats, optional
+        Statistics of `img` computed in the fused pass of `stats.run_stats`.
+        If given, the dvars values are taken from it.
 
     Returns
     -------
@@ -67,6 +185,8 @@ def dvars(img):
         One-dimensional array with n-1 elements, where n is the number of
         volumes in `img`.
     """
+    if run_stats is not None:
+        return run_stats.dvars
     # Hint: remember 'axis='.  For example:
     # In [2]: arr = np.array([[2, 3, 4], [5, 6, 7]])
     # In [3]: np.mean(arr, axis=1)
@@ -74,18 +194,155 @@ def dvars(img):
     #
     # You may be be able to solve this in four lines, without a loop.
     # But solve it any way you can.
-    data = img.get_fdata()
+    data = get_data(img)
     voxel_per_time = data.reshape(-1, data.shape[-1]) #np.reshape(data,new_shape)
     diff = np.diff(voxel_per_time)
-    dvals = np.sqrt(np.mean(diff ** 2, axis=0))
+    dvals = np.sqrt(np.mean(diff ** 2, axis=0, dtype=ACCUM_DTYPE))
+    return dvals
+
+
+@register_metric(offset=1, streamable=True)
+def streaming_dvars(img):
+    """ Calculate TEMPORAL dvars metric reading `img` one volume at a time
+
+    Gives the same values as `dvars`, but the volumes are read in turn through
+    the image array proxy (``img.dataobj``), so only two volumes are in memory
+    at once instead of the whole 4D array and its difference.
+
+    Parameters
+    ----------
+    img : nibabel image, RunData or numpy array
+
+    Returns
+    -------
+    dvals : 1D array
+        One-dimensional array with n-1 elements, where n is the number of
+        volumes in `img`.
+    """
+    dataobj = volume_source(img)
+    dtype = float_dtype(img)
+    n_trs = dataobj.shape[-1]
+    dvals = np.zeros(n_trs - 1)
+    prev_vol = np.asarray(dataobj[..., 0], dtype=dtype)
+    for i in range(1, n_trs):
+        this_vol = np.asarray(dataobj[..., i], dtype=dtype)
+        diff = this_vol - prev_vol
+        dvals[i - 1] = np.sqrt(np.mean(diff ** 2, dtype=ACCUM_DTYPE))
+        prev_vol = this_vol
     return dvals
 
 
-#def standardized_dvar(img):
-    #https: // warwick.ac.uk / fac / sci / statistics / staff / academic - research / nichols / scripts / fsl / standardizeddvars.pdf
+@register_intermediate()
+def dvars_stats(img):
+    """ DVARS variants from the fused pass (see `dvars_engine.compute_dvars`)
+
+    Derived from the "run_stats" intermediate, so the run is read once for
+    dvars, the coefficient of variation and all the DVARS variants.  For a
+    RunData created with ``use_mask=True``, only the brain voxels are used.
+    """
+    return compute_dvars(img, _brain_mask(img), stats=_run_stats(img))
+
+
+def _dvars_stats(img, dvars_stats):
+    if dvars_stats is not None:
+        return dvars_stats
+    return compute_dvars(img)
+
+
+@register_metric(offset=1, streamable=True, needs=['dvars_stats'])
+def std_dvars(img, dvars_stats=None):
+    """ Calculate standardized dvars on Nibabel image `img`
+
+    Dvars divided by its robust expected value without artifact, so that
+    values are close to 1 for clean volumes whatever the scanner and
+    intensity scale (see `dvars_engine.compute_dvars`).
+
+    Parameters
+    ----------
+    img : nibabel image, RunData or numpy array
+    dvars_stats : DVARSStats, optional
+        Output of `dvars_engine.compute_dvars`, computed if not given.
+
+    Returns
+    -------
+    std_dvals : 1D array
+        One-dimensional array with n-1 elements, where n is the number of
+        volumes in `img`.
+    """
+    return _dvars_stats(img, dvars_stats).std_dvars
 
 
-def coefficient_of_variation(img):
+@register_metric(offset=1, streamable=True, needs=['dvars_stats'])
+def dvars_pvalue(img, dvars_stats=None):
+    """ Calculate the p-values of dvars on Nibabel image `img`
+
+    P-values of DVARS^2 under the null distribution of Afyouni & Nichols
+    (2018).  Use with the "pvalue_detector" detector.
+
+    Parameters
+    ----------
+    img : nibabel image, RunData or numpy array
+    dvars_stats : DVARSStats, optional
+        Output of `dvars_engine.compute_dvars`, computed if not given.
+
+    Returns
+    -------
+    p_values : 1D array
+        One-dimensional array with n-1 elements, where n is the number of
+        volumes in `img`.
+    """
+    return _dvars_stats(img, dvars_stats).p_values
+
+
+@register_metric(offset=1, streamable=True, needs=['dvars_stats'])
+def delta_pct_dvar(img, dvars_stats=None):
+    """ Calculate Δ%D-var on Nibabel image `img`
+
+    Excess of the D-var of each volume pair over its median, as a percentage
+    of the average voxel variance (Afyouni & Nichols, 2018).  Values above 5%
+    are usually considered of practical significance.
+
+    Parameters
+    ----------
+    img : nibabel image, RunData or numpy array
+    dvars_stats : DVARSStats, optional
+        Output of `dvars_engine.compute_dvars`, computed if not given.
+
+    Returns
+    -------
+    delta_pct : 1D array
+        One-dimensional array with n-1 elements, where n is the number of
+        volumes in `img`.
+    """
+    return _dvars_stats(img, dvars_stats).delta_pct_dvar
+
+
+@register_metric(offset=1, streamable=True, needs=['dvars_stats'])
+def slice_dvars(img, dvars_stats=None):
+    """ Calculate dvars of each slice of Nibabel image `img`
+
+    Catches artifacts limited to some slices, such as multiband slice
+    artifacts, diluted in the dvars of the whole volume.  With a 2D metric,
+    `detectors.compute_outliers` applies the detector to each slice and flags
+    the frames that are outliers in any slice.
+
+    Parameters
+    ----------
+    img : nibabel image, RunData or numpy array
+    dvars_stats : DVARSStats, optional
+        Output of `dvars_engine.compute_dvars`, computed if not given.
+
+    Returns
+    -------
+    slice_dvals : 2D array
+        Array of shape (n_slices, n-1), where n is the number of volumes in
+        `img`, NaN for the slices without voxels.
+    """
+    return _dvars_stats(img, dvars_stats).slice_dvars
+
+
+@register_metric(streamable=True, needs=['run_stats'])
+def coefficient_of_variation(img, run_stats=None):
     #looking at the output nii I am not quite sure this is right
     """ Calculate the coefficient of variation (CV)
     also known as relative standard deviation (RSD),
@@ -99,7 +356,10 @@ def coefficient_of_variation(img):
 
     Parameters
     ----------
-    img : nibabel image
+    img : nibabel image, RunData or numpy array
+    run_stats : RunStats, optional
+        Statistics of `img` computed in the fused pass of `stats.run_stats`.
+        If given, the CV values are taken from it.
 
     Returns
     -------
@@ -108,9 +368,109 @@ def coefficient_of_variation(img):
         volumes in `img`. This array contains the coefficient of variation for each volume.
 
     """
-    data = img.get_fdata()
-    cv=np.std(data, axis=(0,1,2))/np.mean(data, axis=(0,1,2))
+    if run_stats is not None:
+        return run_stats.cv
+    data = get_data(img)
+    cv=(np.std(data, axis=(0,1,2), dtype=ACCUM_DTYPE)
+        / np.mean(data, axis=(0,1,2), dtype=ACCUM_DTYPE))
 
     return cv
 
 
+@register_metric()
+def spm_global(img, chunk_size=None):
+    """ Calculate the SPM global signal of each volume of `img`
+
+    The global signal of a volume is the mean of the voxels above one eighth of
+    the volume mean (see `spm_funcs.spm_global`).
+
+    Parameters
+    ----------
+    img : nibabel image, RunData or numpy array
+    chunk_size : int, optional
+        Number of volumes processed together, by default all of them.
+
+    Returns
+    -------
+    spm_vals : 1D array
+        One-dimensional array with n elements, where n is the number of
+        volumes in `img`.
+    """
+    return spm_globals(img, chunk_size)
+
+
+@register_metric(streamable=True, needs=['tsnr_stats'])
+def tsnr(img, tsnr_stats=None):
+    """ Calculate the temporal signal to noise ratio of Nibabel image `img`
+
+    The tSNR map is the mean of each voxel over time divided by its standard
+    deviation (Kruger & Glover 2001).  The metric is the run-level summary,
+    the mean tSNR over the voxels, to compare runs with each other (for
+    instance with `cohort.find_cohort_outliers`).  The map is the
+    "tsnr_stats" intermediate.
+
+    Parameters
+    ----------
+    img : nibabel image, RunData or numpy array
+    tsnr_stats : MapSummary, optional
+        Output of `stats.tsnr`, computed if not given.
+
+    Returns
+    -------
+    tsnr_val : 1D array
+        One-element array with the mean tSNR of `img`.
+    """
+    if tsnr_stats is None:
+        tsnr_stats = compute_tsnr(img)
+    return np.array([tsnr_stats.summary])
+
+
+@register_metric(streamable=True, needs=['entropy_stats'])
+def temporal_entropy(img, entropy_stats=None):
+    """ Calculate the voxelwise temporal Shannon entropy of Nibabel image `img`
+
+    The entropy of each voxel comes from the histogram of its values over time
+    (DiNuzzo et al. 2003, see `stats.temporal_entropy`).  The metric is the
+    run-level summary, the mean entropy over the voxels.  The map is the
+    "entropy_stats" intermediate.
+
+    Parameters
+    ----------
+    img : nibabel image, RunData or numpy array
+    entropy_stats : MapSummary, optional
+        Output of `stats.temporal_entropy`, computed if not given.
+
+    Returns
+    -------
+    entropy_val : 1D array
+        One-element array with the mean entropy of `img`, in bits.
+    """
+    if entropy_stats is None:
+        entropy_stats = compute_temporal_entropy(img)
+    return np.array([entropy_stats.summary])
+
+
+@register_metric(offset=1, streamable=True, needs=['motion_params'])
+def framewise_displacement(img, motion_params=None):
+    """ Calculate the framewise displacement of Nibabel image `img`
+
+    Each volume is registered to the first volume with a rigid body
+    transform (see `motion.motion_parameters`).  The framewise displacement
+    is the sum of the absolute changes of the three translations and of the
+    three rotations, converted to mm on a 50 mm sphere (Power et al. 2012).
+
+    Parameters
+    ----------
+    img : nibabel image, RunData or numpy array
+    motion_params : 2D array, optional
+        Motion parameters of the volumes (n x 6), estimated if not given.
+
+    Returns
+    -------
+    fd : 1D array
+        One-dimensional array with n-1 elements, where n is the number of
+        volumes in `img`, in mm.
+    """
+    if motion_params is None:
+        motion_params = motion_parameters(img)
+    return compute_fd(motion_params)
@@ -0,0 +1,279 @@
+""" Head motion estimation and framewise displacement
+
+Each volume is registered to a reference volume with a six-parameter rigid
+body transform (three translations in mm, three rotations in radians), using
+Gauss-Newton minimization of the sum of squared differences:
+
+* the registration goes coarse-to-fine, from smoothed and subsampled volumes
+  to the full resolution, starting each level from the previous estimate;
+* the volumes are registered in parallel threads (the resampling in
+  ``scipy.ndimage`` and the NumPy array operations release the GIL), while the
+  volumes are read in turn, a few ahead of the registrations.  In a worker
+  process (such as those of ``find_outliers(..., n_jobs=n)``), there is one
+  thread by default, as the processes already share the CPUs.
+
+The default reference is the first volume, so that the volumes are read in
+file order: reading a later volume first from a gzipped image would make the
+decompression start again from the beginning of the file for volume 0.
+
+The framewise displacement (Power et al. 2012) sums the absolute changes of
+the six parameters between consecutive volumes, the rotations converted to
+displacements on a sphere of 50 mm radius.
+
+The coordinates are in mm (from the voxel sizes), centred on the volume
+centre, so that the rotations are about the centre of the field of view.
+"""
+
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from scipy import ndimage
+
+from findoutlie.data_load import RunData, volume_source
+
+# Subsampling factors of the coarse-to-fine levels
+LEVELS = (4, 2, 1)
+
+# Radius (mm) of the sphere converting rotations to displacements
+HEAD_RADIUS = 50
+
+
+def rigid_matrix(params):
+    """ Return the 4 x 4 affine of rigid body parameters `params`
+
+    Parameters
+    ----------
+    params : sequence of 6 floats
+        Translations along x, y, z (mm) and rotations about x, y, z (radians).
+        The rotation matrix is ``Rz @ Ry @ Rx``.
+
+    Returns
+    -------
+    matrix : 4 x 4 array
+    """
+    tx, ty, tz, rx, ry, rz = params
+    cx, sx = np.cos(rx), np.sin(rx)
+    cy, sy = np.cos(ry), np.sin(ry)
+    cz, sz = np.cos(rz), np.sin(rz)
+    rot_x = np.array([[1, 0, 0], [0, cx, -sx], [0, sx, cx]])
+    rot_y = np.array([[cy, 0, sy], [0, 1, 0], [-sy, 0, cy]])
+    rot_z = np.array([[cz, -sz, 0], [sz, cz, 0], [0, 0, 1]])
+    matrix = np.eye(4)
+    matrix[:3, :3] = rot_z @ rot_y @ rot_x
+    matrix[:3, 3] = tx, ty, tz
+    return matrix
+
+
+def rigid_params(matrix):
+    """ Return the rigid body parameters of 4 x 4 affine `matrix`
+
+    Inverse of `rigid_matrix`.
+    """
+    rot = matrix[:3, :3]
+    ry = -np.arcsin(np.clip(rot[2, 0], -1, 1))
+    rx = np.arctan2(rot[2, 1], rot[2, 2])
+    rz = np.arctan2(rot[1, 0], rot[0, 0])
+    return np.array([*matrix[:3, 3], rx, ry, rz])
+
+
+class _Level:
+    """ Reference volume at one level of the coarse-to-fine pyramid
+    """
+
+    def __init__(self, vol, factor, zooms, center_mm):
+        self.factor = factor
+        self.vol = _subsample(vol, factor)
+        self.zooms = np.asarray(zooms, dtype=float) * factor
+        # Voxel coordinates of the point at the origin of the mm coordinates
+        self.center = center_mm / self.zooms
+        grid = np.indices(self.vol.shape).reshape(3, -1).T
+        self.coords = (grid - self.center) * self.zooms
+
+    def sample(self, vol, matrix):
+        """ Values of `vol` at the reference voxels moved by `matrix`
+        """
+        vox_rot = matrix[:3, :3] * self.zooms[None, :] / self.zooms[:, None]
+        offset = ((matrix[:3, 3] - matrix[:3, :3] @ (self.center * self.zooms))
+                  / self.zooms + self.center)
+        return ndimage.affine_transform(vol, vox_rot, offset, order=1,
+                                        mode='nearest')
+
+    def jacobian(self, warped):
+        """ Derivatives of the warped volume values for a small parameter change
+        """
+        grads = np.stack([g.reshape(-1) for g in
+                          np.gradient(warped, *self.zooms)], axis=1)
+        x, y, z = self.coords.T
+        gx, gy, gz = grads.T
+        # Rotations about x, y, z move point (x, y, z) by (0, -z, y),
+        # (z, 0, -x) and (-y, x, 0)
+        return np.stack([gx, gy, gz,
+                         gz * y - gy * z,
+                         gx * z - gz * x,
+                         gy * x - gx * y], axis=1)
+
+
+def _subsample(vol, factor):
+    if factor == 1:
+        return vol
+    smoothed = ndimage.gaussian_filter(vol, factor / 2)
+    return smoothed[::factor, ::factor, ::factor]
+
+
+def make_levels(ref_vol, zooms, levels=LEVELS):
+    """ Build the coarse-to-fine pyramid of reference volume `ref_vol`
+
+    Parameters
+    ----------
+    ref_vol : 3D array
+        Reference volume.
+    zooms : sequence of 3 floats
+        Voxel sizes in mm.
+    levels : sequence of int, optional
+        Subsampling factors, from coarse to fine, by default (4, 2, 1).
+
+    Returns
+    -------
+    pyramid : list
+        Reference levels, to pass to `register_volume`.
+    """
+    ref_vol = np.asarray(ref_vol, dtype=np.float64)
+    center_mm = (np.array(ref_vol.shape) - 1) / 2 * np.asarray(zooms)
+    return [_Level(ref_vol, factor, zooms, center_mm) for factor in levels]
+
+
+def register_volume(vol, pyramid, n_iter=10, tol=1e-4):
+    """ Estimate the rigid body parameters aligning `vol` to the reference
+
+    Parameters
+    ----------
+    vol : 3D array
+        Volume to register.
+    pyramid : list
+        Reference levels from `make_levels`.
+    n_iter : int, optional
+        Maximum number of Gauss-Newton iterations per level, by default 10.
+    tol : float, optional
+        Iterations stop when the parameter update is smaller than `tol` (mm
+        or radians), by default 1e-4.
+
+    Returns
+    -------
+    params : 1D array (6,)
+        Translations (mm) and rotations (radians) such that the volume at
+        ``rigid_matrix(params) @ x`` matches the reference at ``x``.
+    """
+    vol = np.asarray(vol, dtype=np.float64)
+    matrix = np.eye(4)
+    for level in pyramid:
+        moving = _subsample(vol, level.factor)
+        ref_values = level.vol.reshape(-1)
+        for _ in range(n_iter):
+            warped = level.sample(moving, matrix)
+            jac = level.jacobian(warped)
+            residuals = ref_values - warped.reshape(-1)
+            hessian = jac.T @ jac
+            # Small damping keeps the system solvable for flat volumes
+            hessian += np.eye(6) * 1e-9 * max(np.trace(hessian), 1)
+            step = np.linalg.solve(hessian, jac.T @ residuals)
+            matrix = matrix @ rigid_matrix(step)
+            if np.max(np.abs(step)) < tol:
+                break
+    return rigid_params(matrix)
+
+
+def motion_parameters(img, reference=None, levels=LEVELS, n_threads=None,
+                      zooms=None):
+    """ Estimate the rigid body motion of each volume of `img`
+
+    Parameters
+    ----------
+    img : nibabel image, RunData or numpy array
+        Functional 4D image.
+    reference : int, optional
+        Index of the reference volume, by default 0.  For a gzipped image
+        whose data is not loaded, a later reference is read before the other
+        volumes, at the cost of decompressing the start of the file twice.
+    levels : sequence of int, optional
+        Subsampling factors of the coarse-to-fine registration, by default
+        (4, 2, 1).
+    n_threads : int, optional
+        Number of registration threads, by default the number of CPUs, or 1
+        in a worker process.
+    zooms : sequence of 3 floats, optional
+        Voxel sizes in mm, by default from the image header (1 mm for an
+        array).
+
+    Returns
+    -------
+    params : 2D array (n_volumes, 6)
+        Translations (mm) and rotations (radians) of each volume relative to
+        the reference (see `register_volume`).
+    """
+    dataobj = volume_source(img)
+    n_trs = dataobj.shape[-1]
+    if zooms is None:
+        zooms = _voxel_sizes(img)
+    if reference is None:
+        reference = 0
+    if n_threads is None:
+        n_threads = default_n_threads()
+    pyramid = make_levels(np.asarray(dataobj[..., reference]), zooms, levels)
+    params = np.zeros((n_trs, 6))
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        pending = deque()
+        for i in range(n_trs):
+            # Read the volumes in this thread, at most a few ahead
+            if len(pending) >= 2 * n_threads:
+                j, future = pending.popleft()
+                params[j] = future.result()
+            vol = np.asarray(dataobj[..., i], dtype=np.float64)
+            pending.append((i, executor.submit(register_volume, vol,
+                                               pyramid)))
+        for j, future in pending:
+            params[j] = future.result()
+    return params
+
+
+def default_n_threads():
+    """ Default number of registration threads
+
+    The number of CPUs in the main process, 1 in a child process, where
+    threads would compete for the CPUs with the other worker processes.
+    """
+    if multiprocessing.parent_process() is not None:
+        return 1
+    return os.cpu_count() or 1
+
+
+def _voxel_sizes(img):
+    if isinstance(img, RunData):
+        img = img.img
+    if isinstance(img, np.ndarray):
+        return (1., 1., 1.)
+    return img.header.get_zooms()[:3]
+
+
+def framewise_displacement(params, radius=HEAD_RADIUS):
+    """ Framewise displacement from the motion parameters of each volume
+
+    Parameters
+    ----------
+    params : 2D array (n_volumes, 6)
+        Translations (mm) and rotations (radians), as from
+        `motion_parameters`.
+    radius : float, optional
+        Radius (mm) of the sphere converting rotations to displacements, by
+        default 50.
+
+    Returns
+    -------
+    fd : 1D array (n_volumes - 1)
+        Sum of the absolute parameter changes between consecutive volumes, in
+        mm.
+    """
+    diffs = np.abs(np.diff(params, axis=0))
+    return np.sum(diffs[:, :3], axis=1) + radius * np.sum(diffs[:, 3:], axis=1)
@@ -0,0 +1,229 @@
+""" Online outlier detection, for volumes arriving during the acquisition
+
+The detectors here are updated with one metric value at a time and return at
+once whether that value is an outlier, with a fixed cost per value:
+
+* `OnlineIQRDetector` estimates the quartiles with the P-square algorithm
+  (Jain & Chlamtac, 1985), keeping five markers per quantile;
+* `OnlineMedianDetector` uses the median and MAD of a sliding window of the
+  last values.
+
+`OnlineDVARS` computes dvars as the volumes arrive, so that::
+
+    dvars = OnlineDVARS()
+    detector = OnlineIQRDetector()
+    for vol in acquisition:
+        value = dvars.update(vol)
+        if value is not None and detector.update(value):
+            print('Spike!')
+"""
+
+import bisect
+from collections import deque
+
+import numpy as np
+
+# Corresponding to erfcinv(3/2), see `detectors.median_detector`
+ERFCINV_CST = -0.4769362762044699
+MAD_SCALE = -1 / (np.sqrt(2) * ERFCINV_CST)
+
+
+class P2Quantile:
+    """ Streaming estimate of quantile `p` with the P-square algorithm
+
+    Five markers are updated for each new value, so the memory and the cost
+    per value do not depend on the number of values.
+
+    Parameters
+    ----------
+    p : float
+        Quantile to estimate, between 0 and 1.
+    """
+
+    def __init__(self, p):
+        self.p = p
+        self.n_values = 0
+        self._heights = []
+        self._positions = [0, 1, 2, 3, 4]
+        self._desired = [0, 2 * p, 4 * p, 2 + 2 * p, 4]
+        self._increments = [0, p / 2, p, (1 + p) / 2, 1]
+
+    @property
+    def value(self):
+        """ Current estimate of the quantile (NaN before the first value)
+        """
+        if self.n_values == 0:
+            return np.nan
+        if self.n_values <= 5:
+            # Markers not started yet, exact quantile of the first values
+            return float(np.percentile(self._heights, self.p * 100))
+        return self._heights[2]
+
+    def update(self, x):
+        """ Add value `x` to the estimate
+        """
+        self.n_values += 1
+        q = self._heights
+        if len(q) < 5:
+            bisect.insort(q, x)
+            return
+        n = self._positions
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[4]:
+            q[4] = x
+            k = 3
+        else:
+            k = bisect.bisect_right(q, x) - 1
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i in range(5):
+            self._desired[i] += self._increments[i]
+        for i in (1, 2, 3):
+            d = self._desired[i] - n[i]
+            if ((d >= 1 and n[i + 1] - n[i] > 1)
+                    or (d <= -1 and n[i - 1] - n[i] < -1)):
+                d = 1 if d > 0 else -1
+                # Piecewise parabolic prediction, linear if out of order
+                height = q[i] + d / (n[i + 1] - n[i - 1]) * (
+                    (n[i] - n[i - 1] + d) * (q[i + 1] - q[i])
+                    / (n[i + 1] - n[i])
+                    + (n[i + 1] - n[i] - d) * (q[i] - q[i - 1])
+                    / (n[i] - n[i - 1]))
+                if not q[i - 1] < height < q[i + 1]:
+                    height = q[i] + d * (q[i + d] - q[i]) / (n[i + d] - n[i])
+                q[i] = height
+                n[i] += d
+
+
+class OnlineIQRDetector:
+    """ Online version of `detectors.iqr_detector`
+
+    Each value is compared to the thresholds computed from the values seen
+    before it, then added to the quartile estimates.
+
+    Parameters
+    ----------
+    iqr_proportion : float, optional
+        Scalar to multiply the IQR to form upper and lower threshold, by
+        default 1.5.
+    pos_only : bool, optional
+        Condition to filter only values above the upper threshold.  Default is
+        True.
+    neg_only : bool, optional
+        Condition to filter only values below the lower threshold.  Default is
+        False.
+    warmup : int, optional
+        Number of values seen before flagging any outlier, by default 10.
+    """
+
+    def __init__(self, iqr_proportion=1.5, pos_only=True, neg_only=False,
+                 warmup=10):
+        self.iqr_proportion = iqr_proportion
+        self.pos_only = pos_only
+        self.neg_only = neg_only
+        self.warmup = warmup
+        self.n_values = 0
+        self._q1 = P2Quantile(0.25)
+        self._q3 = P2Quantile(0.75)
+
+    def update(self, value):
+        """ Return True if `value` is an outlier, and add it to the estimates
+        """
+        is_outlier = False
+        if self.n_values >= self.warmup:
+            q1, q3 = self._q1.value, self._q3.value
+            iqr = q3 - q1
+            is_outlier = ((not self.neg_only
+                           and value > q3 + self.iqr_proportion * iqr)
+                          or (not self.pos_only
+                              and value < q1 - self.iqr_proportion * iqr))
+        self._q1.update(value)
+        self._q3.update(value)
+        self.n_values += 1
+        return is_outlier
+
+
+class OnlineMedianDetector:
+    """ Online version of `detectors.median_detector` on a sliding window
+
+    Each value is compared to the median and scaled MAD of the last `window`
+    values before it.  The window is kept sorted, so the cost per value only
+    depends on the window size.
+
+    Parameters
+    ----------
+    scale : float, optional
+        Scalar to multiply the scaled MAD to form upper and lower threshold,
+        by default 5.
+    pos_only : bool, optional
+        Condition to filter only values above the upper threshold.  Default is
+        True.
+    neg_only : bool, optional
+        Condition to filter only values below the lower threshold.  Default is
+        False.
+    window : int, optional
+        Number of past values used for the median and MAD, by default 50.
+    warmup : int, optional
+        Number of values seen before flagging any outlier, by default 10.
+    """
+
+    def __init__(self, scale=5, pos_only=True, neg_only=False, window=50,
+                 warmup=10):
+        self.scale = scale
+        self.pos_only = pos_only
+        self.neg_only = neg_only
+        self.window = window
+        self.warmup = warmup
+        self.n_values = 0
+        self._recent = deque()
+        self._sorted = []
+
+    def update(self, value):
+        """ Return True if `value` is an outlier, and add it to the window
+        """
+        is_outlier = False
+        if self.n_values >= self.warmup:
+            values = np.array(self._sorted)
+            mid = len(values) // 2
+            median = (values[mid] + values[~mid]) / 2
+            scaled_mad = MAD_SCALE * np.median(np.abs(values - median))
+            is_outlier = bool(
+                (not self.neg_only and value > median + self.scale * scaled_mad)
+                or (not self.pos_only
+                    and value < median - self.scale * scaled_mad))
+        self._recent.append(value)
+        bisect.insort(self._sorted, value)
+        if len(self._recent) > self.window:
+            oldest = self._recent.popleft()
+            del self._sorted[bisect.bisect_left(self._sorted, oldest)]
+        self.n_values += 1
+        return is_outlier
+
+
+class OnlineDVARS:
+    """ Dvars computed on volumes as they arrive
+
+    Parameters
+    ----------
+    mask : BrainMask, optional
+        If given, only the brain voxels are used.
+    """
+
+    def __init__(self, mask=None):
+        self.mask = mask
+        self._prev_vol = None
+
+    def update(self, vol):
+        """ Return dvars between `vol` and the previous volume
+
+        Returns None for the first volume.
+        """
+        vol = np.asarray(vol, dtype=np.float64)
+        if self.mask is not None:
+            vol = self.mask.compact_volume(vol)
+        prev_vol, self._prev_vol = self._prev_vol, vol
+        if prev_vol is None:
+            return None
+        return float(np.sqrt(np.mean((vol - prev_vol) ** 2)))
@@ -1,71 +1,297 @@
 """ Module with routines for finding outliers
 """
 
-import os.path as op
-from glob import glob
+import warnings
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 
 import findoutlie.data_load as data_load
+from findoutlie.dataset_index import DatasetIndex
 import findoutlie.detectors as detectors
 import findoutlie.metrics as metrics
+import findoutlie.profiling as profiling
+import findoutlie.registry as registry
+from findoutlie.results import run_result
 
 
-def detect_outliers(fname):
+# Configuration list for metrics and detectors names
+CONFIG = [['dvars', 'coefficient_of_variation'], ['median_detector', 'iqr_detector']]
+
+
+def compute_metrics(run, metric_names, cache=None):
+    """ Compute metrics on a run, in the order planned by the registry.
+
+    The metrics are grouped by `registry.plan_passes`, and the shared
+    intermediates are freed once the metrics needing them are computed.  The
+    metrics sharing an intermediate read the data once; the others read it
+    on their own.
+
+    Parameters
+    ----------
+    run : RunData
+        Functional run
+    metric_names : sequence of str
+        Names of the metrics to compute
+    cache : MetricCache, optional
+        Cache of the metric values, by default None (no cache).
+
+    Returns
+    -------
+    dict
+        Dictionary with keys being metric names and values being metric
+        values.
+    """
+
+    metric_values = {}
+    passes = registry.plan_passes(metric_names)
+    for i, metric_pass in enumerate(passes):
+        for metric_name in metric_pass:
+            metric = None
+            if cache is not None:
+                with profiling.stage('cache', metric_name):
+                    metric = cache.get(run.fname, metric_name,
+                                       dtype=run.dtype.name,
+                                       use_mask=run.use_mask)
+            if metric is None:
+                with profiling.stage('metric', metric_name):
+                    metric = metrics.compute_metric(run, metric_name)
+                if cache is not None:
+                    cache.put(run.fname, metric_name, metric,
+                              dtype=run.dtype.name, use_mask=run.use_mask)
+            metric_values[metric_name] = metric
+        # Keep only the intermediates needed by the next passes
+        needed = set()
+        for metric_name in sum(passes[i + 1:], []):
+            needed.update(registry.get_metric(metric_name).needs)
+        run.release(keep=needed)
+
+    return metric_values
+
+
+def detect_outliers(fname, dtype=None, cache=None, config=None,
+                    use_mask=True, decode_cache=None, return_result=False):
     """ Outlier detection routine.
 
+    The functional data is decoded once and shared between all the metrics.
+    With a metric cache, metrics computed before on the same file contents are
+    read from the cache, and the image is only loaded if a metric is missing.
+
     Parameters
     ----------
     fname : str
         Path to the file containing the functional image
+    dtype : numpy dtype, optional
+        Floating point type used to decode the data, by default the native
+        float type of the file (float32 for int16 or float32 files, see
+        `data_load.native_float_dtype`).
+    cache : MetricCache, optional
+        Cache of the metric values, by default None (no cache).
+    config : list, optional
+        List of the metric names and list of the matching detector names, by
+        default `CONFIG`.  Any registered metric or detector can be used.
+    use_mask : bool, optional
+        If True (default), the metrics supporting it only use the brain
+        voxels.
+    decode_cache : DecodeCache, optional
+        Cache of the uncompressed runs, by default None (no cache).
+    return_result : bool, optional
+        If True, also return the metric values and the detector masks, by
+        default False.
 
     Returns
     -------
     list
         List of frames considered as outliers.
+    result : dict
+        Results row of the run, with the metric values, the detector masks and
+        the consensus mask (see `results.run_result`).  Only returned if
+        `return_result` is True.
+
+    Notes
+    -----
+    With the instrumentation turned on (see `profiling`), the time and memory
+    of each stage are written as a JSON line for the run.
     """
 
-    # Configuration list for metrics and detectors names
-    CONFIG = [['dvars', 'coefficient_of_variation'], ['median_detector', 'iqr_detector']]
+    if config is None:
+        config = CONFIG
 
-    image = data_load.load_image(fname)
+    with profiling.record_run(fname):
+        outliers, result = _detect_outliers(fname, dtype, cache, config,
+                                            use_mask, decode_cache)
+    return (outliers, result) if return_result else outliers
 
-    metrics_list = CONFIG[0]
-    detectors_list = CONFIG[1]
 
-    n_metrics = len(CONFIG[0])
-    n_timepoints = image.shape[-1]
+def _cached_metrics(fname, metric_names, cache, info_kwargs):
+    # Metric values and run information from the cache, without loading the
+    # image, or None if anything is missing
+    info = cache.get_info(fname, **info_kwargs)
+    if info is None:
+        return None
+    metric_values = {}
+    for metric_name in metric_names:
+        with profiling.stage('cache', metric_name):
+            metric = cache.get(fname, metric_name, dtype=info['dtype'],
+                               use_mask=info_kwargs['use_mask'])
+        if metric is None:
+            return None
+        metric_values[metric_name] = metric
+    return metric_values, info
+
+
+def _detect_outliers(fname, dtype, cache, config, use_mask, decode_cache):
+    metrics_list = config[0]
+    detectors_list = config[1]
+
+    cached = None
+    if cache is not None:
+        # Keyed by the requested dtype; the run information gives the
+        # decoding dtype keying the metrics
+        requested = None if dtype is None else np.dtype(dtype).name
+        info_kwargs = dict(dtype=requested, use_mask=use_mask)
+        cached = _cached_metrics(fname, metrics_list, cache, info_kwargs)
+    if cached is None:
+        run = data_load.RunData(fname, dtype=dtype, use_mask=use_mask,
+                                decode_cache=decode_cache)
+        metric_values = compute_metrics(run, metrics_list, cache)
+        info = {'n_timepoints': run.n_timepoints, 'dtype': run.dtype.name}
+        if cache is not None:
+            cache.put_info(fname, info, **info_kwargs)
+    else:
+        metric_values, info = cached
+
+    n_metrics = len(metrics_list)
+    n_timepoints = info['n_timepoints']
     outlier_tfs = np.zeros((n_metrics, n_timepoints))
 
     for i, (metric_name, detector_name) in enumerate(zip(metrics_list, detectors_list)):
-        metric = metrics.compute_metric(image, metric_name)
-        outlier_tfs[i] = detectors.compute_outliers(metric, n_timepoints, detector_name)
+        with profiling.stage('detector', detector_name):
+            outlier_tfs[i] = detectors.compute_outliers(
+                metric_values[metric_name], n_timepoints, detector_name,
+                offset=metrics.metric_offset(metric_name))
 
     outlier_decision_tf = detectors.consensus_outliers(outlier_tfs, decision='any')
     outlier_frames_id = np.where(outlier_decision_tf > 0)[0]
 
-    return list(outlier_frames_id)
+    masks = dict(zip(zip(metrics_list, detectors_list), outlier_tfs))
+    result = run_result(fname, metric_values, masks, outlier_decision_tf,
+                        dtype=info['dtype'])
 
+    return list(outlier_frames_id), result
 
-def find_outliers(data_directory):
+
+def _detect_run(fname, return_result=False, **kwargs):
+    # Outliers or error of run `fname`, with its instrumentation record and,
+    # if `return_result` is True, its results row
+    with profiling.record_run(fname) as record:
+        try:
+            outliers, result = detect_outliers(fname, return_result=True,
+                                               **kwargs)
+            err = None
+        except Exception as exc:
+            if record is not None:
+                record['error'] = repr(exc)
+            outliers, err = None, exc
+            # Empty columns, so that all the rows have the same columns
+            metrics_list, detectors_list = kwargs.get('config') or CONFIG
+            result = run_result(
+                fname, dict.fromkeys(metrics_list, []),
+                dict.fromkeys(zip(metrics_list, detectors_list), []),
+                error=exc)
+    return outliers, err, record, result if return_result else None
+
+
+def find_outliers(data_directory, n_jobs=1, return_errors=False, cache=None,
+                  config=None, decode_cache=None, results=None,
+                  index_path=None):
     """ Return filenames and outlier indices for images in `data_directory`.
 
     Parameters
     ----------
     data_directory : str
         Directory containing containing images.
+    n_jobs : int, optional
+        Number of worker processes running the outlier detection, by default
+        1 (no parallel processing).
+    return_errors : bool, optional
+        If True, also return the errors raised by the failing runs, by default
+        False.  Otherwise the failing runs are reported as warnings.
+    cache : MetricCache, optional
+        Cache of the metric values, by default None (no cache).
+    config : list, optional
+        List of the metric names and list of the matching detector names, by
+        default `CONFIG`.
+    decode_cache : DecodeCache, optional
+        Cache of the uncompressed runs, by default None (no cache).
+    results : ResultsWriter, optional
+        If given, the results row of each run (metric values, detector masks,
+        consensus mask and metadata, see `results.run_result`) is appended to
+        it, in filename order, and the writer flushed at the end.
+    index_path : str, optional
+        Path of the dataset index file, by default in the user cache
+        directory (see `dataset_index.DatasetIndex`).
 
     Returns
     -------
     outlier_dict : dict
         Dictionary with keys being filenames and values being lists of outliers
-        for filename.
+        for filename.  The filenames are sorted.  The runs are the
+        ``sub-*.nii.gz`` files listed by `dataset_index.DatasetIndex`.
+    error_dict : dict
+        Dictionary with keys being filenames of the failing runs and values
+        being the raised exceptions.  Only returned if `return_errors` is True.
+
+    Notes
+    -----
+    With the instrumentation turned on (see `profiling`), a summary of the
+    times and memory of all the runs is written after the run records.
     """
-    image_fnames = glob(op.join(data_directory, '**', 'sub-*.nii.gz'),
-                        recursive=True)
+    runs = DatasetIndex(data_directory, index_path=index_path).runs()
+    image_fnames = [run['path'] for run in runs]
     outlier_dict = {}
-    for fname in image_fnames:
-        outliers = detect_outliers(fname)
-        outlier_dict[fname] = outliers
+    error_dict = {}
+    records = []
+    kwargs = dict(cache=cache, config=config, decode_cache=decode_cache,
+                  return_result=results is not None)
+
+    if n_jobs == 1:
+        run_results = (_detect_run(fname, **kwargs) for fname in image_fnames)
+        for fname, detected in zip(image_fnames, run_results):
+            _store_result(fname, *detected, outlier_dict, error_dict,
+                          records, results)
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            # Start with the largest runs, to balance the work between workers
+            by_size = sorted(runs, key=lambda run: -np.prod(run['shape'] or 0))
+            futures = {run['path']: executor.submit(
+                _detect_run, run['path'], **kwargs) for run in by_size}
+            # Collect in filename order so the output is deterministic
+            for fname in image_fnames:
+                _store_result(fname, *futures[fname].result(), outlier_dict,
+                              error_dict, records, results)
+
+    if results is not None:
+        results.flush()
+
+    if records:
+        profiling.emit({'summary': profiling.summarize(records)})
+
+    if return_errors:
+        return outlier_dict, error_dict
+
+    for fname, err in error_dict.items():
+        warnings.warn(f'Outlier detection failed for "{fname}": {err!r}')
     return outlier_dict
 
+
+def _store_result(fname, outliers, err, record, result, outlier_dict,
+                  error_dict, records, results):
+    if result is not None:
+        results.append(result)
+    if err is None:
+        outlier_dict[fname] = outliers
+    else:
+        error_dict[fname] = err
+    if record is not None:
+        records.append(record)
@@ -0,0 +1,319 @@
+""" Timing and memory instrumentation of the outlier detection stages
+
+Instrumentation is turned on by setting the environment variable
+``FINDOUTLIE_PROFILE`` to the path of a JSON lines file, or to ``-`` for the
+standard error (see also the ``--profile`` flag of
+``scripts/find_outliers.py``).  `outfind.detect_outliers` then writes one line
+per run, such as::
+
+    {"fname": "sub-01_task-taskzero_run-01_bold.nii.gz", "pid": 1234,
+     "wall": 1.2, "cpu": 1.1, "peak_rss": 524288000, "peak_scope": "run",
+     "error": null,
+     "stages": [{"stage": "load_image", "name": null, "wall": 0.01,
+                 "cpu": 0.01, "rss": 98304000, "peak_rss": 98304000,
+                 "rss_growth": 0}, ...]}
+
+with the wall time and CPU time (seconds) of each stage: "load_image",
+"decode" (``get_fdata``), "intermediate", "cache", "metric" and "detector",
+the last ones with the intermediate, metric or detector name.  Stages nest:
+the time of a metric includes the decoding and the intermediates it
+triggered.  "rss" is the resident memory (bytes) of the process at the end of
+the stage, "peak_rss" its peak resident memory, and "rss_growth" how much the
+stage raised the peak.
+
+On Linux, the peak is reset at the start of each run (by writing "5" to
+``/proc/self/clear_refs``) and read from ``VmHWM`` in ``/proc/self/status``,
+so that "peak_rss" is the peak of the run, even in a worker process that
+handles several runs; "peak_scope" is then "run".  Elsewhere, or when the
+reset fails, "peak_rss" is the peak over the lifetime of the process
+(``ru_maxrss``), so it never goes down from one run to the next of a worker;
+"peak_scope" is then "process", and only "rss" (where available, None
+otherwise) tells the memory of the stages apart.
+`outfind.find_outliers` adds a last line with the summary of all the runs
+(see `summarize`).
+
+When the environment variable is not set, `stage` returns a shared do-nothing
+context manager, so the instrumentation costs one global lookup per stage.
+"""
+
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager, nullcontext
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Environment variable giving the output of the records
+ENV_VAR = 'FINDOUTLIE_PROFILE'
+
+# Records of the run being processed, None when not profiling
+_ACTIVE = None
+
+_NULL_STAGE = nullcontext()
+
+# Linux files giving and resetting the resident memory of the process
+_STATUS_FNAME = '/proc/self/status'
+_CLEAR_REFS_FNAME = '/proc/self/clear_refs'
+
+
+def is_enabled():
+    """ Return True if the instrumentation is turned on
+    """
+    return bool(os.environ.get(ENV_VAR))
+
+
+def enable(output='-'):
+    """ Turn on the instrumentation, in this process and its children
+
+    Parameters
+    ----------
+    output : str, optional
+        Path of the JSON lines file receiving the records, or '-' (default)
+        for the standard error.
+    """
+    os.environ[ENV_VAR] = output
+
+
+def _proc_status():
+    # Resident memory fields of /proc/self/status in bytes, {} if unavailable
+    try:
+        with open(_STATUS_FNAME) as fobj:
+            lines = fobj.readlines()
+    except OSError:
+        return {}
+    fields = {}
+    for line in lines:
+        key, _, value = line.partition(':')
+        if key in ('VmRSS', 'VmHWM'):
+            # Values in kB
+            fields[key] = int(value.split()[0]) * 1024
+    return fields
+
+
+def reset_peak_rss():
+    """ Reset the peak resident memory of the process to its current value
+
+    Only possible on Linux (writing "5" to ``/proc/self/clear_refs``).
+
+    Returns
+    -------
+    reset : bool
+        True if the peak was reset, False otherwise, in which case `peak_rss`
+        keeps returning the peak over the lifetime of the process.
+    """
+    try:
+        with open(_CLEAR_REFS_FNAME, 'w') as fobj:
+            fobj.write('5')
+    except OSError:
+        return False
+    return 'VmHWM' in _proc_status()
+
+
+def current_rss():
+    """ Return the resident memory of the process in bytes, or None
+
+    Only available on Linux (``VmRSS`` in ``/proc/self/status``).
+    """
+    return _proc_status().get('VmRSS')
+
+
+def peak_rss():
+    """ Return the peak resident memory of the process in bytes, or None
+
+    The peak since the last `reset_peak_rss` on Linux, the peak over the
+    lifetime of the process elsewhere.
+    """
+    hwm = _proc_status().get('VmHWM')
+    if hwm is not None:
+        return hwm
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+class _Stage:
+
+    def __init__(self, records, stage, name):
+        self.records = records
+        self.stage = stage
+        self.name = name
+
+    def __enter__(self):
+        self._rss = peak_rss()
+        self._cpu = time.process_time()
+        self._wall = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        wall = time.perf_counter() - self._wall
+        cpu = time.process_time() - self._cpu
+        rss = peak_rss()
+        self.records.append({
+            'stage': self.stage, 'name': self.name, 'wall': wall, 'cpu': cpu,
+            'rss': current_rss(), 'peak_rss': rss,
+            'rss_growth': None if rss is None else rss - self._rss})
+        return False
+
+
+def stage(stage_name, name=None):
+    """ Context manager recording the time and memory of a stage
+
+    Parameters
+    ----------
+    stage_name : str
+        Stage, such as "metric".
+    name : str, optional
+        Name of the metric, detector or intermediate of the stage.
+    """
+    if _ACTIVE is None:
+        return _NULL_STAGE
+    return _Stage(_ACTIVE['stages'], stage_name, name)
+
+
+@contextmanager
+def record_run(fname):
+    """ Collect the stages of the processing of run `fname`
+
+    The run record is written when the context exits.  Nested calls share the
+    record of the outermost call.  The peak resident memory is reset when the
+    context enters, where possible (see `reset_peak_rss`).
+
+    Parameters
+    ----------
+    fname : str
+        Path of the run.
+
+    Yields
+    ------
+    record : dict or None
+        Record of the run, None if the instrumentation is off.
+    """
+    global _ACTIVE
+    if _ACTIVE is not None or not is_enabled():
+        yield _ACTIVE
+        return
+    record = {'fname': fname, 'pid': os.getpid(), 'stages': [],
+              'error': None,
+              'peak_scope': 'run' if reset_peak_rss() else 'process'}
+    _ACTIVE = record
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    try:
+        yield record
+    except Exception as err:
+        record['error'] = repr(err)
+        raise
+    finally:
+        _ACTIVE = None
+        record.update(wall=time.perf_counter() - start_wall,
+                      cpu=time.process_time() - start_cpu,
+                      peak_rss=peak_rss())
+        emit(record)
+
+
+def emit(record):
+    """ Write `record` as a JSON line to the instrumentation output
+    """
+    output = os.environ.get(ENV_VAR)
+    if not output:
+        return
+    line = json.dumps(record) + '\n'
+    if output == '-':
+        sys.stderr.write(line)
+        return
+    # One write per line, so the lines of parallel workers do not mix
+    with open(output, 'a') as fobj:
+        fobj.write(line)
+
+
+def read_records(fname):
+    """ Return the records of JSON lines file `fname`, as a list of dicts
+    """
+    with open(fname) as fobj:
+        return [json.loads(line) for line in fobj if line.strip()]
+
+
+def summarize(records, n_slowest=5):
+    """ Aggregate run records over the runs
+
+    Parameters
+    ----------
+    records : sequence of dict
+        Run records, as written by `record_run`.
+    n_slowest : int, optional
+        Number of slowest runs listed, by default 5.
+
+    Returns
+    -------
+    summary : dict
+        Dictionary with keys:
+
+        * n_runs, n_errors, wall, cpu : number of runs, of failed runs, and
+          total wall and CPU times;
+        * peak_rss : largest peak resident memory of the runs;
+        * stages : list of dicts with the count, total and maximum wall time,
+          total CPU time and largest peak resident memory for each stage and
+          name, by decreasing total wall time;
+        * slowest : list of the (fname, wall) of the slowest runs.
+    """
+    stages = {}
+    for record in records:
+        for entry in record['stages']:
+            key = (entry['stage'], entry['name'])
+            agg = stages.setdefault(key, {
+                'stage': key[0], 'name': key[1], 'count': 0, 'wall': 0.,
+                'wall_max': 0., 'cpu': 0., 'peak_rss': None})
+            agg['count'] += 1
+            agg['wall'] += entry['wall']
+            agg['wall_max'] = max(agg['wall_max'], entry['wall'])
+            agg['cpu'] += entry['cpu']
+            agg['peak_rss'] = _max_or_none(agg['peak_rss'], entry['peak_rss'])
+    peak = None
+    for record in records:
+        peak = _max_or_none(peak, record['peak_rss'])
+    by_wall = sorted(records, key=lambda record: -record['wall'])
+    return {'n_runs': len(records),
+            'n_errors': sum(record['error'] is not None for record in records),
+            'wall': sum(record['wall'] for record in records),
+            'cpu': sum(record['cpu'] for record in records),
+            'peak_rss': peak,
+            'stages': sorted(stages.values(), key=lambda agg: -agg['wall']),
+            'slowest': [(record['fname'], record['wall'])
+                        for record in by_wall[:n_slowest]]}
+
+
+def _max_or_none(a, b):
+    if a is None or b is None:
+        return b if a is None else a
+    return max(a, b)
+
+
+def format_summary(summary):
+    """ Return `summary` (from `summarize`) as a printable table
+    """
+    lines = [f"{summary['n_runs']} runs ({summary['n_errors']} failed), "
+             f"wall {summary['wall']:.2f} s, cpu {summary['cpu']:.2f} s, "
+             f"peak RSS {_format_bytes(summary['peak_rss'])}",
+             f"{'stage':<36} {'count':>6} {'wall (s)':>9} {'max (s)':>8} "
+             f"{'cpu (s)':>8} {'peak RSS':>9}"]
+    for agg in summary['stages']:
+        label = agg['stage'] if agg['name'] is None else (
+            f"{agg['stage']}:{agg['name']}")
+        lines.append(f"{label:<36} {agg['count']:>6} {agg['wall']:>9.3f} "
+                     f"{agg['wall_max']:>8.3f} {agg['cpu']:>8.3f} "
+                     f"{_format_bytes(agg['peak_rss']):>9}")
+    lines.append('Slowest runs:')
+    lines.extend(f'  {wall:.3f} s {fname}'
+                 for fname, wall in summary['slowest'])
+    return '\n'.join(lines)
+
+
+def _format_bytes(n_bytes):
+    if n_bytes is None:
+        return '-'
+    return f'{n_bytes / 2 ** 20:.0f} MB'
@@ -0,0 +1,214 @@
+""" Registry of the metrics, detectors and shared intermediates
+
+Metrics and detectors are registered with the `register_metric` and
+`register_detector` decorators, and looked up by name with `get_metric` and
+`get_detector`.  Each metric declares its cost profile in a `MetricSpec`:
+
+* ``offset``: index of the volume matching the first metric value (1 for
+  dvars);
+* ``streamable``: True if the metric can be computed reading one volume at a
+  time;
+* ``needs``: names of the shared intermediates (such as the mean map) the
+  metric receives as keyword arguments.
+
+Intermediates are registered with `register_intermediate`, computed once per
+run by `data_load.RunData.intermediate` and shared by all the metrics needing
+them.  `plan_passes` uses the specs to order the metrics, so that the
+intermediates are kept in memory only while the metrics needing them are
+computed.
+
+The plan does not fuse the reads of the data: each intermediate, and each
+streamable metric without intermediates, reads the volumes on its own.  The
+metrics read the run once when they share an intermediate, as dvars, the
+coefficient of variation, tsnr and the DVARS variants share "run_stats".
+
+Other packages can add metrics and detectors without changing this one, by
+declaring entry points in the ``findoutlie.metrics`` and
+``findoutlie.detectors`` groups.  The entry point can be a module registering
+its functions with the decorators, or a function, registered under the entry
+point name with the default spec.  For example, in a ``pyproject.toml``::
+
+    [project.entry-points."findoutlie.metrics"]
+    site_metric = "site_package.metrics:site_metric"
+"""
+
+from collections import namedtuple
+
+MetricSpec = namedtuple('MetricSpec', ['name', 'func', 'offset', 'streamable',
+                                       'needs'])
+
+METRICS = {}
+DETECTORS = {}
+INTERMEDIATES = {}
+
+METRICS_GROUP = 'findoutlie.metrics'
+DETECTORS_GROUP = 'findoutlie.detectors'
+
+_loaded = False
+
+
+def register_metric(name=None, offset=0, streamable=False, needs=()):
+    """ Decorator registering a metric function
+
+    Parameters
+    ----------
+    name : str, optional
+        Name of the metric, by default the function name.
+    offset : int, optional
+        Index of the volume matching the first metric value, by default 0.
+    streamable : bool, optional
+        True if the metric reads the volumes one at a time, by default False.
+    needs : sequence of str, optional
+        Names of the intermediates passed to the metric as keyword arguments.
+
+    Returns
+    -------
+    decorator : callable
+        Decorator registering the function and returning it unchanged.
+    """
+    def decorator(func):
+        metric_name = func.__name__ if name is None else name
+        METRICS[metric_name] = MetricSpec(metric_name, func, offset,
+                                          streamable, tuple(needs))
+        return func
+    return decorator
+
+
+def register_detector(name=None):
+    """ Decorator registering a detector function
+
+    Parameters
+    ----------
+    name : str, optional
+        Name of the detector, by default the function name.
+    """
+    def decorator(func):
+        DETECTORS[func.__name__ if name is None else name] = func
+        return func
+    return decorator
+
+
+def register_intermediate(name=None):
+    """ Decorator registering a function computing a shared intermediate
+
+    The function takes the run (a `data_load.RunData`) and returns the
+    intermediate value.
+
+    Parameters
+    ----------
+    name : str, optional
+        Name of the intermediate, by default the function name.
+    """
+    def decorator(func):
+        INTERMEDIATES[func.__name__ if name is None else name] = func
+        return func
+    return decorator
+
+
+def _entry_points(group):
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:  # Python < 3.8
+        return []
+    eps = entry_points()
+    if hasattr(eps, 'select'):
+        return eps.select(group=group)
+    return eps.get(group, [])
+
+
+def load_plugins():
+    """ Register the built-in metrics and detectors, and the plugins
+
+    Only done once; called by the lookup functions.
+    """
+    global _loaded
+    if _loaded:
+        return
+    _loaded = True
+    # Import the built-in modules for their registration side effects
+    import findoutlie.detectors  # noqa: F401
+    import findoutlie.metrics  # noqa: F401
+    for group, registry, register in ((METRICS_GROUP, METRICS,
+                                       register_metric),
+                                      (DETECTORS_GROUP, DETECTORS,
+                                       register_detector)):
+        for entry_point in _entry_points(group):
+            obj = entry_point.load()
+            if callable(obj) and entry_point.name not in registry:
+                register(entry_point.name)(obj)
+
+
+def get_metric(name):
+    """ Return the `MetricSpec` of metric `name`
+
+    Raises
+    ------
+    ValueError
+        No metric is registered under `name`.
+    """
+    load_plugins()
+    try:
+        return METRICS[name]
+    except KeyError:
+        raise ValueError(f'Unknown metric "{name}", expected one of '
+                         f'{sorted(METRICS)}') from None
+
+
+def get_detector(name):
+    """ Return the detector function registered under `name`
+
+    Raises
+    ------
+    ValueError
+        No detector is registered under `name`.
+    """
+    load_plugins()
+    try:
+        return DETECTORS[name]
+    except KeyError:
+        raise ValueError(f'Unknown detector "{name}", expected one of '
+                         f'{sorted(DETECTORS)}') from None
+
+
+def get_intermediate(name):
+    """ Return the function computing intermediate `name`
+    """
+    load_plugins()
+    try:
+        return INTERMEDIATES[name]
+    except KeyError:
+        raise ValueError(f'Unknown intermediate "{name}", expected one of '
+                         f'{sorted(INTERMEDIATES)}') from None
+
+
+def plan_passes(metric_names):
+    """ Group metrics into the steps of their computation
+
+    The streamable metrics, which read the volumes one at a time and do not
+    need the decoded data, come first, in one group.  This is not a single
+    read of the data: each of their intermediates, and each of them without
+    intermediates, reads the volumes once (see the module docstring).  The
+    other metrics are grouped by the intermediates they need, so that each
+    intermediate is only kept in memory while the metrics using it are
+    computed.
+
+    Parameters
+    ----------
+    metric_names : sequence of str
+        Names of the metrics to compute.
+
+    Returns
+    -------
+    passes : list of list of str
+        Metric names of each group, in order.  Each metric appears once.
+    """
+    specs = [get_metric(name) for name in dict.fromkeys(metric_names)]
+    streamed = [spec.name for spec in specs if spec.streamable]
+    groups = {}
+    for spec in specs:
+        if not spec.streamable:
+            groups.setdefault(tuple(sorted(spec.needs)), []).append(spec.name)
+    passes = [streamed] if streamed else []
+    # Metrics without intermediates first, then by intermediates
+    passes.extend(groups[needs] for needs in sorted(groups))
+    return passes
@@ -0,0 +1,385 @@
+""" Columnar store of the outlier detection results
+
+The results of each run are one row, with:
+
+* the run metadata: "fname", the BIDS entities "sub", "ses", "task" and "run",
+  "n_timepoints", "dtype" (decoding float type), "version" (package version)
+  and "error" (None, or the error of a failed run);
+* "metrics": dict of the metric values, by metric name;
+* "masks": dict of the (n_timepoints,) boolean outlier masks of the
+  detectors, by (metric name, detector name);
+* "outliers": the (n_timepoints,) boolean consensus mask.
+
+The rows are stored column by column, each array column as one flat array of
+the values of all the rows and the offsets of the rows in it.  The store is a
+Parquet file when the name ends with ``.parquet`` (needs ``pyarrow``), and
+otherwise a zip of ``.npy`` arrays, as written by ``np.savez``, with one group
+of members per batch of rows.  `ResultsWriter` appends the rows in batches;
+`load_results` reads the rows of a subset of the runs, and only the requested
+metric columns.
+"""
+
+import json
+import os
+import os.path as op
+import zipfile
+
+import numpy as np
+
+from findoutlie import __version__
+from findoutlie.dataset_index import (BIDS_ENTITIES, _matches,
+                                      parse_bids_entities)
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+# Scalar columns, one value per run
+META_COLUMNS = ('fname',) + BIDS_ENTITIES + ('n_timepoints', 'dtype',
+                                             'version', 'error')
+
+# Default number of rows written together
+BATCH_SIZE = 64
+
+
+def run_result(fname, metric_values=None, masks=None, outliers=None,
+               dtype=None, error=None):
+    """ Return the results row of run `fname`
+
+    Parameters
+    ----------
+    fname : str
+        Path of the run.
+    metric_values : dict, optional
+        Metric values (arrays), by metric name.
+    masks : dict, optional
+        Boolean outlier masks, by (metric name, detector name).
+    outliers : array, optional
+        Boolean consensus outlier mask.
+    dtype : str, optional
+        Float type the data was decoded to.
+    error : Exception or str, optional
+        Error of a failed run.
+
+    Returns
+    -------
+    row : dict
+        Results of the run (see module docstring).
+    """
+    entities = parse_bids_entities(fname)
+    outliers = np.zeros(0, dtype=bool) if outliers is None else outliers
+    if error is not None and not isinstance(error, str):
+        error = repr(error)
+    row = {'fname': fname, 'n_timepoints': len(outliers), 'dtype': dtype,
+           'version': __version__, 'error': error}
+    row.update((key, entities[key]) for key in BIDS_ENTITIES)
+    row['metrics'] = {name: np.asarray(values, dtype=np.float64)
+                      for name, values in (metric_values or {}).items()}
+    row['masks'] = {key: np.asarray(mask, dtype=bool)
+                    for key, mask in (masks or {}).items()}
+    row['outliers'] = np.asarray(outliers, dtype=bool)
+    return row
+
+
+def _array_columns(row):
+    # Array columns of `row`, by column name
+    columns = {}
+    for name, values in row['metrics'].items():
+        columns[f'metric:{name}'] = values.reshape(-1)
+        columns[f'metric_shape:{name}'] = np.array(values.shape,
+                                                   dtype=np.int64)
+    for (metric_name, detector_name), mask in row['masks'].items():
+        columns[f'mask:{metric_name}:{detector_name}'] = mask
+    columns['outliers'] = row['outliers']
+    return columns
+
+
+def _to_columns(rows):
+    """ Return the metadata columns and the (values, offsets) array columns
+    """
+    meta = {name: [row[name] for row in rows] for name in META_COLUMNS}
+    row_arrays = [_array_columns(row) for row in rows]
+    names = sorted(set().union(*row_arrays))
+    arrays = {}
+    for name in names:
+        parts = [columns.get(name, np.zeros(0)) for columns in row_arrays]
+        offsets = np.zeros(len(parts) + 1, dtype=np.int64)
+        np.cumsum([len(part) for part in parts], out=offsets[1:])
+        dtype = _column_dtype(name)
+        values = (np.concatenate(parts).astype(dtype) if offsets[-1]
+                  else np.zeros(0, dtype=dtype))
+        arrays[name] = values, offsets
+    return meta, arrays
+
+
+def _column_dtype(name):
+    if name.startswith('metric_shape:'):
+        return np.int64
+    if name.startswith('metric:'):
+        return np.float64
+    return bool
+
+
+def _from_columns(meta, arrays, indices):
+    """ Return the rows at `indices` of metadata and array columns
+    """
+    rows = []
+    for i in indices:
+        row = {name: meta[name][i] for name in META_COLUMNS}
+        row.update(metrics={}, masks={})
+        shapes = {}
+        for name, (values, offsets) in arrays.items():
+            value = values[offsets[i]:offsets[i + 1]]
+            kind, _, key = name.partition(':')
+            if kind == 'metric':
+                row['metrics'][key] = value
+            elif kind == 'metric_shape':
+                shapes[key] = tuple(value)
+            elif kind == 'mask':
+                row['masks'][tuple(key.rsplit(':', 1))] = value
+            else:
+                row[name] = value
+        for key, shape in shapes.items():
+            if key in row['metrics']:
+                row['metrics'][key] = row['metrics'][key].reshape(shape)
+        rows.append(row)
+    return rows
+
+
+def _is_parquet(path):
+    return path.endswith('.parquet')
+
+
+def _check_pyarrow():
+    if pa is None:
+        raise ImportError('Writing or reading Parquet results needs pyarrow; '
+                          'use a results file ending in .npz instead')
+
+
+class _NpzBatches:
+    """ Zip of ``.npy`` members, one ``batch-<n>/`` group per batch of rows
+    """
+
+    def __init__(self, path, mode):
+        self.path = path
+        if mode == 'w' and op.exists(path):
+            os.remove(path)
+
+    def write(self, meta, arrays):
+        with zipfile.ZipFile(self.path, 'a') as zip_file:
+            prefix = f'batch-{len(_npz_batches(zip_file)):06d}/'
+            zip_file.writestr(prefix + 'meta.json', json.dumps(meta))
+            for name, (values, offsets) in arrays.items():
+                _write_npy(zip_file, f'{prefix}{name}.values.npy', values)
+                _write_npy(zip_file, f'{prefix}{name}.offsets.npy', offsets)
+
+    def close(self):
+        pass
+
+
+def _write_npy(zip_file, name, array):
+    with zip_file.open(name, 'w') as fobj:
+        np.lib.format.write_array(fobj, np.ascontiguousarray(array))
+
+
+def _read_npy(zip_file, name):
+    with zip_file.open(name) as fobj:
+        return np.lib.format.read_array(fobj)
+
+
+def _read_column(zip_file, member_root):
+    # Values and offsets of an array column
+    return (_read_npy(zip_file, member_root + '.values.npy'),
+            _read_npy(zip_file, member_root + '.offsets.npy'))
+
+
+def _npz_batches(zip_file):
+    # Batch prefixes, in order, with the array column names of each batch
+    batches = {}
+    for name in zip_file.namelist():
+        prefix, _, member = name.partition('/')
+        columns = batches.setdefault(prefix, [])
+        if member.endswith('.values.npy'):
+            columns.append(member[:-len('.values.npy')])
+    return dict(sorted(batches.items()))
+
+
+class _ParquetBatches:
+    """ Parquet file, one row group per batch of rows
+
+    The file is written under a temporary name and renamed when closed, so
+    readers never see a partial file.  When appending, the rows already in
+    the file are copied first.
+    """
+
+    def __init__(self, path, mode):
+        _check_pyarrow()
+        self.path = path
+        self.tmp_path = f'{path}.{os.getpid()}.tmp'
+        self.writer = None
+        self.previous = (pq.read_table(path) if mode == 'a' and op.isfile(path)
+                         else None)
+
+    def write(self, meta, arrays):
+        columns = {name: pa.array(meta[name], type=_arrow_meta_type(name))
+                   for name in META_COLUMNS}
+        for name, (values, offsets) in arrays.items():
+            columns[name] = pa.ListArray.from_arrays(pa.array(offsets),
+                                                     pa.array(values))
+        table = pa.table(columns)
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.tmp_path, table.schema)
+            if self.previous is not None:
+                self._write_table(self.previous)
+        self._write_table(table)
+
+    def _write_table(self, table):
+        if table.schema.names != self.writer.schema.names:
+            raise ValueError('All the runs of a Parquet results file need '
+                             'the same metrics and detectors')
+        self.writer.write_table(table.cast(self.writer.schema))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            os.replace(self.tmp_path, self.path)
+            self.writer = None
+
+
+def _arrow_meta_type(name):
+    return pa.int64() if name == 'n_timepoints' else pa.string()
+
+
+class ResultsWriter:
+    """ Write results rows to a columnar file, in batches
+
+    Parameters
+    ----------
+    path : str
+        Results file.  A Parquet file if the name ends with ``.parquet``,
+        otherwise a zip of ``.npy`` arrays (such as ``results.npz``).
+    batch_size : int, optional
+        Number of rows written together, by default 64.
+    mode : {'w', 'a'}, optional
+        'w' (default) to replace an existing file, 'a' to add rows to it.
+
+    Notes
+    -----
+    Each batch of the ``.npz`` store is written to the file at once.  A
+    Parquet file is only complete when the writer is closed, and all its rows
+    need the same metrics and detectors.
+    """
+
+    def __init__(self, path, batch_size=BATCH_SIZE, mode='w'):
+        if mode not in ('w', 'a'):
+            raise ValueError(f"mode should be 'w' or 'a', not {mode!r}")
+        self.path = path
+        self.batch_size = batch_size
+        batches_class = _ParquetBatches if _is_parquet(path) else _NpzBatches
+        self._batches = batches_class(path, mode)
+        self._pending = []
+
+    def append(self, row):
+        """ Add results row `row` (see `run_result`)
+        """
+        self._pending.append(row)
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """ Write the rows not written yet
+        """
+        if self._pending:
+            self._batches.write(*_to_columns(self._pending))
+            self._pending = []
+
+    def close(self):
+        """ Write the remaining rows and finalize the file
+        """
+        self.flush()
+        self._batches.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+
+def _select(meta, fnames, filters):
+    fnames = None if fnames is None else set(fnames)
+    return [i for i, fname in enumerate(meta['fname'])
+            if (fnames is None or fname in fnames)
+            and all(_matches(meta[key][i], value)
+                    for key, value in filters.items())]
+
+
+def _wanted(name, metrics):
+    # Whether array column `name` is needed for the metrics `metrics`
+    if metrics is None or name == 'outliers':
+        return True
+    return name.split(':')[1] in metrics
+
+
+def load_results(path, fnames=None, metrics=None, **filters):
+    """ Load the results rows of a subset of the runs
+
+    Parameters
+    ----------
+    path : str
+        Results file, written by `ResultsWriter`.
+    fnames : sequence of str, optional
+        Paths of the runs to load, by default all the runs.
+    metrics : sequence of str, optional
+        Names of the metrics whose values and detector masks are loaded, by
+        default all.  The other metric columns are not read.
+    **filters
+        Values of the BIDS entities, for instance ``sub=1, task='taskzero'``.
+
+    Returns
+    -------
+    rows : list of dict
+        Results of the selected runs (see `run_result`), in the order they
+        were written.
+    """
+    if metrics is not None:
+        metrics = set(metrics)
+    if _is_parquet(path):
+        return _load_parquet(path, fnames, metrics, filters)
+    rows = []
+    with zipfile.ZipFile(path) as zip_file:
+        for prefix, names in _npz_batches(zip_file).items():
+            meta = json.loads(zip_file.read(f'{prefix}/meta.json'))
+            indices = _select(meta, fnames, filters)
+            if not indices:
+                continue
+            arrays = {name: _read_column(zip_file, f'{prefix}/{name}')
+                      for name in names if _wanted(name, metrics)}
+            rows.extend(_from_columns(meta, arrays, indices))
+    return rows
+
+
+def _load_parquet(path, fnames, metrics, filters):
+    _check_pyarrow()
+    meta_table = pq.read_table(path, columns=list(META_COLUMNS))
+    meta = meta_table.to_pydict()
+    indices = _select(meta, fnames, filters)
+    if not indices:
+        return []
+    names = [name for name in pq.read_schema(path).names
+             if name not in META_COLUMNS and _wanted(name, metrics)]
+    # Only the row groups holding the selected runs are read
+    selected = [meta['fname'][i] for i in indices]
+    table = pq.read_table(path, columns=list(META_COLUMNS) + names,
+                          filters=[('fname', 'in', selected)])
+    arrays = {}
+    for name in names:
+        column = table.column(name).combine_chunks()
+        offsets = column.offsets.to_numpy()
+        values = column.flatten().to_numpy(zero_copy_only=False)
+        arrays[name] = values, offsets - offsets[0]
+    return _from_columns(table.select(list(META_COLUMNS)).to_pydict(), arrays,
+                         range(table.num_rows))
@@ -0,0 +1,233 @@
+""" Fused statistics over the volumes of a functional run
+
+`run_stats` reads each volume once and accumulates, in the same pass:
+
+* the per-voxel temporal moments (Welford algorithm), giving the mean map, the
+  standard deviation map and the tSNR map;
+* the per-volume moments, giving the coefficient of variation of each volume;
+* the difference with the previous volume, giving dvars and, summed per
+  slice, the per-slice dvars of `dvars_engine.compute_dvars`;
+* the per-voxel minimum and maximum, giving the histogram bins of
+  `temporal_entropy`.
+
+Only a few volume-sized arrays are kept in memory, whatever the number of
+volumes.  The volumes are read in their native float type, and the moments
+accumulated in float64.  With a brain mask, only the brain voxels of each
+volume are used.
+
+`tsnr` and `temporal_entropy` give voxelwise maps with their average over the
+voxels, as `MapSummary` named tuples.  The temporal Shannon entropy of each
+voxel (DiNuzzo et al. 2003) comes from a fixed-bin histogram of its values,
+built up volume by volume for all the voxels at once, so the memory scales
+with the number of voxels times the number of bins.
+"""
+
+from collections import namedtuple
+
+import numpy as np
+
+from findoutlie.data_load import ACCUM_DTYPE, float_dtype, volume_source
+
+RunStats = namedtuple('RunStats', ['mean_map', 'sd_map', 'tsnr_map', 'cv',
+                                   'dvars', 'min_map', 'max_map',
+                                   'slice_dvars', 'mean_var'])
+
+MapSummary = namedtuple('MapSummary', ['map', 'summary'])
+
+# Number of voxels whose entropy is computed together from the bin counts
+ENTROPY_CHUNK = 2 ** 16
+
+
+def run_stats(img, mask=None, slice_axis=2):
+    """ Compute temporal maps and per-volume statistics in one pass
+
+    Parameters
+    ----------
+    img : nibabel image, RunData or numpy array
+        Functional 4D image.  Volumes are read one at a time through
+        ``img.dataobj`` when available.
+    mask : BrainMask, optional
+        If given, the statistics are computed on the brain voxels only, and
+        the maps are 0 outside the brain.
+    slice_axis : int, optional
+        Axis of the slices of `slice_dvars`, by default 2.
+
+    Returns
+    -------
+    stats : RunStats
+        Named tuple with fields:
+
+        * mean_map : 3D array, mean of each voxel over time;
+        * sd_map : 3D array, standard deviation of each voxel over time;
+        * tsnr_map : 3D array, mean map divided by sd map (0 where the
+          standard deviation is 0);
+        * cv : 1D array (n), coefficient of variation of each volume;
+        * dvars : 1D array (n - 1), dvars between consecutive volumes;
+        * min_map, max_map : 3D arrays, minimum and maximum of each voxel over
+          time;
+        * slice_dvars : 2D array (n_slices x n - 1), dvars computed on each
+          slice, NaN for the slices without voxels;
+        * mean_var : average over the voxels of the temporal variance.
+    """
+    dataobj = volume_source(img)
+    dtype = float_dtype(img)
+    n_trs = dataobj.shape[-1]
+    vol_shape = dataobj.shape[:-1]
+    map_shape = vol_shape if mask is None else (mask.n_voxels,)
+    n_slices = vol_shape[slice_axis]
+    if mask is None:
+        other_axes = tuple(axis for axis in range(len(vol_shape))
+                           if axis != slice_axis)
+        slice_counts = np.full(n_slices, np.prod(vol_shape) // n_slices)
+    else:
+        # Slice of each brain voxel, from its index in the C-ordered volume
+        stride = int(np.prod(vol_shape[slice_axis + 1:]))
+        slice_labels = (mask.indices // stride) % n_slices
+        slice_counts = np.bincount(slice_labels, minlength=n_slices)
+    slice_sq = np.zeros((n_slices, n_trs - 1))
+    mean_map = np.zeros(map_shape, dtype=ACCUM_DTYPE)
+    m2_map = np.zeros(map_shape, dtype=ACCUM_DTYPE)
+    vol_means = np.zeros(n_trs)
+    vol_sds = np.zeros(n_trs)
+    min_map = np.full(map_shape, np.inf, dtype=dtype)
+    max_map = np.full(map_shape, -np.inf, dtype=dtype)
+    prev_vol = None
+    for i in range(n_trs):
+        vol = np.asarray(dataobj[..., i], dtype=dtype)
+        if mask is not None:
+            vol = mask.compact_volume(vol)
+        np.minimum(min_map, vol, out=min_map)
+        np.maximum(max_map, vol, out=max_map)
+        # Welford update of the per-voxel temporal moments
+        delta = vol - mean_map
+        mean_map += delta / (i + 1)
+        m2_map += delta * (vol - mean_map)
+        # Per-volume moments
+        vol_means[i] = np.mean(vol, dtype=ACCUM_DTYPE)
+        vol_sds[i] = np.sqrt(np.mean((vol - vol_means[i]) ** 2,
+                                     dtype=ACCUM_DTYPE))
+        if prev_vol is not None:
+            sq_diff = (vol - prev_vol) ** 2
+            if mask is None:
+                slice_sq[:, i - 1] = np.sum(sq_diff, axis=other_axes,
+                                            dtype=ACCUM_DTYPE)
+            else:
+                slice_sq[:, i - 1] = np.bincount(slice_labels,
+                                                 weights=sq_diff,
+                                                 minlength=n_slices)
+        prev_vol = vol
+    n_voxels = np.sum(slice_counts)
+    dvals = np.sqrt(slice_sq.sum(axis=0) / n_voxels)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        slice_dvals = np.sqrt(slice_sq / slice_counts[:, None])
+    mean_var = np.mean(m2_map) / n_trs
+    sd_map = np.sqrt(m2_map / n_trs)
+    tsnr_map = np.divide(mean_map, sd_map, out=np.zeros_like(mean_map),
+                         where=sd_map > 0)
+    if mask is not None:
+        mean_map, sd_map, tsnr_map, min_map, max_map = [
+            mask.expand(values) for values in
+            (mean_map, sd_map, tsnr_map, min_map, max_map)]
+    return RunStats(mean_map, sd_map, tsnr_map, vol_sds / vol_means, dvals,
+                    min_map, max_map, slice_dvals, mean_var)
+
+
+def _brain_values(map_3d, mask):
+    if mask is None:
+        return np.reshape(map_3d, -1)
+    return mask.compact_volume(map_3d)
+
+
+def tsnr(img, mask=None, stats=None):
+    """ Temporal signal to noise ratio map of `img` and its average
+
+    The tSNR of a voxel is its temporal mean divided by its temporal standard
+    deviation (Kruger & Glover 2001), from the streaming moments of
+    `run_stats`.
+
+    Parameters
+    ----------
+    img : nibabel image, RunData or numpy array
+        Functional 4D image.
+    mask : BrainMask, optional
+        If given, only the brain voxels are used.
+    stats : RunStats, optional
+        Output of ``run_stats(img, mask)``, computed if not given.
+
+    Returns
+    -------
+    tsnr : MapSummary
+        Named tuple with fields map (3D array, 0 where the standard deviation
+        is 0 and outside the mask) and summary (mean tSNR of the voxels with
+        non-zero standard deviation).
+    """
+    if stats is None:
+        stats = run_stats(img, mask)
+    tsnr_values = _brain_values(stats.tsnr_map, mask)
+    varying = _brain_values(stats.sd_map, mask) > 0
+    summary = np.mean(tsnr_values[varying]) if np.any(varying) else np.nan
+    return MapSummary(stats.tsnr_map, float(summary))
+
+
+def temporal_entropy(img, n_bins=None, mask=None, stats=None):
+    """ Voxelwise temporal Shannon entropy map of `img` and its average
+
+    The values of each voxel over time are binned in `n_bins` equal bins
+    between the voxel minimum and maximum, as ``np.histogram`` does, and the
+    entropy of the bin frequencies is ``-sum(p * log2(p))`` bits.  A voxel
+    with constant values has entropy 0.
+
+    The bin counts of all the voxels are updated for each volume in turn,
+    needing one pass over the data after the minimum and maximum maps of
+    `run_stats`.
+
+    Parameters
+    ----------
+    img : nibabel image, RunData or numpy array
+        Functional 4D image.
+    n_bins : int, optional
+        Number of histogram bins, by default the square root of the number of
+        volumes, rounded up.
+    mask : BrainMask, optional
+        If given, only the brain voxels are used.
+    stats : RunStats, optional
+        Output of ``run_stats(img, mask)``, computed if not given.
+
+    Returns
+    -------
+    entropy : MapSummary
+        Named tuple with fields map (3D array of entropies in bits, 0 outside
+        the mask) and summary (mean entropy of the voxels).
+    """
+    if stats is None:
+        stats = run_stats(img, mask)
+    dataobj = volume_source(img)
+    dtype = float_dtype(img)
+    n_trs = dataobj.shape[-1]
+    if n_bins is None:
+        n_bins = int(np.ceil(np.sqrt(n_trs)))
+    mins = _brain_values(stats.min_map, mask).astype(ACCUM_DTYPE)
+    ranges = _brain_values(stats.max_map, mask) - mins
+    scales = np.divide(n_bins, ranges, out=np.zeros_like(ranges),
+                       where=ranges > 0)
+    n_voxels = len(mins)
+    count_dtype = np.uint16 if n_trs < 2 ** 16 else np.uint32
+    counts = np.zeros((n_voxels, n_bins), dtype=count_dtype)
+    # Index of the first bin of each voxel in the flattened counts
+    offsets = np.arange(n_voxels) * n_bins
+    flat_counts = counts.reshape(-1)
+    for i in range(n_trs):
+        vol = _brain_values(np.asarray(dataobj[..., i], dtype=dtype), mask)
+        bins = ((vol - mins) * scales).astype(np.intp)
+        # The maximum goes in the last bin
+        np.clip(bins, 0, n_bins - 1, out=bins)
+        flat_counts[offsets + bins] += 1
+    entropies = np.zeros(n_voxels)
+    for start in range(0, n_voxels, ENTROPY_CHUNK):
+        p = counts[start:start + ENTROPY_CHUNK] / n_trs
+        plogp = p * np.log2(p, out=np.zeros_like(p), where=p > 0)
+        entropies[start:start + ENTROPY_CHUNK] = -np.sum(plogp, axis=1)
+    entropy_map = (entropies.reshape(dataobj.shape[:-1]) if mask is None
+                   else mask.expand(entropies))
+    summary = np.mean(entropies) if n_voxels else np.nan
+    return MapSummary(entropy_map, float(summary))
@@ -0,0 +1,46 @@
+""" Shared test configuration
+"""
+
+import os
+
+import numpy as np
+
+import nibabel as nib
+
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def user_cache(tmp_path_factory):
+    # Keep the dataset indexes of the tests out of the user cache directory.
+    # Own patcher, so that ``monkeypatch.undo()`` in a test keeps it.
+    cache_dir = tmp_path_factory.mktemp('user_cache')
+    with pytest.MonkeyPatch.context() as patcher:
+        patcher.setenv('XDG_CACHE_HOME', str(cache_dir))
+        yield cache_dir
+
+
+def _make_dataset(data_directory, n_subs=3, shape=(6, 7, 5, 20)):
+    """ Write a small BIDS-like dataset with a spike in every run
+    """
+    rng = np.random.default_rng(0)
+    fnames = []
+    for sub in range(1, n_subs + 1):
+        func_dir = os.path.join(data_directory, 'group-00', f'sub-{sub:02d}',
+                                'func')
+        os.makedirs(func_dir)
+        data = rng.normal(100, 1, size=shape)
+        data[..., 10] += 50
+        fname = os.path.join(
+            func_dir, f'sub-{sub:02d}_task-taskzero_run-01_bold.nii.gz')
+        nib.save(nib.Nifti1Image(data.astype(np.float32), np.eye(4)), fname)
+        fnames.append(fname)
+    return fnames
+
+
+@pytest.fixture
+def make_dataset():
+    """ Function writing a small dataset: ``make_dataset(data_directory,
+    n_subs=3, shape=(6, 7, 5, 20))`` returns the paths of the runs
+    """
+    return _make_dataset
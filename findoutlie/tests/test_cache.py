@@ -0,0 +1,112 @@
+""" Test on-disk caches
+
+You can run the tests from the root directory (containing ``README.md``) with::
+
+    python3 -m pytest .
+"""
+
+import hashlib
+import os
+
+import numpy as np
+
+import nibabel as nib
+
+import findoutlie.cache as cache_module
+import findoutlie.metrics as metrics
+from findoutlie.cache import DecodeCache, MetricCache, file_hash
+from findoutlie.data_load import load_image
+from findoutlie.outfind import detect_outliers
+
+
+def test_file_hash(tmp_path):
+    fname = str(tmp_path / 'some_file.bin')
+    contents = os.urandom(10000)
+    with open(fname, 'wb') as fobj:
+        fobj.write(contents)
+    expected = hashlib.sha1(contents).hexdigest()
+    assert file_hash(fname) == expected
+    assert file_hash(fname, chunk_size=333) == expected
+
+
+def test_metric_cache(tmp_path, make_dataset):
+    fname, = make_dataset(str(tmp_path / 'data'), n_subs=1)
+    cache = MetricCache(str(tmp_path / 'cache'))
+    assert cache.get(fname, 'dvars') is None
+    values = np.arange(10.)
+    cache.put(fname, 'dvars', values)
+    assert np.all(cache.get(fname, 'dvars') == values)
+    # Arguments are part of the key
+    assert cache.get(fname, 'dvars', chunk_size=2) is None
+    assert cache.get(fname, 'coefficient_of_variation') is None
+
+
+def test_metric_cache_eviction(tmp_path, make_dataset):
+    fname, = make_dataset(str(tmp_path / 'data'), n_subs=1)
+    # Room for about two entries
+    cache = MetricCache(str(tmp_path / 'cache'), max_bytes=2000)
+    for i in range(4):
+        cache.put(fname, 'dvars', np.zeros(100), i=i)
+    assert len([name for name in os.listdir(cache.cache_dir)
+                if name.endswith('.npy')]) == 2
+    assert cache.get(fname, 'dvars', i=0) is None
+    assert cache.get(fname, 'dvars', i=3) is not None
+
+
+def test_detect_outliers_cache(tmp_path, monkeypatch, make_dataset):
+    fname, = make_dataset(str(tmp_path / 'data'), n_subs=1)
+    cache = MetricCache(str(tmp_path / 'cache'))
+    outliers = detect_outliers(fname, cache=cache)
+
+    # The second call must not compute any metric
+    def no_compute(*args, **kwargs):
+        raise AssertionError('metric computed instead of read from cache')
+
+    monkeypatch.setattr(metrics, 'compute_metric', no_compute)
+    assert detect_outliers(fname, cache=cache) == outliers
+
+    # In a new process, the image is neither loaded nor hashed again
+    def no_read(*args, **kwargs):
+        raise AssertionError('run file read with all metrics cached')
+
+    monkeypatch.setattr(cache_module, '_HASH_MEMO', {})
+    monkeypatch.setattr(cache_module, 'file_hash', no_read)
+    monkeypatch.setattr(nib, 'load', no_read)
+    assert detect_outliers(fname, cache=MetricCache(cache.cache_dir)) == \
+        outliers
+    monkeypatch.undo()
+
+    # A modified run is hashed again
+    img = nib.load(fname)
+    nib.save(nib.Nifti1Image(img.get_fdata() + 1, img.affine), fname)
+    assert cache.get_info(fname, dtype=None, use_mask=True) is None
+
+
+def test_decode_cache(tmp_path, monkeypatch, make_dataset):
+    fnames = make_dataset(str(tmp_path / 'data'), n_subs=2)
+    cache = DecodeCache(str(tmp_path / 'decoded'))
+    img = load_image(fnames[0], decode_cache=cache)
+    expected = nib.load(fnames[0]).get_fdata()
+    assert img.get_filename().endswith('.nii')
+    assert np.all(img.get_fdata() == expected)
+    assert isinstance(np.asanyarray(img.dataobj), np.memmap)
+    assert detect_outliers(fnames[0], decode_cache=cache) == \
+        detect_outliers(fnames[0])
+
+    # Second load does not decompress the gzipped file
+    def no_gzip_load(fname, *args, **kwargs):
+        assert not fname.endswith('.gz')
+        return orig_load(fname, *args, **kwargs)
+
+    orig_load = nib.load
+    monkeypatch.setattr(nib, 'load', no_gzip_load)
+    assert np.all(load_image(fnames[0], decode_cache=cache).get_fdata()
+                  == expected)
+    monkeypatch.undo()
+
+    # Eviction keeps the most recently used copy only
+    size = os.path.getsize(cache.get_path(fnames[0]))
+    small_cache = DecodeCache(cache.cache_dir, max_bytes=int(size * 1.5))
+    small_cache.get_path(fnames[1])
+    assert os.listdir(cache.cache_dir) == [
+        os.path.basename(small_cache.get_path(fnames[1]))]
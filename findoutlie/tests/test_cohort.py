@@ -0,0 +1,108 @@
+""" Test cohort outlier detection
+
+You can run the tests from the root directory (containing ``README.md``) with::
+
+    python3 -m pytest .
+"""
+
+import os
+
+import numpy as np
+
+import pytest
+
+import nibabel as nib
+
+from findoutlie.cohort import (detect_cohort_outliers, find_cohort_outliers,
+                               stack_series)
+from findoutlie.detectors import iqr_detector
+
+
+def test_stack_series():
+    stacked = stack_series([np.arange(3), np.arange(4), np.arange(2)],
+                           offsets=[1, 0, 0])
+    assert stacked.shape == (3, 4)
+    assert np.allclose(stacked[0], [np.nan, 0, 1, 2], equal_nan=True)
+    assert np.allclose(stacked[1], [0, 1, 2, 3])
+    assert np.allclose(stacked[2], [0, 1, np.nan, np.nan], equal_nan=True)
+
+
+def test_detect_cohort_outliers():
+    rng = np.random.default_rng(0)
+    stacked = rng.normal(10, 1, size=(12, 30))
+    stacked[:, :2] = np.nan
+    # One run with a single spike, and one shifted run
+    stacked[3, 10] = 30
+    stacked[7] += 10
+    groups = np.repeat(['a', 'b', 'c', 'd', 'e', 'f'], 2)
+    outliers = detect_cohort_outliers(stacked, groups)
+    assert not np.any(outliers.frames[:, :2])
+    assert outliers.frames[3, 10]
+    assert np.all(outliers.frames[7, 2:])
+    valid = ~np.isnan(stacked)
+    assert np.all(outliers.frames[valid] == iqr_detector(stacked[valid]))
+    assert np.all(np.where(outliers.runs)[0] == [7])
+    assert list(outliers.group_labels) == ['a', 'b', 'c', 'd', 'e', 'f']
+    assert np.all(np.where(outliers.groups)[0] == [3])
+
+
+def test_find_cohort_outliers(tmp_path, make_dataset):
+    fnames = make_dataset(str(tmp_path), n_subs=6)
+    # One noisy subject
+    img = nib.load(fnames[4])
+    data = img.get_fdata() + np.random.default_rng(1).normal(0, 20, img.shape)
+    nib.save(nib.Nifti1Image(data.astype(np.float32), img.affine), fnames[4])
+    found_fnames, outliers = find_cohort_outliers(str(tmp_path))
+    assert found_fnames == sorted(fnames)
+    dvars_outliers = outliers['dvars']
+    assert dvars_outliers.frames.shape == (6, 20)
+    assert np.all(np.where(dvars_outliers.runs)[0] == [4])
+    assert list(dvars_outliers.group_labels) == [f'0{i}' for i in range(1, 7)]
+    assert np.all(np.where(dvars_outliers.groups)[0] == [4])
+
+
+def test_cohort_failing_run(tmp_path, make_dataset):
+    fnames = sorted(make_dataset(str(tmp_path), n_subs=6))
+    # Unreadable run
+    with open(fnames[2], 'wb') as fobj:
+        fobj.write(b'not an image')
+    found_fnames, outliers, error_dict = find_cohort_outliers(
+        str(tmp_path), return_errors=True)
+    assert list(error_dict) == [fnames[2]]
+    dvars_outliers = outliers['dvars']
+    assert dvars_outliers.frames.shape == (6, 20)
+    assert not np.any(dvars_outliers.frames[2])
+    assert not dvars_outliers.runs[2]
+    assert not dvars_outliers.groups[2]
+    with pytest.warns(UserWarning, match='Metrics failed'):
+        find_cohort_outliers(str(tmp_path))
+    # Metrics with one value per slice and frame are rejected
+    with pytest.raises(ValueError, match='slice_dvars'):
+        find_cohort_outliers(str(tmp_path),
+                             config=[['slice_dvars'], ['iqr_detector']])
+
+
+def test_cohort_no_runs(tmp_path, make_dataset):
+    # Empty dataset
+    fnames, outliers, error_dict = find_cohort_outliers(str(tmp_path),
+                                                        return_errors=True)
+    assert fnames == [] and error_dict == {}
+    for metric_outliers in outliers.values():
+        assert metric_outliers.frames.shape == (0, 0)
+        assert metric_outliers.runs.shape == (0,)
+        assert metric_outliers.groups.shape == (0,)
+    # All the runs fail
+    fnames = sorted(make_dataset(str(tmp_path), n_subs=3))
+    for fname in fnames:
+        with open(fname, 'wb') as fobj:
+            fobj.write(b'not an image')
+    found_fnames, outliers, error_dict = find_cohort_outliers(
+        str(tmp_path), return_errors=True)
+    assert found_fnames == fnames
+    assert sorted(error_dict) == fnames
+    for metric_outliers in outliers.values():
+        assert not np.any(metric_outliers.frames)
+        assert not np.any(metric_outliers.runs)
+        assert metric_outliers.runs.shape == (3,)
+        assert not np.any(metric_outliers.groups)
+        assert metric_outliers.groups.shape == (3,)
@@ -14,10 +14,15 @@ import sys
 
 MY_DIR = op.dirname(__file__)
 
-sys.path.append("findoutlie")
+# Directory containing the findoutlie package, when run as a script
+sys.path.append(op.join(MY_DIR, "..", ".."))
+import numpy as np
 from nibabel import nifti1
 
-from data_load import get_fname, load_sub_run
+from findoutlie.data_load import (RunData, get_data, get_fname, iter_sub_runs,
+                                  load_sub_run)
+
+EXAMPLE_FILENAME = op.join(MY_DIR, "ds107_sub012_t1r2_small.nii")
 
 
 def test_get_fname():
@@ -32,10 +37,38 @@ def test_get_fname():
     fname_to_test = get_fname(5, 5, data_dir = 'another_data')
     assert fname_to_test == 'another_data/group-00/sub-05/func/sub-05_task-taskzero_run-05_bold.nii.gz'
 
-    
+
+def test_run_data():
+    run = RunData(EXAMPLE_FILENAME, dtype=np.float32)
+    assert run.n_timepoints == run.img.shape[-1]
+    data = run.data
+    assert data.dtype == np.float32
+    # The data is decoded only once and then shared
+    assert run.data is data
+    assert get_data(run) is data
+    assert np.allclose(data, run.img.get_fdata(), rtol=1e-6)
+
+
+def test_iter_sub_runs(tmp_path, make_dataset):
+    make_dataset(str(tmp_path), n_subs=4)
+    data_dir = str(tmp_path)
+    loaded = list(iter_sub_runs(range(1, 5), 1, n_prefetch=2,
+                                dtype=np.float32, data_dir=data_dir))
+    assert [(sub, run) for sub, run, _ in loaded] == [(1, 1), (2, 1), (3, 1),
+                                                      (4, 1)]
+    for sub, run, data in loaded:
+        assert data.dtype == np.float32
+        assert np.all(data == load_sub_run(sub, run, data_dir=data_dir).get_fdata())
+    try:
+        list(iter_sub_runs([1, 5], [1], data_dir=data_dir))
+    except FileNotFoundError:
+        pass
+    else:
+        raise AssertionError('Missing run should raise FileNotFoundError')
 
 
 if __name__ == "__main__":
     # File being executed as a script
     test_get_fname()
+    test_run_data()
     print("Tests passed")
@@ -0,0 +1,137 @@
+""" Test the dataset index
+
+You can run the tests from the root directory (containing ``README.md``) with::
+
+    python3 -m pytest .
+"""
+
+import os
+
+import nibabel as nib
+
+import pytest
+
+from findoutlie import dataset_index
+from findoutlie.data_load import get_fname, iter_sub_runs
+from findoutlie.dataset_index import DatasetIndex, parse_bids_entities
+from findoutlie.outfind import find_outliers
+
+
+def test_parse_bids_entities():
+    assert parse_bids_entities(
+        'data/sub-01/func/sub-01_ses-pre_task-rest_run-02_bold.nii.gz') == {
+            'sub': '01', 'ses': 'pre', 'task': 'rest', 'run': '02',
+            'suffix': 'bold'}
+    assert parse_bids_entities('sub-3_T1w.nii') == {
+        'sub': '3', 'ses': None, 'task': None, 'run': None, 'suffix': 'T1w'}
+
+
+def test_dataset_index(tmp_path, monkeypatch, make_dataset):
+    data_dir = str(tmp_path)
+    fnames = make_dataset(data_dir, n_subs=3)
+    index = DatasetIndex(data_dir)
+    assert index.fnames() == sorted(fnames)
+    run, = index.runs(sub=2)
+    assert run['path'] == fnames[1]
+    assert run['task'] == 'taskzero'
+    assert run['shape'] == [6, 7, 5, 20]
+    assert run['dtype'] == 'float32'
+    assert index.get_fname(3, 1) == fnames[2]
+    assert os.path.isfile(index.index_path)
+
+    # Reloading an unchanged tree reads no header
+    def no_header(*args, **kwargs):
+        raise AssertionError('header read for an unchanged file')
+
+    monkeypatch.setattr(dataset_index, '_header_entry', no_header)
+    assert DatasetIndex(data_dir).fnames() == sorted(fnames)
+    monkeypatch.undo()
+
+    # New and removed runs are picked up
+    os.remove(fnames[0])
+    new_fname = fnames[1].replace('run-01', 'run-02')
+    nib.save(nib.load(fnames[1]), new_fname)
+    index = DatasetIndex(data_dir)
+    assert index.fnames() == sorted([fnames[1], new_fname, fnames[2]])
+    assert index.fnames(sub='02', run=2) == [new_fname]
+
+
+def test_index_location(tmp_path, user_cache, monkeypatch, make_dataset):
+    data_dir = str(tmp_path / 'data')
+    fnames = make_dataset(data_dir, n_subs=2)
+    index = DatasetIndex(data_dir)
+    # The dataset tree is not written to
+    assert os.listdir(data_dir) == ['group-00']
+    assert index.index_path.startswith(str(user_cache))
+    assert os.path.isfile(index.index_path)
+    index_path = str(tmp_path / 'index.json')
+    outlier_dict = find_outliers(data_dir, index_path=index_path)
+    assert list(outlier_dict) == fnames
+    # Read-only index file: the headers are read once per index only
+    loads = []
+    orig_entry = dataset_index._header_entry
+
+    def counted_entry(*args, **kwargs):
+        loads.append(args[0])
+        return orig_entry(*args, **kwargs)
+
+    monkeypatch.setattr(dataset_index, '_header_entry', counted_entry)
+    for _ in range(3):
+        assert DatasetIndex(data_dir, index_path=index_path).fnames() == fnames
+    assert loads == []
+
+
+def test_get_fname_layout(tmp_path, make_dataset):
+    # Group directory and task name other than the course dataset ones
+    data_dir = str(tmp_path)
+    fnames = make_dataset(data_dir, n_subs=2)
+    new_fnames = []
+    for fname in fnames:
+        new_fname = fname.replace('group-00', 'group-03').replace(
+            'taskzero', 'rest')
+        os.makedirs(os.path.dirname(new_fname), exist_ok=True)
+        os.rename(fname, new_fname)
+        new_fnames.append(new_fname)
+    index = DatasetIndex(data_dir)
+    assert get_fname(2, 1, data_dir=data_dir, index=index) == new_fnames[1]
+    assert get_fname(1, 1, data_dir=data_dir, index=index,
+                     task='rest') == new_fnames[0]
+    loaded = list(iter_sub_runs([1, 2], 1, data_dir=data_dir))
+    assert [sub for sub, _, _ in loaded] == [1, 2]
+    # Several matching runs
+    os.symlink(new_fnames[0], new_fnames[0].replace('rest', 'other'))
+    with pytest.raises(ValueError):
+        get_fname(1, 1, data_dir=data_dir, index=DatasetIndex(data_dir))
+    with pytest.raises(ValueError):
+        DatasetIndex(data_dir).get_fname(1, 1)
+
+
+def test_get_fname_no_index(tmp_path, monkeypatch, user_cache, make_dataset):
+    data_dir = str(tmp_path / 'data')
+    make_dataset(data_dir, n_subs=2)
+    # Without an index, get_fname only builds the course dataset path
+    monkeypatch.setattr(DatasetIndex, 'refresh', None)
+    assert get_fname(1, 1, data_dir=data_dir) == os.path.join(
+        data_dir, 'group-00', 'sub-01', 'func',
+        'sub-01_task-taskzero_run-01_bold.nii.gz')
+    assert os.listdir(user_cache) == []
+    monkeypatch.undo()
+    # The index of `index_path` is opened, and the tree walked, once
+    refreshes = []
+    refresh = DatasetIndex.refresh
+    monkeypatch.setattr(DatasetIndex, 'refresh', lambda self: (
+        refreshes.append(self), refresh(self)))
+    index_path = str(tmp_path / 'index.json')
+    for sub in (1, 2, 1):
+        assert get_fname(sub, 1, data_dir=data_dir,
+                         index_path=index_path).startswith(data_dir)
+    assert len(refreshes) == 1
+    # A new run is found by refreshing the index
+    new_fname = make_dataset(str(tmp_path / 'other'), n_subs=1)[0]
+    new_path = os.path.join(data_dir, 'group-01', 'sub-03', 'func',
+                            'sub-03_task-taskzero_run-01_bold.nii.gz')
+    os.makedirs(os.path.dirname(new_path))
+    os.rename(new_fname, new_path)
+    assert get_fname(3, 1, data_dir=data_dir,
+                     index_path=index_path) == new_path
+    assert len(refreshes) == 2
@@ -14,10 +14,15 @@ import sys
 
 MY_DIR = op.dirname(__file__)
 
-sys.path.append("findoutlie")
+# Directory containing the findoutlie package, when run as a script
+sys.path.append(op.join(MY_DIR, "..", ".."))
 import numpy as np
 
-from detectors import iqr_detector
+from findoutlie.detectors import (compute_outliers, compute_outliers_batch,
+                                  iqr_detector, median_detector,
+                                  robust_stats, rolling_iqr_detector,
+                                  rolling_median_detector,
+                                  rolling_robust_stats)
 
 
 def test_iqr_detector():
@@ -48,7 +53,124 @@ def test_iqr_detector():
     assert np.all(example_values[is_outlier] == [10.2, 14.1, 15.1, 15.9, 16.4])
 
 
+def test_compute_outliers():
+    values = np.ones(9)
+    values[4] = 10
+    # Aligned with the last volumes by default
+    outlier_tf = compute_outliers(values, 10, 'iqr_detector')
+    assert outlier_tf.dtype == bool
+    assert np.all(np.where(outlier_tf)[0] == [5])
+    # Explicit offset
+    outlier_tf = compute_outliers(values, 12, 'iqr_detector', offset=1)
+    assert np.all(np.where(outlier_tf)[0] == [5])
+    assert len(outlier_tf) == 12
+
+
+def test_compute_outliers_batch():
+    rng = np.random.default_rng(0)
+    values = rng.normal(size=(3, 50))
+    values[0, 10] = 20
+    values[2, [3, 40]] = -20
+    for detector_name, kwargs in (('iqr_detector', {}),
+                                  ('median_detector', {'pos_only': False})):
+        outlier_tfs = compute_outliers_batch(values, 52, detector_name,
+                                             offsets=[0, 1, 2], **kwargs)
+        assert outlier_tfs.shape == (3, 52)
+        for row, offset in enumerate([0, 1, 2]):
+            assert np.all(outlier_tfs[row] == compute_outliers(
+                values[row], 52, detector_name, offset, **kwargs))
+    # Batched detectors match the one-dimensional ones
+    assert np.all(median_detector(values)[1] == median_detector(values[1]))
+    assert np.all(iqr_detector(values)[2] == iqr_detector(values[2]))
+
+
+def test_robust_stats():
+    rng = np.random.default_rng(0)
+    for shape in [(15,), (16,), (1,), (4, 15), (3, 16)]:
+        values = rng.normal(size=shape)
+        q1, median, q3, mad = robust_stats(values)
+        assert q1.shape == median.shape == q3.shape == mad.shape == shape[:-1] + (1,)
+        assert np.allclose(q1[..., 0], np.percentile(values, 25, axis=-1))
+        assert np.allclose(median[..., 0], np.median(values, axis=-1))
+        assert np.allclose(q3[..., 0], np.percentile(values, 75, axis=-1))
+        expected_mad = np.median(np.abs(values - median), axis=-1)
+        assert np.allclose(mad[..., 0], expected_mad)
+    assert robust_stats(values, with_mad=False)[3] is None
+
+
+def test_rolling_robust_stats():
+    rng = np.random.default_rng(0)
+    # Integer values, to have ties in the windows
+    values = rng.integers(0, 10, size=(3, 50)).astype(float)
+    for window in (1, 8, 11, 50, 80):
+        stats = rolling_robust_stats(values, window)
+        size = min(window, 50)
+        for row, series in enumerate(values):
+            for i in range(50):
+                start = min(max(i - size // 2, 0), 50 - size)
+                win = series[start:start + size]
+                q1, median, q3 = np.percentile(win, [25, 50, 75])
+                mad = np.median(np.abs(win - median))
+                assert np.allclose([stat[row, i] for stat in stats],
+                                   [q1, median, q3, mad])
+        # 1D series give the same as the rows
+        for stat, row_stat in zip(rolling_robust_stats(values[1], window),
+                                  stats):
+            assert np.allclose(stat, row_stat[1])
+
+
+def test_rolling_robust_stats_nan():
+    values = np.arange(1, 13, dtype=float)
+    values[2] = np.nan
+    q1, median, q3, mad = rolling_robust_stats(values, window=5)
+    for i in range(12):
+        start = min(max(i - 2, 0), 12 - 5)
+        win = values[start:start + 5]
+        expected_median = np.nanmedian(win)
+        assert np.allclose([q1[i], median[i], q3[i], mad[i]],
+                           [*np.nanpercentile(win, [25, 50, 75]),
+                            np.nanmedian(np.abs(win - expected_median))])
+    # The NaN only changes the windows containing it
+    assert median[-1] == 10 and not np.any(np.isnan(mad))
+    # Batch with series with and without NaN, and with NaN only
+    batch = np.stack([values, np.arange(12.), np.full(12, np.nan)])
+    for stat, row_stat in zip(rolling_robust_stats(batch, window=5),
+                              (q1, median, q3, mad)):
+        assert np.allclose(stat[0], row_stat)
+        assert np.all(np.isnan(stat[2]))
+    assert np.array_equal(rolling_robust_stats(batch, window=5)[1][1],
+                          rolling_robust_stats(np.arange(12.), window=5)[1])
+
+
+def test_rolling_detectors():
+    rng = np.random.default_rng(0)
+    # Slow drift with two spikes
+    n_values = 300
+    series = np.linspace(0, 20, n_values) + rng.normal(size=n_values)
+    series[[100, 200]] += 8
+    for global_detector, rolling_detector in (
+            (iqr_detector, rolling_iqr_detector),
+            (median_detector, rolling_median_detector)):
+        # The global threshold misses the spike in the lower part of the drift
+        global_tf = global_detector(series)
+        assert not global_tf[100]
+        rolling_tf = rolling_detector(series)
+        assert rolling_tf[100] and rolling_tf[200]
+        assert np.sum(rolling_tf) <= 4
+        # Batched version
+        batch = np.stack([series, series[::-1]])
+        batch_tf = rolling_detector(batch)
+        assert np.array_equal(batch_tf[0], rolling_tf)
+        assert np.array_equal(batch_tf[1], rolling_detector(series[::-1]))
+
+
 if __name__ == "__main__":
     # File being executed as a script
     test_iqr_detector()
+    test_compute_outliers()
+    test_compute_outliers_batch()
+    test_robust_stats()
+    test_rolling_robust_stats()
+    test_rolling_robust_stats_nan()
+    test_rolling_detectors()
     print("Tests passed")
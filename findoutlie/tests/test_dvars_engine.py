@@ -0,0 +1,142 @@
+""" Test standardized and per-slice dvars
+
+You can run the tests from the root directory (containing ``README.md``) with::
+
+    python3 -m pytest .
+"""
+
+import numpy as np
+
+import nibabel as nib
+
+from findoutlie.data_load import RunData
+from findoutlie.detectors import compute_outliers, pvalue_detector
+from findoutlie.dvars_engine import compute_dvars
+from findoutlie.masking import BrainMask, compute_brain_mask
+from findoutlie.metrics import compute_metric, dvars, metric_offset
+from findoutlie.outfind import compute_metrics
+
+
+def make_data(shape=(20, 20, 8, 60)):
+    """ White noise with a global spike at 20 and a slice artifact at 40
+    """
+    rng = np.random.default_rng(0)
+    data = rng.normal(1000, 10, size=shape)
+    data[..., 20] += 20
+    data[:, :, 3, 40] += 10
+    return data
+
+
+def test_compute_dvars():
+    data = make_data()
+    stats = compute_dvars(data)
+    assert np.allclose(stats.dvars, dvars(data))
+    # Per-slice dvars the long way round
+    diffs = np.diff(data, axis=-1)
+    assert stats.slice_dvars.shape == (8, 59)
+    assert np.allclose(stats.slice_dvars,
+                       np.sqrt(np.mean(diffs ** 2, axis=(0, 1))))
+    # Without artifact, standardized dvars is close to 1, and D-var about 50%
+    # of the variance for white noise
+    clean = np.ones(59, dtype=bool)
+    clean[[19, 20, 39, 40]] = False
+    assert np.allclose(np.median(stats.std_dvars), 1)
+    assert np.allclose(stats.std_dvars[clean], 1, atol=0.05)
+    assert 40 < np.median(stats.pct_dvar) < 60
+    assert np.allclose(stats.delta_pct_dvar,
+                       stats.pct_dvar - np.median(stats.pct_dvar))
+    # The global spike is significant, the clean volumes are not
+    assert np.all(stats.p_values[[19, 20]] < 0.05 / 59)
+    assert np.all(stats.p_values[clean] > 0.05 / 59)
+    assert np.all(stats.delta_pct_dvar[[19, 20]] > 5)
+
+
+def test_compute_dvars_mask():
+    data = make_data()
+    mask = np.zeros(data.shape[:-1], dtype=bool)
+    mask[2:18, 3:19, 1:6] = True
+    stats = compute_dvars(data, BrainMask(mask))
+    brain = data[mask]
+    assert np.allclose(stats.dvars,
+                       np.sqrt(np.mean(np.diff(brain) ** 2, axis=0)))
+    assert np.allclose(stats.mean_var, np.mean(np.var(brain, axis=-1)))
+    # Slices without brain voxels
+    assert np.all(np.isnan(stats.slice_dvars[[0, 6, 7]]))
+    assert not np.any(np.isnan(stats.slice_dvars[1:6]))
+
+
+def test_dvars_outliers(tmp_path):
+    data = make_data()
+    fname = str(tmp_path / 'run.nii.gz')
+    nib.save(nib.Nifti1Image(data.astype(np.float32), np.eye(4)), fname)
+    run = RunData(fname)
+    n_trs = run.n_timepoints
+    # One pass shared between the metrics
+    values = {name: compute_metric(run, name)
+              for name in ('std_dvars', 'dvars_pvalue', 'delta_pct_dvar',
+                           'slice_dvars')}
+    assert run._data is None
+    assert values['std_dvars'] is run.intermediate('dvars_stats').std_dvars
+    p_tf = compute_outliers(values['dvars_pvalue'], n_trs, 'pvalue_detector',
+                            offset=metric_offset('dvars_pvalue'))
+    assert list(np.where(p_tf)[0]) == [20, 21]
+    # The slice artifact is diluted in the volume dvars, but not in its slice
+    slice_tf = compute_outliers(values['slice_dvars'], n_trs, 'iqr_detector',
+                                offset=metric_offset('slice_dvars'))
+    assert slice_tf.shape == (n_trs,)
+    assert slice_tf[40] and slice_tf[41]
+    dvars_tf = compute_outliers(compute_metric(run, 'dvars'), n_trs,
+                                'iqr_detector', offset=1)
+    assert not dvars_tf[40] and not dvars_tf[41]
+    assert slice_tf[20] and slice_tf[21]
+
+
+class CountingRun(RunData):
+    """ Run counting the volumes read from its data
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.n_reads = 0
+
+    @property
+    def dataobj(self):
+        return CountingSource(self, super().dataobj)
+
+
+class CountingSource:
+
+    def __init__(self, run, dataobj):
+        self.run = run
+        self.dataobj = dataobj
+        self.shape = dataobj.shape
+
+    def __getitem__(self, index):
+        self.run.n_reads += 1
+        return self.dataobj[index]
+
+
+def test_dvars_single_read(tmp_path):
+    data = make_data()
+    fname = str(tmp_path / 'run.nii.gz')
+    nib.save(nib.Nifti1Image(data.astype(np.float32), np.eye(4)), fname)
+    run = CountingRun(fname, use_mask=True)
+    names = ['dvars', 'coefficient_of_variation', 'std_dvars', 'dvars_pvalue',
+             'delta_pct_dvar', 'slice_dvars', 'tsnr']
+    values = compute_metrics(run, names)
+    # One read of each volume, and the first volume for the brain mask
+    assert run.n_reads == run.n_timepoints + 1
+    stats = compute_dvars(data.astype(np.float32),
+                          compute_brain_mask(data.astype(np.float32)))
+    assert np.allclose(values['dvars'], stats.dvars)
+    assert np.allclose(values['std_dvars'], stats.std_dvars)
+    assert np.allclose(values['slice_dvars'], stats.slice_dvars,
+                       equal_nan=True)
+
+
+def test_pvalue_detector():
+    p_values = np.array([0.5, 0.001, 0.02, np.nan])
+    assert list(pvalue_detector(p_values)) == [False, True, False, False]
+    assert list(pvalue_detector(p_values, correction=None)) == [
+        False, True, True, False]
+    assert pvalue_detector(np.tile(p_values, (2, 1))).shape == (2, 4)
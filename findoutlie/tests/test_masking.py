@@ -0,0 +1,58 @@
+""" Test brain masking
+
+You can run the tests from the root directory (containing ``README.md``) with::
+
+    python3 -m pytest .
+"""
+
+import os.path as op
+
+import numpy as np
+
+import nibabel as nib
+
+from findoutlie.data_load import RunData
+from findoutlie.masking import BrainMask, compute_brain_mask
+from findoutlie.metrics import compute_metric
+from findoutlie.stats import run_stats
+
+MY_DIR = op.dirname(__file__)
+EXAMPLE_FILENAME = op.join(MY_DIR, "ds107_sub012_t1r2_small.nii")
+
+
+def test_brain_mask():
+    rng = np.random.default_rng(0)
+    bool_mask = rng.uniform(size=(4, 5, 6)) > 0.7
+    mask = BrainMask(bool_mask)
+    assert mask.n_voxels == bool_mask.sum()
+    assert mask.indices.dtype == np.int32
+    assert np.all(mask.to_bool() == bool_mask)
+    bits = mask.packbits()
+    assert bits.nbytes == int(np.ceil(bool_mask.size / 8))
+    assert np.all(BrainMask.from_packbits(bits, mask.shape).to_bool()
+                  == bool_mask)
+    data = rng.normal(size=(4, 5, 6, 7))
+    compact = mask.compact(data)
+    assert np.all(compact == data[bool_mask])
+    assert np.all(mask.expand(compact[:, 2])[bool_mask] == data[..., 2][bool_mask])
+    assert np.all(mask.expand(compact[:, 2])[~bool_mask] == 0)
+
+
+def test_masked_stats():
+    img = nib.load(EXAMPLE_FILENAME)
+    data = img.get_fdata()
+    mask = compute_brain_mask(img)
+    bool_mask = mask.to_bool()
+    assert np.all(bool_mask == (data[..., 0] > data[..., 0].mean() / 8))
+    assert 0 < mask.n_voxels < data[..., 0].size
+    stats = run_stats(img, mask)
+    brain = data[bool_mask]
+    assert np.allclose(stats.mean_map[bool_mask], brain.mean(axis=1))
+    assert np.all(stats.mean_map[~bool_mask] == 0)
+    assert np.allclose(stats.cv, brain.std(axis=0) / brain.mean(axis=0))
+    assert np.allclose(stats.dvars,
+                       np.sqrt(np.mean(np.diff(brain) ** 2, axis=0)))
+    # Masked metrics through a RunData
+    run = RunData(EXAMPLE_FILENAME, use_mask=True)
+    assert np.allclose(compute_metric(run, 'dvars'), stats.dvars)
+    assert np.allclose(run.intermediate('compact_data'), brain)
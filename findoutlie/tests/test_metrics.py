@@ -0,0 +1,59 @@
+""" Test metrics implementations
+
+You can run the tests from the root directory (containing ``README.md``) with::
+
+    python3 -m pytest .
+"""
+
+import os.path as op
+
+import numpy as np
+
+import nibabel as nib
+
+from findoutlie.data_load import RunData, native_float_dtype
+from findoutlie.metrics import (coefficient_of_variation, compute_metric,
+                                dvars, spm_global, streaming_dvars)
+
+MY_DIR = op.dirname(__file__)
+EXAMPLE_FILENAME = op.join(MY_DIR, "ds107_sub012_t1r2_small.nii")
+
+
+def test_streaming_dvars(tmp_path):
+    img = nib.load(EXAMPLE_FILENAME)
+    expected = dvars(img)
+    assert np.allclose(streaming_dvars(img), expected)
+    assert np.allclose(streaming_dvars(img.get_fdata()), expected)
+    # Streaming from a gzipped file through the RunData proxy
+    gz_fname = str(tmp_path / 'example.nii.gz')
+    nib.save(img, gz_fname)
+    run = RunData(gz_fname)
+    assert np.allclose(streaming_dvars(run), expected)
+    assert run._data is None
+
+
+def test_native_dtype(tmp_path):
+    assert native_float_dtype(np.int16) == np.float32
+    assert native_float_dtype(np.float32) == np.float32
+    assert native_float_dtype(np.int32) == np.float64
+    assert native_float_dtype(np.float64) == np.float64
+    # float32 image with a large mean, so that float32 sums would be
+    # inaccurate
+    rng = np.random.default_rng(0)
+    data = rng.normal(10000, 10, size=(20, 21, 22, 30)).astype(np.float32)
+    fname = str(tmp_path / 'run.nii.gz')
+    nib.save(nib.Nifti1Image(data, np.eye(4)), fname)
+    reference = data.astype(np.float64)
+    img = nib.load(fname)
+    run = RunData(fname)
+    assert run.dtype == np.float32
+    assert run.data.dtype == np.float32
+    for metric in (dvars, streaming_dvars, coefficient_of_variation,
+                   spm_global):
+        expected = metric(reference)
+        assert np.allclose(metric(img), expected, rtol=1e-5, atol=0)
+        assert np.allclose(metric(run), expected, rtol=1e-5, atol=0)
+    for metric_name in ('dvars', 'coefficient_of_variation'):
+        assert np.allclose(compute_metric(RunData(fname), metric_name),
+                           compute_metric(reference, metric_name),
+                           rtol=1e-5, atol=0)
@@ -0,0 +1,106 @@
+""" Test motion estimation and framewise displacement
+
+You can run the tests from the root directory (containing ``README.md``) with::
+
+    python3 -m pytest .
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import nibabel as nib
+from scipy import ndimage
+
+from findoutlie.data_load import RunData
+from findoutlie.metrics import compute_metric, metric_offset
+from findoutlie.motion import (default_n_threads, framewise_displacement,
+                               make_levels, motion_parameters,
+                               register_volume, rigid_matrix, rigid_params)
+
+ZOOMS = (3., 3., 4.)
+
+
+def make_phantom(shape=(32, 32, 20)):
+    """ Smooth ellipsoid with some texture
+    """
+    rng = np.random.default_rng(0)
+    ijk = np.indices(shape)
+    centre = (np.array(shape) - 1) / 2
+    radii = np.array(shape) * 0.4
+    inside = np.sum(((ijk - centre[:, None, None, None])
+                     / radii[:, None, None, None]) ** 2, axis=0) < 1
+    texture = ndimage.gaussian_filter(rng.normal(size=shape), 1) * 300
+    return ndimage.gaussian_filter(inside * (1000 + texture), 1)
+
+
+def move(vol, params, zooms=ZOOMS):
+    """ Resample `vol` so that its value at ``rigid_matrix(params) @ x`` is the
+    value of `vol` at ``x``, with cubic splines
+    """
+    inverse = np.linalg.inv(rigid_matrix(params))
+    zooms = np.asarray(zooms)
+    centre = (np.array(vol.shape) - 1) / 2
+    matrix = inverse[:3, :3] * zooms[None, :] / zooms[:, None]
+    offset = (inverse[:3, 3] - inverse[:3, :3] @ (centre * zooms)) / zooms + centre
+    return ndimage.affine_transform(vol, matrix, offset, order=3,
+                                    mode='nearest')
+
+
+def test_rigid_params():
+    params = np.array([1, -2, 3, 0.1, -0.2, 0.3])
+    assert np.allclose(rigid_params(rigid_matrix(params)), params)
+    assert np.allclose(rigid_matrix(np.zeros(6)), np.eye(4))
+
+
+def test_register_volume():
+    ref = make_phantom()
+    pyramid = make_levels(ref, ZOOMS)
+    # A shift of 2 voxels along the first axis is a 6 mm translation
+    shifted = ndimage.shift(ref, (2, 0, 0), order=3, mode='nearest')
+    assert np.allclose(register_volume(shifted, pyramid),
+                       [6, 0, 0, 0, 0, 0], atol=0.02)
+    true_params = np.array([1.5, -0.8, 0.5, 0.03, -0.02, 0.04])
+    params = register_volume(move(ref, true_params), pyramid)
+    assert np.allclose(params[:3], true_params[:3], atol=0.1)
+    assert np.allclose(params[3:], true_params[3:], atol=0.003)
+
+
+def test_framewise_displacement(tmp_path):
+    params = np.array([[0, 0, 0, 0, 0, 0],
+                       [1, 0, -1, 0, 0.01, 0],
+                       [1, 0, -1, 0, 0.01, 0]])
+    assert np.allclose(framewise_displacement(params), [2.5, 0])
+    ref = make_phantom()
+    true_params = np.array([[0, 0, 0, 0, 0, 0],
+                            [0.5, 0, 0, 0, 0, 0],
+                            [0.5, -1, 0, 0.02, 0, 0],
+                            [0.5, -1, 0, 0.02, 0, 0]])
+    data = np.stack([move(ref, p) for p in true_params], axis=-1)
+    img = nib.Nifti1Image(data.astype(np.float32), np.diag([*ZOOMS, 1]))
+    fname = str(tmp_path / 'run.nii.gz')
+    nib.save(img, fname)
+    run = RunData(fname)
+    fd = compute_metric(run, 'framewise_displacement')
+    assert metric_offset('framewise_displacement') == 1
+    assert np.allclose(fd, framewise_displacement(true_params), atol=0.15)
+    # Relative to the reference volume, the same with one or several threads
+    params = run.intermediate('motion_params')
+    assert np.allclose(params[0], 0)
+    assert np.allclose(motion_parameters(data, zooms=ZOOMS, n_threads=1),
+                       params, atol=1e-3)
+    # Middle reference
+    middle_params = motion_parameters(run, reference=2)
+    assert np.allclose(middle_params[2], 0)
+    assert np.allclose(framewise_displacement(middle_params), fd, atol=0.05)
+
+
+def _worker_n_threads():
+    return default_n_threads()
+
+
+def test_default_n_threads():
+    assert default_n_threads() >= 1
+    # One thread per worker process
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        assert executor.submit(_worker_n_threads).result() == 1
@@ -0,0 +1,56 @@
+""" Test online outlier detection
+
+You can run the tests from the root directory (containing ``README.md``) with::
+
+    python3 -m pytest .
+"""
+
+import os.path as op
+
+import numpy as np
+
+import nibabel as nib
+
+from findoutlie.metrics import dvars
+from findoutlie.online import (OnlineDVARS, OnlineIQRDetector,
+                               OnlineMedianDetector, P2Quantile)
+
+MY_DIR = op.dirname(__file__)
+EXAMPLE_FILENAME = op.join(MY_DIR, "ds107_sub012_t1r2_small.nii")
+
+
+def test_p2_quantile():
+    rng = np.random.default_rng(0)
+    values = rng.normal(size=5000)
+    for p in (0.25, 0.5, 0.75):
+        estimator = P2Quantile(p)
+        assert np.isnan(estimator.value)
+        for value in values[:3]:
+            estimator.update(value)
+        assert estimator.value == np.percentile(values[:3], p * 100)
+        for value in values[3:]:
+            estimator.update(value)
+        assert abs(estimator.value - np.percentile(values, p * 100)) < 0.05
+
+
+def test_online_detectors():
+    rng = np.random.default_rng(0)
+    values = rng.normal(10, 1, size=200)
+    values[[50, 120]] = 30
+    values[150] = -10
+    for detector in (OnlineIQRDetector(iqr_proportion=3),
+                     OnlineMedianDetector(window=40)):
+        flags = [detector.update(value) for value in values]
+        assert np.all(np.where(flags)[0] == [50, 120])
+    detector = OnlineMedianDetector(pos_only=False, window=40)
+    flags = [detector.update(value) for value in values]
+    assert np.all(np.where(flags)[0] == [50, 120, 150])
+
+
+def test_online_dvars():
+    img = nib.load(EXAMPLE_FILENAME)
+    data = img.get_fdata()
+    online_dvars = OnlineDVARS()
+    values = [online_dvars.update(data[..., i]) for i in range(data.shape[-1])]
+    assert values[0] is None
+    assert np.allclose(values[1:], dvars(img))
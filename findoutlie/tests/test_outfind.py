@@ -0,0 +1,31 @@
+""" Test outlier finding routines
+
+You can run the tests from the root directory (containing ``README.md``) with::
+
+    python3 -m pytest .
+"""
+
+from findoutlie.outfind import detect_outliers, find_outliers
+
+
+def test_find_outliers(tmp_path, make_dataset):
+    fnames = make_dataset(str(tmp_path))
+    outlier_dict = find_outliers(str(tmp_path))
+    assert list(outlier_dict) == sorted(fnames)
+    for fname in fnames:
+        assert 10 in outlier_dict[fname]
+        assert outlier_dict[fname] == detect_outliers(fname)
+    # Parallel mode gives the same results in the same order
+    par_dict = find_outliers(str(tmp_path), n_jobs=2)
+    assert list(par_dict.items()) == list(outlier_dict.items())
+
+
+def test_find_outliers_errors(tmp_path, make_dataset):
+    fnames = make_dataset(str(tmp_path))
+    with open(fnames[1], 'wb') as fobj:
+        fobj.write(b'not an image')
+    for n_jobs in (1, 2):
+        outlier_dict, error_dict = find_outliers(str(tmp_path), n_jobs=n_jobs,
+                                                 return_errors=True)
+        assert list(outlier_dict) == [fnames[0], fnames[2]]
+        assert list(error_dict) == [fnames[1]]
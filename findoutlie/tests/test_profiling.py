@@ -0,0 +1,105 @@
+""" Test timing and memory instrumentation
+"""
+
+import os.path as op
+
+import numpy as np
+
+import pytest
+
+from findoutlie import profiling
+from findoutlie.outfind import find_outliers
+
+
+def test_profiling_off(tmp_path, monkeypatch):
+    monkeypatch.delenv(profiling.ENV_VAR, raising=False)
+    assert not profiling.is_enabled()
+    # Shared do-nothing context manager
+    assert profiling.stage('metric', 'dvars') is profiling.stage('decode')
+    with profiling.record_run('run.nii.gz') as record:
+        assert record is None
+
+
+def test_profiling_records(tmp_path, monkeypatch, make_dataset):
+    data_dir = tmp_path / 'data'
+    fnames = make_dataset(str(data_dir))
+    out_fname = str(tmp_path / 'timings.jsonl')
+    monkeypatch.setenv(profiling.ENV_VAR, out_fname)
+    outlier_dict = find_outliers(str(data_dir))
+    monkeypatch.delenv(profiling.ENV_VAR)
+    assert outlier_dict == find_outliers(str(data_dir))
+    records = profiling.read_records(out_fname)
+    # One line per run, then the summary
+    assert len(records) == len(fnames) + 1
+    run_records, summary = records[:-1], records[-1]['summary']
+    assert sorted(record['fname'] for record in run_records) == sorted(fnames)
+    for record in run_records:
+        assert record['error'] is None
+        assert record['wall'] > 0
+        stages = {(entry['stage'], entry['name'])
+                  for entry in record['stages']}
+        assert {('load_image', None), ('metric', 'dvars'),
+                ('metric', 'coefficient_of_variation'),
+                ('detector', 'iqr_detector')} <= stages
+    assert summary['n_runs'] == len(fnames)
+    assert summary['n_errors'] == 0
+    dvars_agg, = [agg for agg in summary['stages']
+                  if agg['name'] == 'dvars']
+    assert dvars_agg['count'] == len(fnames)
+    assert len(summary['slowest']) == len(fnames)
+    assert 'metric:dvars' in profiling.format_summary(summary)
+
+
+def test_profiling_errors(tmp_path, monkeypatch, make_dataset):
+    data_dir = tmp_path / 'data'
+    fnames = make_dataset(str(data_dir))
+    with open(fnames[0], 'wb') as fobj:
+        fobj.write(b'not an image')
+    out_fname = str(tmp_path / 'timings.jsonl')
+    monkeypatch.setenv(profiling.ENV_VAR, out_fname)
+    for n_jobs in (1, 2):
+        find_outliers(str(data_dir), n_jobs=n_jobs, return_errors=True)
+        summary = profiling.read_records(out_fname)[-1]['summary']
+        assert summary['n_runs'] == len(fnames)
+        assert summary['n_errors'] == 1
+
+
+def _record_runs(out_fname, n_bytes):
+    # Records of runs allocating (and touching) `n_bytes`, then nothing
+    for fname, size in (('big.nii.gz', n_bytes), ('small.nii.gz', 0)):
+        with profiling.record_run(fname):
+            with profiling.stage('metric', 'alloc'):
+                np.ones(size // 8).sum()
+    return profiling.read_records(out_fname)
+
+
+@pytest.mark.skipif(not profiling.reset_peak_rss(),
+                    reason='Cannot reset the peak resident memory')
+def test_peak_rss_per_run(tmp_path, monkeypatch):
+    out_fname = str(tmp_path / 'timings.jsonl')
+    monkeypatch.setenv(profiling.ENV_VAR, out_fname)
+    n_bytes = 200 * 2 ** 20
+    big, small = _record_runs(out_fname, n_bytes)
+    assert big['peak_scope'] == small['peak_scope'] == 'run'
+    # The peak of the first run does not leak into the second
+    assert big['peak_rss'] - small['peak_rss'] > n_bytes / 2
+    assert big['stages'][0]['rss_growth'] > n_bytes / 2
+    assert small['stages'][0]['rss'] is not None
+
+
+def test_peak_rss_fallback(tmp_path, monkeypatch):
+    # No /proc files, as on macOS and Windows
+    missing = str(tmp_path / 'missing')
+    monkeypatch.setattr(profiling, '_STATUS_FNAME', op.join(missing, 'status'))
+    monkeypatch.setattr(profiling, '_CLEAR_REFS_FNAME',
+                        op.join(missing, 'clear_refs'))
+    assert not profiling.reset_peak_rss()
+    assert profiling.current_rss() is None
+    out_fname = str(tmp_path / 'timings.jsonl')
+    monkeypatch.setenv(profiling.ENV_VAR, out_fname)
+    big, small = _record_runs(out_fname, 2 ** 20)
+    assert big['peak_scope'] == small['peak_scope'] == 'process'
+    assert small['stages'][0]['rss'] is None
+    if profiling.resource is not None:
+        # Lifetime peak
+        assert small['peak_rss'] >= big['peak_rss']
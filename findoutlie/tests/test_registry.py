@@ -0,0 +1,89 @@
+""" Test the registry of metrics and detectors
+
+You can run the tests from the root directory (containing ``README.md``) with::
+
+    python3 -m pytest .
+"""
+
+import numpy as np
+
+import pytest
+
+from findoutlie import registry
+from findoutlie.data_load import RunData, get_data
+from findoutlie.detectors import compute_outliers
+from findoutlie.metrics import compute_metric, dvars, metric_offset
+from findoutlie.outfind import compute_metrics, detect_outliers
+
+
+@pytest.fixture
+def clean_registry():
+    # Remove the metrics and detectors registered by a test
+    saved = [dict(reg) for reg in (registry.METRICS, registry.DETECTORS,
+                                   registry.INTERMEDIATES)]
+    yield
+    for reg, contents in zip((registry.METRICS, registry.DETECTORS,
+                              registry.INTERMEDIATES), saved):
+        reg.clear()
+        reg.update(contents)
+
+
+def test_builtins():
+    spec = registry.get_metric('dvars')
+    assert spec.func is dvars
+    assert spec.offset == metric_offset('dvars') == 1
+    assert spec.streamable
+    assert spec.needs == ('run_stats',)
+    assert not registry.get_metric('spm_global').streamable
+    assert callable(registry.get_detector('iqr_detector'))
+    with pytest.raises(ValueError):
+        registry.get_metric('no_such_metric')
+    with pytest.raises(ValueError):
+        compute_outliers(np.ones(3), 3, 'no_such_detector')
+
+
+def test_plan_passes(clean_registry):
+    registry.register_metric('uses_mean', needs=['mean_map'])(dvars)
+    registry.register_metric('uses_both', needs=['mean_map', 'std_map'])(dvars)
+    passes = registry.plan_passes(['uses_both', 'dvars', 'spm_global',
+                                   'uses_mean', 'coefficient_of_variation'])
+    assert passes == [['dvars', 'coefficient_of_variation'], ['spm_global'],
+                      ['uses_mean'], ['uses_both']]
+
+
+def test_custom_metric(tmp_path, clean_registry, make_dataset):
+    fname, = make_dataset(str(tmp_path), n_subs=1)
+    calls = []
+
+    @registry.register_intermediate()
+    def counted_mean(img):
+        calls.append(img)
+        return np.mean(get_data(img), axis=-1)
+
+    @registry.register_metric(needs=['counted_mean'])
+    def mean_distance(img, counted_mean):
+        data = get_data(img)
+        data = data.reshape(-1, data.shape[-1])
+        return np.sqrt(np.mean((data - counted_mean.reshape(-1, 1)) ** 2,
+                               axis=0))
+
+    @registry.register_metric(needs=['counted_mean'])
+    def max_distance(img, counted_mean):
+        data = get_data(img)
+        data = data.reshape(-1, data.shape[-1])
+        return np.max(np.abs(data - counted_mean.reshape(-1, 1)), axis=0)
+
+    @registry.register_detector()
+    def threshold_detector(measures, threshold=10):
+        return measures > threshold
+
+    run = RunData(fname)
+    values = compute_metrics(run, ['mean_distance', 'max_distance'])
+    # The shared intermediate is computed once, then freed
+    assert len(calls) == 1
+    assert run._intermediates == {}
+    assert np.allclose(values['mean_distance'],
+                       compute_metric(run.img.get_fdata(), 'mean_distance'))
+    outliers = detect_outliers(fname, config=[['mean_distance'],
+                                              ['threshold_detector']])
+    assert outliers == [10]
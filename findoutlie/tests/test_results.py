@@ -0,0 +1,103 @@
+""" Test columnar results store
+
+You can run the tests from the root directory (containing ``README.md``) with::
+
+    python3 -m pytest .
+"""
+
+import numpy as np
+
+import pytest
+
+from findoutlie.outfind import detect_outliers, find_outliers
+from findoutlie.results import ResultsWriter, load_results, run_result
+
+
+def make_rows(n_runs=5, n_timepoints=20):
+    rng = np.random.default_rng(0)
+    rows = []
+    for i in range(n_runs):
+        fname = (f'data/sub-{i % 3 + 1:02d}_task-taskzero_'
+                 f'run-{i // 3 + 1:02d}_bold.nii.gz')
+        masks = {('dvars', 'iqr_detector'): rng.random(n_timepoints) > 0.8,
+                 ('slice_dvars', 'median_detector'):
+                     rng.random(n_timepoints) > 0.8}
+        rows.append(run_result(
+            fname,
+            {'dvars': rng.normal(size=n_timepoints - 1),
+             'slice_dvars': rng.normal(size=(4, n_timepoints - 1))},
+            masks, masks[('dvars', 'iqr_detector')], dtype='float32'))
+    return rows
+
+
+def assert_rows_equal(rows, expected):
+    assert len(rows) == len(expected)
+    for row, exp_row in zip(rows, expected):
+        for key in ('fname', 'sub', 'task', 'run', 'n_timepoints', 'dtype',
+                    'version', 'error'):
+            assert row[key] == exp_row[key]
+        assert row['metrics'].keys() == exp_row['metrics'].keys()
+        for name, values in row['metrics'].items():
+            assert np.array_equal(values, exp_row['metrics'][name])
+        assert row['masks'].keys() == exp_row['masks'].keys()
+        for key, mask in row['masks'].items():
+            assert np.array_equal(mask, exp_row['masks'][key])
+        assert np.array_equal(row['outliers'], exp_row['outliers'])
+
+
+@pytest.mark.parametrize('suffix', ['.npz', '.parquet'])
+def test_results_store(tmp_path, suffix):
+    if suffix == '.parquet':
+        pytest.importorskip('pyarrow')
+    path = str(tmp_path / f'results{suffix}')
+    rows = make_rows()
+    with ResultsWriter(path, batch_size=2) as writer:
+        for row in rows[:4]:
+            writer.append(row)
+    assert_rows_equal(load_results(path), rows[:4])
+    assert load_results(path)[0]['metrics']['slice_dvars'].shape == (4, 19)
+    # Appending keeps the rows already written
+    with ResultsWriter(path, mode='a') as writer:
+        writer.append(rows[4])
+    assert_rows_equal(load_results(path), rows)
+    # Subsets of the runs and of the metrics
+    assert_rows_equal(load_results(path, sub=1), [rows[0], rows[3]])
+    assert_rows_equal(load_results(path, fnames=[rows[2]['fname']], run=1),
+                      [rows[2]])
+    assert load_results(path, sub=4) == []
+    subset = load_results(path, metrics=['dvars'], task='taskzero')
+    assert len(subset) == 5
+    assert list(subset[0]['metrics']) == ['dvars']
+    assert list(subset[0]['masks']) == [('dvars', 'iqr_detector')]
+    # Writing again replaces the file
+    with ResultsWriter(path) as writer:
+        writer.append(rows[1])
+    assert_rows_equal(load_results(path), [rows[1]])
+
+
+def test_find_outliers_results(tmp_path, make_dataset):
+    data_dir = tmp_path / 'data'
+    fnames = make_dataset(str(data_dir))
+    with open(fnames[1], 'wb') as fobj:
+        fobj.write(b'not an image')
+    path = str(tmp_path / 'results.npz')
+    with ResultsWriter(path, batch_size=2) as writer:
+        outlier_dict, error_dict = find_outliers(
+            str(data_dir), return_errors=True, results=writer)
+    rows = load_results(path)
+    assert [row['fname'] for row in rows] == fnames
+    failed = rows[1]
+    assert failed['error'] == repr(error_dict[fnames[1]])
+    assert failed['n_timepoints'] == 0
+    assert list(failed['metrics']) == ['coefficient_of_variation', 'dvars']
+    for row in (rows[0], rows[2]):
+        fname = row['fname']
+        assert row['error'] is None
+        assert row['n_timepoints'] == 20
+        assert row['dtype'] == 'float32'
+        assert list(np.flatnonzero(row['outliers'])) == outlier_dict[fname]
+        outliers, result = detect_outliers(fname, return_result=True)
+        assert outliers == outlier_dict[fname]
+        assert_rows_equal([row], [result])
+        assert len(row['metrics']['dvars']) == 19
+        assert row['masks'][('dvars', 'median_detector')][10]
@@ -15,12 +15,13 @@ import sys
 MY_DIR = op.dirname(__file__)
 EXAMPLE_FILENAME = "ds107_sub012_t1r2_small.nii"
 
-sys.path.append("findoutlie")
+# Directory containing the findoutlie package, when run as a script
+sys.path.append(op.join(MY_DIR, "..", ".."))
 import numpy as np
 
 import nibabel as nib
 
-from spm_funcs import get_spm_globals, spm_global
+from findoutlie.spm_funcs import get_spm_globals, spm_global, spm_globals
 
 
 def test_spm_globals():
@@ -37,6 +38,11 @@ def test_spm_globals():
         vol = data[..., vol_no]
         globals.append(spm_global(vol))
     assert np.allclose(globals, expected_values, rtol=1e-4)
+    # Processing the volumes by chunks gives the same values
+    for chunk_size in (1, 7, data.shape[-1]):
+        assert np.allclose(get_spm_globals(example_path, chunk_size),
+                           expected_values, rtol=1e-4)
+    assert np.allclose(spm_globals(data, 5), expected_values, rtol=1e-4)
 
 
 if __name__ == "__main__":
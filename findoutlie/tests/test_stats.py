@@ -0,0 +1,94 @@
+""" Test fused statistics
+
+You can run the tests from the root directory (containing ``README.md``) with::
+
+    python3 -m pytest .
+"""
+
+import os.path as op
+
+import numpy as np
+
+import nibabel as nib
+
+from findoutlie.data_load import RunData
+from findoutlie.metrics import coefficient_of_variation, compute_metric, dvars
+from findoutlie.masking import BrainMask
+from findoutlie.stats import run_stats, temporal_entropy, tsnr
+
+MY_DIR = op.dirname(__file__)
+EXAMPLE_FILENAME = op.join(MY_DIR, "ds107_sub012_t1r2_small.nii")
+
+
+def test_run_stats():
+    img = nib.load(EXAMPLE_FILENAME)
+    data = img.get_fdata()
+    stats = run_stats(img)
+    assert np.allclose(stats.mean_map, np.mean(data, axis=-1))
+    assert np.allclose(stats.sd_map, np.std(data, axis=-1))
+    sd_map = np.std(data, axis=-1)
+    nonzero = sd_map > 0
+    assert np.allclose(stats.tsnr_map[nonzero],
+                       np.mean(data, axis=-1)[nonzero] / sd_map[nonzero])
+    assert np.all(stats.tsnr_map[~nonzero] == 0)
+    assert np.allclose(stats.cv, coefficient_of_variation(img))
+    assert np.allclose(stats.dvars, dvars(img))
+
+
+def test_fused_metrics():
+    run = RunData(EXAMPLE_FILENAME)
+    fused_dvars = compute_metric(run, 'dvars')
+    fused_cv = compute_metric(run, 'coefficient_of_variation')
+    # Computed from the same pass over the data, without decoding it
+    assert run._data is None
+    assert fused_dvars is run.intermediate('run_stats').dvars
+    img = nib.load(EXAMPLE_FILENAME)
+    assert np.allclose(fused_dvars, dvars(img))
+    assert np.allclose(fused_cv, coefficient_of_variation(img))
+
+
+def test_tsnr_entropy():
+    rng = np.random.default_rng(0)
+    data = rng.normal(100, 5, size=(6, 7, 5, 40))
+    data[0, 0, 0] = 3  # Constant voxel
+    data[1, 1, 1, ::2] += 20  # Bimodal voxel
+    entropy = temporal_entropy(data, n_bins=8)
+    expected = np.zeros(data.shape[:-1])
+    for index in np.ndindex(*data.shape[:-1]):
+        counts, _ = np.histogram(data[index], bins=8)
+        p = counts[counts > 0] / data.shape[-1]
+        expected[index] = -np.sum(p * np.log2(p))
+    assert np.allclose(entropy.map, expected)
+    assert entropy.map[0, 0, 0] == 0
+    assert np.isclose(entropy.summary, np.mean(expected))
+    # Default number of bins
+    assert np.allclose(temporal_entropy(data).map,
+                       temporal_entropy(data, n_bins=7).map)
+    snr = tsnr(data)
+    sd_map = np.std(data, axis=-1)
+    varying = sd_map > 0
+    assert np.allclose(snr.map[varying],
+                       np.mean(data, axis=-1)[varying] / sd_map[varying])
+    assert np.isclose(snr.summary, np.mean(snr.map[varying]))
+    # Brain voxels only
+    mask = np.zeros(data.shape[:-1], dtype=bool)
+    mask[1:4, 1:5, 1:4] = True
+    masked = temporal_entropy(data, n_bins=8, mask=BrainMask(mask))
+    assert np.allclose(masked.map[mask], expected[mask])
+    assert np.all(masked.map[~mask] == 0)
+    assert np.isclose(masked.summary, np.mean(expected[mask]))
+    assert np.isclose(tsnr(data, BrainMask(mask)).summary,
+                      np.mean(snr.map[mask]))
+
+
+def test_map_metrics(tmp_path):
+    fname = str(tmp_path / 'run.nii.gz')
+    nib.save(nib.load(EXAMPLE_FILENAME), fname)
+    run = RunData(fname)
+    entropy = compute_metric(run, 'temporal_entropy')
+    snr = compute_metric(run, 'tsnr')
+    assert entropy.shape == snr.shape == (1,)
+    data = nib.load(EXAMPLE_FILENAME).get_fdata()
+    assert np.isclose(entropy[0], temporal_entropy(data).summary)
+    assert np.isclose(snr[0], tsnr(data).summary)
+    assert run.intermediate('entropy_stats').map.shape == data.shape[:-1]
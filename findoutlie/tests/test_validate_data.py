@@ -0,0 +1,106 @@
+""" Test the data validation script
+
+You can run the tests from the root directory (containing ``README.md``) with::
+
+    python3 -m pytest .
+"""
+
+import os
+import os.path as op
+import sys
+
+import pytest
+
+MY_DIR = op.dirname(__file__)
+sys.path.append(op.join(MY_DIR, '..', '..', 'scripts'))
+
+import validate_data
+from validate_data import check_hashes
+
+from findoutlie.cache import file_hash
+
+
+def make_hashed_data(data_dir, n_files=5):
+    """ Write files and their ``hash_list.txt``, return the filenames
+    """
+    group_dir = op.join(data_dir, 'group-00')
+    os.makedirs(group_dir)
+    filenames = []
+    lines = []
+    for i in range(n_files):
+        filename = op.join('group-00', f'file_{i}.bin')
+        with open(op.join(data_dir, filename), 'wb') as fobj:
+            fobj.write(os.urandom(1000))
+        filenames.append(filename)
+        lines.append(f'{file_hash(op.join(data_dir, filename))} {filename}')
+    with open(op.join(group_dir, 'hash_list.txt'), 'w') as fobj:
+        fobj.write('\n'.join(lines) + '\n')
+    return filenames
+
+
+def corrupt(fname):
+    with open(fname, 'ab') as fobj:
+        fobj.write(b'extra')
+
+
+def test_check_hashes(tmp_path):
+    data_dir = str(tmp_path)
+    filenames = make_hashed_data(data_dir)
+    assert check_hashes(data_dir) == {'missing': [], 'corrupted': []}
+    validate_data.validate_data(data_dir)
+    os.remove(op.join(data_dir, filenames[1]))
+    os.remove(op.join(data_dir, filenames[4]))
+    corrupt(op.join(data_dir, filenames[0]))
+    corrupt(op.join(data_dir, filenames[3]))
+    expected = {'missing': [filenames[1], filenames[4]],
+                'corrupted': [filenames[0], filenames[3]]}
+    assert check_hashes(data_dir) == expected
+    # Hashing in parallel gives the same report
+    assert check_hashes(data_dir, n_jobs=3) == expected
+    # The error lists all the failing files
+    with pytest.raises(ValueError) as excinfo:
+        validate_data.validate_data(data_dir, n_jobs=2)
+    message = str(excinfo.value)
+    assert all(filename in message for filename in
+               expected['missing'] + expected['corrupted'])
+    assert filenames[2] not in message
+
+
+def test_manifest(tmp_path, monkeypatch):
+    data_dir = str(tmp_path / 'data')
+    filenames = make_hashed_data(data_dir)
+    manifest_path = str(tmp_path / 'manifest.json')
+    hashed = []
+
+    def counting_hash(fname, *args, **kwargs):
+        hashed.append(op.relpath(fname, data_dir))
+        return file_hash(fname, *args, **kwargs)
+
+    monkeypatch.setattr(validate_data, 'file_hash', counting_hash)
+    report = check_hashes(data_dir, manifest_path=manifest_path)
+    assert report == {'missing': [], 'corrupted': []}
+    assert sorted(hashed) == filenames
+    manifest = validate_data.read_manifest(manifest_path)
+    assert sorted(manifest) == filenames
+    # Unchanged files are not hashed again
+    hashed.clear()
+    assert check_hashes(data_dir, manifest_path=manifest_path) == report
+    assert hashed == []
+    # A change of size or of modification time triggers a new hash
+    corrupt(op.join(data_dir, filenames[0]))
+    stat = os.stat(op.join(data_dir, filenames[1]))
+    os.utime(op.join(data_dir, filenames[1]),
+             ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    report = check_hashes(data_dir, manifest_path=manifest_path)
+    assert sorted(hashed) == filenames[:2]
+    assert report == {'missing': [], 'corrupted': [filenames[0]]}
+    # Corrupted files are dropped from the manifest
+    manifest = validate_data.read_manifest(manifest_path)
+    assert sorted(manifest) == filenames[1:]
+    hashed.clear()
+    check_hashes(data_dir, manifest_path=manifest_path)
+    assert hashed == [filenames[0]]
+    # With full=True, every file is hashed again
+    hashed.clear()
+    check_hashes(data_dir, manifest_path=manifest_path, full=True)
+    assert sorted(hashed) == filenames
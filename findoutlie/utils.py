@@ -1,8 +1,11 @@
+import os
 
 import nibabel as nib
 import numpy as np
 from matplotlib import pyplot as plt
 
+from findoutlie.stats import run_stats
+
 def basic_stats(image_fname,plot=True):
     """ Calculate basic stats metrics to be reused in different metrics
     for outlier detection
@@ -23,11 +26,14 @@ def basic_stats(image_fname,plot=True):
     sdmap_median : float, median of the sd nifti
     """
 
-    filename,img,data=get_image(image_fname)
+    filename = os.path.basename(image_fname)
+    img = nib.load(image_fname)
 
-    mean_data = np.mean(data,axis=-1)
-    #mean of image on the 4th dim, time
-    sd_data=np.std(data,axis=-1) #temporal deviation map
+    # Mean of image on the 4th dim (time) and temporal deviation map,
+    # computed in a single pass over the volumes
+    stats = run_stats(img)
+    mean_data = stats.mean_map
+    sd_data = stats.sd_map
 
     # Median #make sense ?
     meanmap_median=np.median(mean_data)
@@ -67,6 +73,7 @@ def easy_masking(img,value_mask,plot=True):
         NB : USEFUL for : SNR of the background vs SNR of the head (normally brain
         but using this mask, might be difficult just to have the brain)
 
+        See also `masking.compute_brain_mask` for the mask used by the metrics.
 
         Parameters
         ----------
@@ -75,22 +82,23 @@ def easy_masking(img,value_mask,plot=True):
 
         Returns
         -------
-        brain_mask : masked image with value set at 1 if voxel value > value_mask
+        brain_mask : 3D boolean array, True if the voxel mean over time > value_mask
         """
     #from nilearn.maskers import NiftiMasker
 
-    data=img.get_fdata()
+    mean_data = run_stats(img).mean_map
 
-    brain_mask = np.where(data > float(value_mask), 1, 0)
+    brain_mask = mean_data > float(value_mask)
 
     if plot:
         #all the value in the img above value_mask will be set to 1
         #plt.imshow(brain_mask, cmap='gray')
         # Save as nii
+        filename = os.path.basename(img.get_filename())
         print("AS FOR NOW in testing mode --> generating & saving outputs. Comment the lines below in the final code.")
         print("---Saving as nii mean map across time adn sd map. \nWill be in /output_for_tests/")
         # nib.Nifti1Image to convert to a spatial image
-        nib.save(nib.Nifti1Image(brain_mask, img.affine),
+        nib.save(nib.Nifti1Image(brain_mask.astype(np.uint8), img.affine),
                  os.path.join(os.getcwd(), 'output_for_tests', filename + "_desc-brain-mask.nii.gz"))
 
-    return brain_mask
\ No newline at end of file
+    return brain_mask
@@ -0,0 +1,203 @@
+""" Python script to benchmark the metrics, detectors and I/O hot paths
+
+Times and measures the peak memory (with ``tracemalloc``, which tracks the
+numpy allocations) of the hot paths, on synthetic 4D images of several sizes
+and on the small test image.  Run as:
+
+    python3 scripts/benchmark.py --output bench.json
+
+and compare with the results of another commit with:
+
+    python3 scripts/benchmark.py --output new.json --compare bench.json
+
+The comparison exits with an error if any benchmark is slower or uses more
+memory than the reference by more than the ``--tolerance`` fraction.
+"""
+
+import json
+import os
+import os.path as op
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+
+import numpy as np
+import nibabel as nib
+
+# Put the findoutlie directory on the Python path.
+PACKAGE_DIR = op.join(op.dirname(__file__), '..')
+sys.path.append(PACKAGE_DIR)
+
+from findoutlie import detectors, metrics, outfind, spm_funcs
+from findoutlie.cache import file_hash
+
+TEST_FNAME = op.join(PACKAGE_DIR, 'findoutlie', 'tests',
+                     'ds107_sub012_t1r2_small.nii')
+
+# Image shapes of the synthetic benchmarks
+SIZES = {'small': (32, 32, 16, 100),
+         'medium': (64, 64, 30, 200),
+         'large': (100, 100, 72, 1000)}
+
+
+def measure(func, repeat=3):
+    """ Return best wall time and peak traced memory of calling `func`
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'time': min(times), 'peak_bytes': peak}
+
+
+def make_image(shape, fname):
+    """ Save synthetic float32 image of `shape` to `fname`
+
+    The data are generated one volume at a time into a memory map next to
+    `fname`, so that the large image (2.9 GB as float32) is never held in
+    memory.
+    """
+    rng = np.random.default_rng(0)
+    raw_fname = fname + '.raw'
+    # Fortran order, so that each volume is contiguous in the map, and in the
+    # order nibabel writes the data
+    data = np.memmap(raw_fname, dtype=np.float32, mode='w+', shape=shape,
+                     order='F')
+    try:
+        for i in range(shape[-1]):
+            volume = rng.standard_normal(shape[:-1], dtype=np.float32)
+            data[..., i] = volume * 10 + 1000
+        nib.save(nib.Nifti1Image(data, np.eye(4)), fname)
+    finally:
+        del data
+        os.remove(raw_fname)
+
+
+def image_benchmarks(label, fname, repeat):
+    """ Benchmarks working on the image in `fname`
+
+    ``dvars`` and ``coefficient_of_variation`` decode the whole image, so that
+    on the large image they measure the full-decode path (and its memory),
+    where ``streaming_dvars`` and ``detect_outliers`` read one volume at a
+    time.
+    """
+    n_trs = nib.load(fname).shape[-1]
+    rng = np.random.default_rng(0)
+    series = rng.normal(size=n_trs)
+    batch = rng.normal(size=(50, n_trs))
+    # Images are loaded in each call, so that the nibabel data cache does not
+    # hide the decoding cost
+    benchmarks = {
+        'dvars': lambda: metrics.dvars(nib.load(fname)),
+        'streaming_dvars': lambda: metrics.streaming_dvars(nib.load(fname)),
+        'coefficient_of_variation':
+            lambda: metrics.coefficient_of_variation(nib.load(fname)),
+        'temporal_entropy': lambda: metrics.compute_metric(
+            nib.load(fname), 'temporal_entropy'),
+        'get_spm_globals': lambda: spm_funcs.get_spm_globals(fname),
+        'iqr_detector': lambda: detectors.iqr_detector(series),
+        'median_detector': lambda: detectors.median_detector(series),
+        'iqr_detector_batch': lambda: detectors.iqr_detector(batch),
+        'median_detector_batch': lambda: detectors.median_detector(batch),
+        'rolling_median_detector':
+            lambda: detectors.rolling_median_detector(series),
+        'rolling_median_detector_batch':
+            lambda: detectors.rolling_median_detector(batch),
+        'detect_outliers': lambda: outfind.detect_outliers(fname),
+        'file_hash': lambda: file_hash(fname),
+    }
+    results = {}
+    for name, func in benchmarks.items():
+        results[f'{label}/{name}'] = measure(func, repeat)
+        print(f"{label}/{name}: {results[f'{label}/{name}']['time']:.4f} s, "
+              f"{results[f'{label}/{name}']['peak_bytes'] / 2 ** 20:.1f} MB",
+              flush=True)
+    return results
+
+
+def run_benchmarks(sizes, repeat=3):
+    results = image_benchmarks('test_image', TEST_FNAME, repeat)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for size in sizes:
+            fname = op.join(tmp_dir, f'sub-01_{size}_bold.nii.gz')
+            make_image(SIZES[size], fname)
+            results.update(image_benchmarks(size, fname, repeat))
+            os.remove(fname)
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=PACKAGE_DIR,
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, reference, tolerance):
+    """ Print ratios to `reference`, return names of the regressions
+    """
+    regressions = []
+    for name, values in results.items():
+        if name not in reference:
+            continue
+        ratios = {key: values[key] / max(reference[name][key], 1e-12)
+                  for key in ('time', 'peak_bytes')}
+        flag = ''
+        if any(ratio > 1 + tolerance for ratio in ratios.values()):
+            regressions.append(name)
+            flag = '  <-- regression'
+        print(f"{name}: time x{ratios['time']:.2f}, "
+              f"memory x{ratios['peak_bytes']:.2f}{flag}")
+    return regressions
+
+
+def get_parser():
+    parser = ArgumentParser(description=__doc__,  # Usage from docstring
+                            formatter_class=RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', nargs='*', default=['small', 'medium'],
+                        choices=list(SIZES),
+                        help='Synthetic image sizes (default small medium)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Number of timed calls, best kept (default 3)')
+    parser.add_argument('--output', help='JSON file for the results')
+    parser.add_argument('--compare', help='JSON results of a reference run')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Accepted slow down or memory increase fraction '
+                        '(default 0.2)')
+    return parser
+
+
+def main():
+    # This function (main) called when this file run as a script.
+    parser = get_parser()
+    args = parser.parse_args()
+    results = run_benchmarks(args.sizes, args.repeat)
+    if args.output:
+        with open(args.output, 'w') as fobj:
+            json.dump({'commit': git_commit(),
+                       'python': platform.python_version(),
+                       'numpy': np.__version__,
+                       'results': results}, fobj, indent=1)
+    if args.compare:
+        with open(args.compare) as fobj:
+            reference = json.load(fobj)
+        print(f"Compared to commit {reference['commit']}:")
+        regressions = compare(results, reference['results'], args.tolerance)
+        if regressions:
+            sys.exit(f'{len(regressions)} benchmark(s) regressed')
+
+
+if __name__ == '__main__':
+    # Python is running this file as a script, not importing it.
+    main()
@@ -3,22 +3,55 @@
 Run as:
 
     python3 scripts/find_outliers.py data
+
+or, using 8 worker processes:
+
+    python3 scripts/find_outliers.py data --jobs 8
+
+With ``--cohort``, the runs and subjects that are outliers relative to the
+rest of the dataset are printed instead.
+
+With ``--results results.npz``, the metric values, the masks of each detector
+and the consensus mask of every run are also saved to ``results.npz`` (or to a
+Parquet file for a name ending with ``.parquet``, needing ``pyarrow``); see
+``findoutlie/results.py`` to load them.
+
+With ``--profile timings.jsonl``, the time and memory of each stage of each run
+are written to ``timings.jsonl`` (see ``findoutlie/profiling.py``), and their
+summary printed at the end.
 """
 
 import os.path as op
 import sys
 
+import numpy as np
+
 from argparse import ArgumentParser, RawDescriptionHelpFormatter
 
 # Put the findoutlie directory on the Python path.
 PACKAGE_DIR = op.join(op.dirname(__file__), '..')
 sys.path.append(PACKAGE_DIR)
 
-from findoutlie import outfind
+from findoutlie import cohort, outfind, profiling
+from findoutlie.cache import DecodeCache, MetricCache
+from findoutlie.results import ResultsWriter
 
 
-def print_outliers(data_directory):
-    outlier_dict = outfind.find_outliers(data_directory)
+def print_outliers(data_directory, n_jobs=1, cache_dir=None,
+                   decode_cache_dir=None, results_fname=None,
+                   index_path=None):
+    cache = None if cache_dir is None else MetricCache(cache_dir)
+    decode_cache = (None if decode_cache_dir is None
+                    else DecodeCache(decode_cache_dir))
+    results = None if results_fname is None else ResultsWriter(results_fname)
+    try:
+        outlier_dict, error_dict = outfind.find_outliers(
+            data_directory, n_jobs=n_jobs, return_errors=True, cache=cache,
+            decode_cache=decode_cache, results=results,
+            index_path=index_path)
+    finally:
+        if results is not None:
+            results.close()
     for fname, outliers in outlier_dict.items():
         if len(outliers) == 0:
             continue
@@ -26,6 +59,26 @@ def print_outliers(data_directory):
         for out_ind in outliers:
             outlier_strs.append(str(out_ind))
         print(', '.join([fname] + outlier_strs))
+    for fname, err in error_dict.items():
+        print(f'{fname}: {err!r}', file=sys.stderr)
+
+
+def print_cohort_outliers(data_directory, n_jobs=1, cache_dir=None,
+                          decode_cache_dir=None, index_path=None):
+    cache = None if cache_dir is None else MetricCache(cache_dir)
+    decode_cache = (None if decode_cache_dir is None
+                    else DecodeCache(decode_cache_dir))
+    fnames, outliers, error_dict = cohort.find_cohort_outliers(
+        data_directory, n_jobs=n_jobs, cache=cache, decode_cache=decode_cache,
+        index_path=index_path, return_errors=True)
+    for metric_name, metric_outliers in outliers.items():
+        for run_index in np.where(metric_outliers.runs)[0]:
+            print(f'{metric_name}, run, {fnames[run_index]}')
+        for group_index in np.where(metric_outliers.groups)[0]:
+            print(f'{metric_name}, subject, '
+                  f'{metric_outliers.group_labels[group_index]}')
+    for fname, err in error_dict.items():
+        print(f'{fname}: {err!r}', file=sys.stderr)
 
 
 def get_parser():
@@ -33,6 +86,26 @@ def get_parser():
                             formatter_class=RawDescriptionHelpFormatter)
     parser.add_argument('data_directory',
                         help='Directory containing data')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of worker processes (default 1)')
+    parser.add_argument('--cache-dir',
+                        help='Directory caching the metric values between '
+                        'calls (default no cache)')
+    parser.add_argument('--decode-cache-dir',
+                        help='Directory caching uncompressed copies of the '
+                        'runs between calls (default no cache)')
+    parser.add_argument('--index', metavar='JSON',
+                        help='Dataset index file (default in the user cache '
+                        'directory, ~/.cache/findoutlie/index)')
+    parser.add_argument('--cohort', action='store_true',
+                        help='Print the outlier runs and subjects across the '
+                        'dataset')
+    parser.add_argument('--results', metavar='FILE',
+                        help='Save the metric values and outlier masks of '
+                        'all the runs to this .npz or .parquet file')
+    parser.add_argument('--profile', metavar='JSONL',
+                        help='Write the time and memory of each stage to this '
+                        'JSON lines file, and print their summary')
     return parser
 
 
@@ -43,7 +116,27 @@ def main():
     parser = get_parser()
     args = parser.parse_args()
     # Call function to find outliers.
-    print_outliers(args.data_directory)
+    if args.profile:
+        # Start a new file, the records are appended
+        open(args.profile, 'w').close()
+        profiling.enable(args.profile)
+    if args.cohort:
+        print_cohort_outliers(args.data_directory, n_jobs=args.jobs,
+                              cache_dir=args.cache_dir,
+                              decode_cache_dir=args.decode_cache_dir,
+                              index_path=args.index)
+    else:
+        print_outliers(args.data_directory, n_jobs=args.jobs,
+                       cache_dir=args.cache_dir,
+                       decode_cache_dir=args.decode_cache_dir,
+                       results_fname=args.results,
+                       index_path=args.index)
+    if args.profile:
+        summaries = [record['summary']
+                     for record in profiling.read_records(args.profile)
+                     if 'summary' in record]
+        if summaries:
+            print(profiling.format_summary(summaries[-1]), file=sys.stderr)
 
 
 if __name__ == '__main__':
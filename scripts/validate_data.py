@@ -6,41 +6,156 @@ Run as:
     
 or in anaconda
     python scripts/validate_data.py data
+
+or, checking 8 files at a time:
+
+    python3 scripts/validate_data.py data --jobs 8
+
+With a manifest, only the files changed since the last validation are hashed
+again (use ``--full`` to hash all of them):
+
+    python3 scripts/validate_data.py data --manifest data/manifest.json
 """
 
 import os
+import os.path as op
+import json
 import sys
-import hashlib
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+from concurrent.futures import ThreadPoolExecutor
+
+# Put the findoutlie directory on the Python path.
+PACKAGE_DIR = op.join(op.dirname(__file__), '..')
+sys.path.append(PACKAGE_DIR)
+
+from findoutlie.cache import file_hash
+
+
+def read_hash_list(data_directory):
+    """ Return (hash, filename) pairs listed in ``hash_list.txt``
+    """
+    hash_file_path = os.path.join(data_directory, "group-00", "hash_list.txt")
+
+    with open(hash_file_path) as f:
+        lines = f.read().splitlines()
+    pairs = []
+    for line in lines:
+        if not line.strip():
+            continue
+        correct_hash, filename = line.split(maxsplit=1)
+        pairs.append((correct_hash, filename))
+    return pairs
+
+
+def read_manifest(manifest_path):
+    """ Return manifest entries stored in `manifest_path`, empty if missing
+    """
+    try:
+        with open(manifest_path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def write_manifest(manifest_path, manifest):
+    """ Write manifest entries to `manifest_path`
+    """
+    # Write then rename, so an interrupted write does not corrupt the manifest
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
 
 
-def file_hash(filename):
-    """ Get byte contents of file `filename`, return SHA1 hash
+def stat_entry(file_path):
+    """ Return size, modification time and inode of `file_path`
+    """
+    stat = os.stat(file_path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+            'inode': stat.st_ino}
+
+
+def check_hashes(data_directory, n_jobs=1, manifest_path=None, full=False):
+    """ Check every file listed in ``hash_list.txt``, return the failures
+
+    With a manifest, a file whose size, modification time and inode are the
+    ones recorded when its hash was last verified is not hashed again.
 
     Parameters
     ----------
-    filename : str
-        Name of file to read
+    data_directory : str
+        Directory containing data and ``hash_list.txt`` file.
+    n_jobs : int, optional
+        Number of files hashed at the same time, by default 1.
+    manifest_path : str, optional
+        Path of the manifest recording the verified files, by default None
+        (no manifest).  It is created if it does not exist, and updated with
+        the files verified by this call.
+    full : bool, optional
+        If True, hash every file even if the manifest shows it did not
+        change, by default False.
 
     Returns
     -------
-    hash : str
-        SHA1 hexadecimal hash string for contents of `filename`.
+    report : dict
+        Dictionary with keys "missing" and "corrupted", giving the lists of
+        filenames that do not exist or have a wrong hash, in the order of
+        ``hash_list.txt``.
     """
-    with open(filename, 'rb') as fobj:
-        file_bytes = fobj.read()
-    return hashlib.sha1(file_bytes).hexdigest()
-
+    pairs = read_hash_list(data_directory)
+    manifest = {} if manifest_path is None else read_manifest(manifest_path)
 
-def validate_data(data_directory):
+    def _hash(filename):
+        file_path = os.path.join(data_directory, filename)
+        try:
+            entry = stat_entry(file_path)
+        except FileNotFoundError:
+            return None, None
+        known = manifest.get(filename, {})
+        if not full and {k: known.get(k) for k in entry} == entry:
+            return known['hash'], entry
+        return file_hash(file_path), entry
+
+    # hashlib releases the GIL on large blocks, so threads hash in parallel
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        actual_hashes = executor.map(_hash, [fname for _, fname in pairs])
+        report = {'missing': [], 'corrupted': []}
+        for (correct_hash, filename), (actual_hash, entry) in zip(
+                pairs, actual_hashes):
+            manifest.pop(filename, None)
+            if actual_hash is None:
+                report['missing'].append(filename)
+            elif actual_hash != correct_hash:
+                report['corrupted'].append(filename)
+            else:
+                manifest[filename] = dict(entry, hash=actual_hash)
+
+    if manifest_path is not None:
+        write_manifest(manifest_path, manifest)
+    return report
+
+
+def validate_data(data_directory, n_jobs=1, manifest_path=None, full=False):
     """ Read ``hash_list.txt`` file in ``data_directory``, check hashes
     
     An example file ``data_hashes.txt`` is found in the baseline version
     of the repository template for your reference.
 
+    Every listed file is checked before reporting, so the error lists all the
+    missing and corrupted files.
+
     Parameters
     ----------
     data_directory : str
         Directory containing data and ``hash_list.txt`` file.
+    n_jobs : int, optional
+        Number of files hashed at the same time, by default 1.
+    manifest_path : str, optional
+        Path of the manifest recording the verified files, by default None
+        (no manifest, all the files are hashed).
+    full : bool, optional
+        If True, hash every file even if the manifest shows it did not
+        change, by default False.
 
     Returns
     -------
@@ -49,44 +164,45 @@ def validate_data(data_directory):
     Raises
     ------
     ValueError:
-        If hash value for any file is different from hash value recorded in
-        ``hash_list.txt`` file.
+        If any file is missing, or if hash value for any file is different
+        from hash value recorded in ``hash_list.txt`` file.
     """
-    # Read lines from ``hash_list.txt`` file.
-    # Split into SHA1 hash and filename
-    # Calculate actual hash for given filename.
-    # If hash for filename is not the same as the one in the file, raise
-    # ValueError
-    
-    
-    hash_file_path = os.path.join(data_directory, "group-00", "hash_list.txt")
-    
-    with open(hash_file_path) as f:
-        lines = f.read().splitlines()
-    for line in lines :
-        split_line = line.split(" ")
-        filename = split_line[1]
-        correct_hash = split_line[0]
+    report = check_hashes(data_directory, n_jobs, manifest_path, full)
+
+    messages = ([f"Missing file: {filename}" for filename in report['missing']]
+                + [f"Oh no, seems that {filename} is corrupted"
+                   for filename in report['corrupted']])
+    if messages:
+        raise ValueError("\n".join(messages))
 
-        file_path = os.path.join(data_directory, filename)
-        actual_hash = file_hash(file_path)
-        if correct_hash != actual_hash :
-            raise ValueError(f"Oh no, seems that {filename} is corrupted")
-    
     print('All good! \n')
 
 
+def get_parser():
+    parser = ArgumentParser(description=__doc__,  # Usage from docstring
+                            formatter_class=RawDescriptionHelpFormatter)
+    parser.add_argument('data_directory',
+                        help='Directory containing data')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of files hashed at the same time '
+                        '(default 1)')
+    parser.add_argument('--manifest',
+                        help='Manifest file recording the verified files, '
+                        'so unchanged files are not hashed again')
+    parser.add_argument('--full', action='store_true',
+                        help='Hash all files, even unchanged ones')
+    return parser
+
 
 def main():
     # This function (main) called when this file run as a script.
     #
     # Get the data directory from the command line arguments
-    if len(sys.argv) < 2:
-        raise RuntimeError("Please give data directory on "
-                           "command line")
-    data_directory = sys.argv[1]
+    parser = get_parser()
+    args = parser.parse_args()
     # Call function to validate data in data directory
-    validate_data(data_directory)
+    validate_data(args.data_directory, n_jobs=args.jobs,
+                  manifest_path=args.manifest, full=args.full)
 
 
 if __name__ == '__main__':